@@ -1,5 +1,4 @@
 import logging
-import time
 from datetime import datetime
 
 from aiogram import Router, F, types
@@ -7,43 +6,36 @@ from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
 
 # Импорты
-from ..core.models import User, Plan, Subscription, Transaction
+from ..core.models import Transaction
+from ..core.repository import latest_subscription, register_user
 from ..core.config import settings
-from .keyboards import main_menu, plans_keyboard, admin_approval_keyboard
-from ..services.marzban_api import MarzbanAPI
+from .keyboards import main_menu, admin_approval_keyboard
+from .qr import send_key_qr
+from .sender import answer, send_photo
+from .texts import INSTRUCTION_TEXT, MARZBAN_ERROR_TEXT, WELCOME_TEXT
+from ..services.server_pool import server_pool
+from ..services.provisioning import enqueue_provisioning, provisioning_worker
+from ..services.plan_catalog import plan_catalog
+from ..services.stats_service import record_activity, record_transaction, set_transaction_status
 
 # Логирование
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 router = Router()
-api = MarzbanAPI()
-
-# --- ТЕКСТЫ ---
-INSTRUCTION_TEXT = (
-    "<b>🚀 Настройка подключения:</b>\n\n"
-    "1. Скачай приложение:\n"
-    "📱 <b>Android:</b> <a href='https://play.google.com/store/apps/details?id=com.v2ray.ang'>v2rayNG (Google Play)</a>\n"
-    "🍏 <b>iOS:</b> <a href='https://apps.apple.com/us/app/v2box-v2ray-client/id6446814690'>V2Box (AppStore)</a>\n"
-    "💻 <b>PC (Windows):</b> <a href='https://github.com/hiddify/hiddify-next/releases/latest/download/Hiddify-Windows-Setup-x64.exe'>Скачать Hiddify</a>\n\n"
-    "2. Скопируй ключ (начинается с <code>vless://</code>).\n"
-    "3. Вставь ключ в приложение и нажми подключиться."
-)
-
-WELCOME_TEXT = (
-    "Привет, <b>{name}</b>! 👋\n\n"
-    "Я бот для выдачи скоростного доступа в сеть.\n"
-    "Youtube 4K, Instagram, Игры — без ограничений скорости.\n\n"
-    "🔐 Трафик шифруется. Логи не ведутся.\n"
-    "Жми <b>«⚡️ Купить доступ»</b>, чтобы начать."
-)
 
 class PaymentStates(StatesGroup):
     waiting_for_receipt = State()
 
+# Кнопки -> хендлеры для ThrottlingMiddleware (она работает до фильтров роутера)
+THROTTLE_ROUTES = {
+    "⚡️ Купить доступ": "shop_menu",
+    "👤 Профиль": "profile_menu",
+    "buy_plan_": "process_buy_plan",
+}
+
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
 
 def get_username(user: types.User) -> str:
@@ -52,38 +44,18 @@ def get_username(user: types.User) -> str:
         return user.username
     return f"user_{user.id}"
 
-async def get_expire_date(username: str, days: int) -> int:
-    """Считает дату окончания подписки"""
-    current_ts = int(time.time())
-    seconds_add = days * 24 * 60 * 60
-    
-    try:
-        user_info = await api.get_user(username)
-        old_expire = user_info.get("expire") or 0
-        if old_expire > current_ts:
-            return old_expire + seconds_add
-    except:
-        pass
-        
-    return current_ts + seconds_add
-
 # --- ХЕНДЛЕРЫ ---
 
 @router.message(Command("start"))
 async def cmd_start(message: types.Message, session: AsyncSession, state: FSMContext):
     await state.clear()
     
-    # Проверка юзера
-    result = await session.execute(select(User).where(User.telegram_id == message.from_user.id))
-    if not result.scalars().first():
-        session.add(User(
-            telegram_id=message.from_user.id,
-            username=message.from_user.username,
-            full_name=message.from_user.full_name
-        ))
+    # Регистрация юзера одним upsert'ом
+    if await register_user(session, message.from_user.id, message.from_user.username, message.from_user.full_name):
+        await record_activity(session, "new_users")
         await session.commit()
     
-    await message.answer(
+    await answer(message,
         WELCOME_TEXT.format(name=message.from_user.first_name),
         reply_markup=main_menu(), 
         parse_mode="HTML"
@@ -95,23 +67,24 @@ async def cmd_home(message: types.Message, session: AsyncSession, state: FSMCont
 
 @router.message(F.text == "ℹ️ Помощь")
 async def help_command(message: types.Message):
-    await message.answer(INSTRUCTION_TEXT, parse_mode="HTML", disable_web_page_preview=True)
+    await answer(message, INSTRUCTION_TEXT, parse_mode="HTML", disable_web_page_preview=True)
 
 @router.message(F.text == "⚡️ Купить доступ")
-async def shop_menu(message: types.Message, session: AsyncSession):
-    result = await session.execute(select(Plan).where(Plan.is_active == True))
-    plans = result.scalars().all()
+async def shop_menu(message: types.Message):
+    # Каталог и клавиатура собраны заранее — в БД не ходим
+    await plan_catalog.ensure_loaded()
     
-    if not plans:
-        await message.answer("Тарифы не найдены.")
+    if not plan_catalog.keyboard:
+        await answer(message, "Тарифы не найдены.")
         return
         
-    await message.answer("💎 Выберите период:", reply_markup=plans_keyboard(plans))
+    await answer(message, "💎 Выберите период:", reply_markup=plan_catalog.keyboard)
 
 @router.callback_query(F.data.startswith("buy_plan_"))
 async def process_buy_plan(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     plan_id = int(callback.data.split("_")[-1])
-    plan = await session.get(Plan, plan_id)
+    await plan_catalog.ensure_loaded()
+    plan = plan_catalog.get(plan_id)
     
     if not plan:
         await callback.answer("Тариф не найден.")
@@ -124,59 +97,23 @@ async def process_buy_plan(callback: types.CallbackQuery, state: FSMContext, ses
     if plan.price == 0:
         await callback.answer("⏳ Активация...", show_alert=False)
         try:
-            expire_ts = await get_expire_date(username, plan.duration_days)
-            
-            # 1. Создаем в Marzban
-            user_data = await api.create_user(
-                username=username,
-                data_limit=plan.limit_gb,
-                expire=expire_ts
-            )
-            
-            if not user_data:
-                await callback.message.answer("❌ Ошибка API Marzban.")
-                return
-
-            sub_url = user_data.get('subscription_url', '')
-            links = user_data.get('links', [])
-            vless_key = links[0] if links else "Ошибка ключа"
-            
-            # 2. Сохраняем в БД (Только существующие поля!)
-            q = await session.execute(select(Subscription).where(Subscription.user_id == callback.from_user.id))
-            existing_sub = q.scalars().first()
-
-            if existing_sub:
-                existing_sub.marzban_key = sub_url
-                existing_sub.status = "active"
-                existing_sub.expire_date = datetime.fromtimestamp(expire_ts)
-                existing_sub.plan_id = plan.id
-            else:
-                new_sub = Subscription(
-                    user_id=callback.from_user.id,
-                    plan_id=plan.id,
-                    marzban_key=sub_url,
-                    status="active",
-                    expire_date=datetime.fromtimestamp(expire_ts)
-                )
-                session.add(new_sub)
-            
+            # Выдачу делает воркер из outbox, ключ придет отдельным сообщением
+            enqueue_provisioning(session, callback.from_user.id, username, plan.id)
             await session.commit()
+            provisioning_worker.notify()
             
-            await callback.message.answer(
-                f"✅ <b>Доступ активирован!</b>\n"
+            await answer(callback.message,
+                f"⏳ <b>Активируем доступ...</b>\n"
                 f"Тариф: {plan.name}\n\n"
-                f"<b>Ваш ключ (ссылка):</b>\n{sub_url}\n\n"
-                f"<b>Ваш ключ (VLESS):</b>\n<code>{vless_key}</code>",
-                parse_mode="HTML",
-                disable_web_page_preview=True
+                "Ключ придет в этот чат через несколько секунд.",
+                parse_mode="HTML"
             )
-            await callback.message.answer(INSTRUCTION_TEXT, parse_mode="HTML", disable_web_page_preview=True)
             try: await callback.message.delete()
             except: pass
             
         except Exception as e:
             logger.error(f"Error free plan: {e}")
-            await callback.message.answer(f"⚠️ Ошибка: {e}")
+            await answer(callback.message, f"⚠️ Ошибка: {e}")
         return
 
     # === ПЛАТНЫЙ ТАРИФ ===
@@ -199,74 +136,41 @@ async def handle_receipt(message: types.Message, state: FSMContext, session: Asy
         amount = data.get("amount")
         photo = message.photo[-1]
         
-        plan = await session.get(Plan, plan_id)
+        await plan_catalog.ensure_loaded()
+        plan = plan_catalog.get(plan_id)
 
-        # 1. Работаем с Marzban (Логин = Никнейм)
-        username = get_username(message.from_user)
-        expire_ts = await get_expire_date(username, plan.duration_days)
-        
-        user_data = await api.create_user(
-            username=username,
-            data_limit=plan.limit_gb,
-            expire=expire_ts
-        )
-        
-        if not user_data:
-            raise Exception("Marzban не вернул данные")
-
-        sub_url = user_data.get('subscription_url', '')
-        links = user_data.get('links', [])
-        vless_key = links[0] if links else "Ключ генерируется..."
-        expire_str = datetime.fromtimestamp(expire_ts).strftime('%d.%m.%Y')
-
-        # 2. Сохраняем в БД (БЕЗ выдуманных полей)
+        # 1. Транзакция и заявка на выдачу — одним коммитом (Логин = Никнейм)
         new_tx = Transaction(
             user_id=message.from_user.id,
             plan_id=plan_id,
             amount=amount,
-            status="success",
+            receipt_file_id=photo.file_id,
+            status="pending",
             created_at=datetime.now()
         )
         session.add(new_tx)
         await session.flush()
+        await record_transaction(session, new_tx, None, "pending")
         
-        q = await session.execute(select(Subscription).where(Subscription.user_id == message.from_user.id))
-        existing_sub = q.scalars().first()
-
-        if existing_sub:
-            existing_sub.marzban_key = sub_url
-            existing_sub.status = "active"
-            existing_sub.expire_date = datetime.fromtimestamp(expire_ts)
-            existing_sub.plan_id = plan.id
-        else:
-            new_sub = Subscription(
-                user_id=message.from_user.id,
-                plan_id=plan_id,
-                marzban_key=sub_url,
-                status="active",
-                expire_date=datetime.fromtimestamp(expire_ts)
-            )
-            session.add(new_sub)
-        
+        enqueue_provisioning(session, message.from_user.id, get_username(message.from_user), plan.id, transaction_id=new_tx.id)
         await session.commit()
+        provisioning_worker.notify()
 
-        # 3. Ответ юзеру
-        await message.answer(
+        # 2. Ответ юзеру сразу, ключ пришлет воркер
+        await answer(message,
             f"✅ <b>Платеж принят!</b>\n"
-            f"Подписка продлена до: <b>{expire_str}</b>\n\n"
-            f"<b>Ваш ключ (ссылка):</b>\n{sub_url}\n\n"
-            f"<b>Ваш ключ (VLESS):</b>\n<code>{vless_key}</code>",
-            parse_mode="HTML",
-            disable_web_page_preview=True
+            f"Тариф: {plan.name}\n\n"
+            "⏳ Ключ придет в этот чат через несколько секунд.",
+            parse_mode="HTML"
         )
-        await message.answer(INSTRUCTION_TEXT, parse_mode="HTML", disable_web_page_preview=True)
 
-        # 4. Админу
+        # 3. Админу
         try:
-            await message.bot.send_photo(
-                chat_id=settings.ADMIN_ID,
-                photo=photo.file_id,
-                caption=f"🔔 <b>Новый платеж!</b>\nЮзер: {message.from_user.full_name} (@{message.from_user.username})\nСумма: {amount} RUB\nТариф: {plan.name}\n\n✅ <i>Выдано автоматом</i>",
+            await send_photo(
+                message.bot,
+                settings.ADMIN_ID,
+                photo.file_id,
+                caption=f"🔔 <b>Новый платеж!</b>\nЮзер: {message.from_user.full_name} (@{message.from_user.username})\nСумма: {amount} RUB\nТариф: {plan.name}\n\n✅ <i>Выдается автоматом</i>",
                 reply_markup=admin_approval_keyboard(new_tx.id),
                 parse_mode="HTML"
             )
@@ -275,43 +179,42 @@ async def handle_receipt(message: types.Message, state: FSMContext, session: Asy
     
     except Exception as e:
         logger.error(f"Receipt error: {e}", exc_info=True)
-        await message.answer(f"🚫 Ошибка: {e}")
+        await answer(message, f"🚫 Ошибка: {e}")
     
     finally:
         await state.clear()
 
 @router.message(F.text == "👤 Профиль")
 async def profile_menu(message: types.Message, session: AsyncSession):
-    q = await session.execute(
-        select(Subscription).where(Subscription.user_id == message.from_user.id).order_by(Subscription.id.desc())
-    )
-    sub = q.scalars().first()
+    sub = await latest_subscription(session, message.from_user.id)
     
     if not sub:
-        await message.answer("У вас нет активных подписок.")
+        await answer(message, "У вас нет активных подписок.")
     else:
         status = "✅ Активна" if sub.status == "active" else "❌ Истекла"
         date_str = sub.expire_date.strftime('%d.%m.%Y %H:%M') if sub.expire_date else "Бессрочно"
         
-        # Вычисляем логин
-        username = get_username(message.from_user)
+        # Логин, под которым юзер выдан в Marzban (ник мог смениться)
+        username = sub.marzban_username or get_username(message.from_user)
         
-        try:
-            user_info = await api.get_user(username)
-            links = user_info.get('links', [])
-            vless_key = links[0] if links else "Ошибка"
-        except:
-            vless_key = "..."
+        res = await server_pool.api_for(sub.server_id).get_user(username)
+        if res:
+            links = (res.data or {}).get('links', [])
+            vless_key = f"<code>{links[0]}</code>" if links else "Ошибка"
+        else:
+            # Таймаут, дедлайн апдейта или открытый предохранитель — говорим юзеру, что случилось
+            vless_key = MARZBAN_ERROR_TEXT.get(res.error, "⚠️ Не удалось получить ключ с сервера. Попробуйте позже.")
 
-        await message.answer(
+        await answer(message,
             f"👤 <b>Профиль</b>\n\n"
             f"Статус: {status}\n"
             f"Истекает: {date_str}\n\n"
             f"<b>Ваш ключ (ссылка):</b>\n{sub.marzban_key}\n\n"
-            f"<b>Ваш ключ (VLESS):</b>\n<code>{vless_key}</code>",
+            f"<b>Ваш ключ (VLESS):</b>\n{vless_key}",
             parse_mode="HTML",
             disable_web_page_preview=True
         )
+        await send_key_qr(message.bot, session, message.chat.id, sub)
 
 # Callbacks админа
 @router.callback_query(F.data.startswith("admin_approve_"))
@@ -323,6 +226,6 @@ async def admin_reject(callback: types.CallbackQuery, session: AsyncSession):
     tx_id = int(callback.data.split("_")[-1])
     tx = await session.get(Transaction, tx_id)
     if tx:
-        tx.status = "failed"
+        await set_transaction_status(session, tx, "failed")
         await session.commit()
     await callback.message.edit_caption(caption=f"{callback.message.caption}\n\n❌ Отклонено")
@@ -0,0 +1,215 @@
+import logging
+import time
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from ..core.config import settings
+from ..core.db import AsyncSessionLocal
+from ..core.metrics import DB_QUERIES_PER_UPDATE, HANDLER_LATENCY, THROTTLED_UPDATES
+from ..services.marzban_api import deadline_scope
+from .sender import TokenBucket, send_message
+
+logger = logging.getLogger(__name__)
+
+# Счетчики по хендлерам: сколько апдейтов, сколько реально открытых сессий и запросов
+session_stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {"updates": 0, "sessions": 0, "queries": 0})
+
+
+class LazySession:
+    """
+    Прокси над AsyncSession: сессия создается только при первом обращении.
+    Хендлеры вроде help_command вообще не трогают БД и не платят за сессию.
+    """
+
+    def __init__(self, session_factory: async_sessionmaker):
+        self._factory = session_factory
+        self._session: Optional[AsyncSession] = None
+        self.queries = 0
+        self.handler_name = "unhandled"
+
+    @property
+    def opened(self) -> bool:
+        return self._session is not None
+
+    def _count_query(self, orm_execute_state):
+        self.queries += 1
+
+    def _get(self) -> AsyncSession:
+        if self._session is None:
+            self._session = self._factory()
+            event.listen(self._session.sync_session, "do_orm_execute", self._count_query)
+        return self._session
+
+    def __getattr__(self, name: str):
+        return getattr(self._get(), name)
+
+    async def finish(self, failed: bool):
+        if self._session is None:
+            return
+        try:
+            # Хендлеры коммитят сами; все, что осталось незакоммиченным, откатываем
+            if failed or self._session.in_transaction():
+                await self._session.rollback()
+        finally:
+            await self._session.close()
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """Outer-middleware на update: кладет в data ленивую сессию и закрывает ее после хендлера"""
+
+    def __init__(self, session_factory: async_sessionmaker = AsyncSessionLocal):
+        self.session_factory = session_factory
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        session = LazySession(self.session_factory)
+        data["session"] = session
+        failed = True
+        try:
+            result = await handler(event, data)
+            failed = False
+            return result
+        finally:
+            await session.finish(failed)
+            stats = session_stats[session.handler_name]
+            stats["updates"] += 1
+            stats["sessions"] += int(session.opened)
+            stats["queries"] += session.queries
+            DB_QUERIES_PER_UPDATE.observe(session.handler_name, value=session.queries)
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """Inner-middleware: запоминает, какой хендлер обработал апдейт, и меряет его время"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        session = data.get("session")
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unhandled"
+        if isinstance(session, LazySession):
+            session.handler_name = name
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            HANDLER_LATENCY.observe(name, value=time.perf_counter() - started)
+
+
+class DeadlineMiddleware(BaseMiddleware):
+    """Outer-middleware на update: общий дедлайн для всех вызовов Marzban внутри апдейта"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        with deadline_scope(settings.UPDATE_DEADLINE):
+            return await handler(event, data)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Outer-middleware на update (ставится первым): token bucket на юзера и хендлер.
+    Лишние апдейты отбрасываются до сессии БД и запросов в Marzban.
+    Middleware работает до фильтров роутера, поэтому хендлер узнает по кнопке:
+    routes — точный текст сообщения или префикс callback_data -> имя хендлера.
+    """
+
+    NOTICE_TEXT = "⏳ Не так быстро — подождите пару секунд."
+
+    def __init__(
+        self,
+        default: Tuple[float, float],
+        rates: Optional[Dict[str, Tuple[float, float]]] = None,
+        routes: Optional[Dict[str, str]] = None,
+        idle_ttl: float = 300,
+        notice_interval: float = 10,
+    ):
+        self.default = default
+        self.rates = rates or {}
+        self.routes = routes or {}
+        self.idle_ttl = idle_ttl
+        self.notice_interval = notice_interval
+        self.buckets: Dict[Tuple[int, str], TokenBucket] = {}
+        self.notices: Dict[int, float] = {}
+        self.shed: Dict[str, int] = defaultdict(int)
+        self._swept = time.monotonic()
+
+    def _handler_name(self, event: Update) -> str:
+        if event.message is not None and event.message.text in self.routes:
+            return self.routes[event.message.text]
+        if event.callback_query is not None and event.callback_query.data:
+            for prefix, name in self.routes.items():
+                if event.callback_query.data.startswith(prefix):
+                    return name
+        return "default"
+
+    def _sweep(self, now: float):
+        # Раз в idle_ttl: полная корзина ничем не отличается от новой, ее можно забыть
+        self._swept = now
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if not bucket.is_idle()}
+        self.notices = {user_id: at for user_id, at in self.notices.items() if now - at < self.notice_interval}
+
+    def allow(self, user_id: int, name: str) -> bool:
+        rate, burst = self.rates.get(name, self.default)
+        if rate <= 0:
+            return True
+        now = time.monotonic()
+        if now - self._swept >= self.idle_ttl:
+            self._sweep(now)
+        bucket = self.buckets.get((user_id, name))
+        if bucket is None:
+            bucket = self.buckets[(user_id, name)] = TokenBucket(rate, burst)
+        if bucket.delay() > 0:
+            return False
+        bucket.consume()
+        return True
+
+    async def _notify(self, event: Update, user_id: int, bot):
+        now = time.monotonic()
+        # Одно предупреждение на серию: сам ответ тоже запрос к Telegram
+        if now - self.notices.get(user_id, float("-inf")) < self.notice_interval:
+            return
+        self.notices[user_id] = now
+        if event.callback_query is not None:
+            await bot.answer_callback_query(event.callback_query.id, text=self.NOTICE_TEXT)
+        elif event.message is not None:
+            await send_message(bot, event.message.chat.id, self.NOTICE_TEXT)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None or not isinstance(event, Update):
+            return await handler(event, data)
+        name = self._handler_name(event)
+        if self.allow(user.id, name):
+            return await handler(event, data)
+
+        self.shed[name] += 1
+        THROTTLED_UPDATES.inc(name)
+        try:
+            await self._notify(event, user.id, data["bot"])
+        except Exception as e:
+            logger.warning(f"Throttle notice to {user.id} failed: {e}")
+        return None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"buckets": len(self.buckets), "shed": dict(self.shed)}
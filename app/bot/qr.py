@@ -0,0 +1,54 @@
+"""
+QR-код ссылки подписки для импорта ключа на другом устройстве.
+Картинка рисуется один раз в отдельном потоке, дальше отправляется по file_id Telegram:
+он хранится в subscriptions.qr_file_id вместе с ключом, для которого нарисован (qr_key).
+Пока marzban_key не сменился, повторный показ — без рендера и без загрузки.
+"""
+import asyncio
+import io
+import logging
+from typing import Optional
+
+import segno
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..core.models import Subscription
+from ..core.repository import save_qr_file_id
+from .sender import send_photo
+
+logger = logging.getLogger(__name__)
+
+QR_CAPTION = "📷 QR-код ключа: отсканируйте его в приложении на другом устройстве."
+
+def render_qr(data: str) -> bytes:
+    """PNG с QR-кодом (чистый Python, вызывать через asyncio.to_thread)"""
+    buffer = io.BytesIO()
+    segno.make(data, error="m").save(buffer, kind="png", scale=8, border=2)
+    return buffer.getvalue()
+
+def cached_file_id(sub: Subscription) -> Optional[str]:
+    return sub.qr_file_id if sub.qr_file_id and sub.qr_key == sub.marzban_key else None
+
+async def send_key_qr(bot: Bot, session: AsyncSession, chat_id: int, sub: Subscription):
+    """Шлет QR ключа подписки; новый file_id сохраняет в подписку"""
+    key = sub.marzban_key
+    if not key:
+        return
+
+    file_id = cached_file_id(sub)
+    if file_id:
+        try:
+            await send_photo(bot, chat_id, file_id, caption=QR_CAPTION)
+            return
+        except TelegramBadRequest as e:
+            # file_id чужого бота или удален Telegram — рисуем заново
+            logger.warning(f"Cached QR for subscription {sub.id} rejected: {e}")
+
+    png = await asyncio.to_thread(render_qr, key)
+    message = await send_photo(bot, chat_id, BufferedInputFile(png, filename="key.png"), caption=QR_CAPTION)
+    if message is not None and message.photo:
+        await save_qr_file_id(session, sub.id, key, message.photo[-1].file_id)
+        await session.commit()
@@ -0,0 +1,164 @@
+import asyncio
+import itertools
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import Bot, types
+from aiogram.exceptions import TelegramRetryAfter
+
+from ..core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты: чем меньше число, тем раньше уходит сообщение
+INTERACTIVE = 0
+BULK = 10
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Сколько секунд ждать до следующего токена (0 — можно отправлять)"""
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def is_idle(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+class SendScheduler:
+    """
+    Общая очередь исходящих сообщений.
+    Темп ограничен глобальным и per-chat token bucket. RetryAfter от Telegram ставит
+    на паузу чат, а если чат перед этим молчал (значит, лимит не его, а всего бота) —
+    и глобальный бакет. Сообщение уходит повторно, но не больше TG_SEND_MAX_RETRIES раз.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(settings.TG_GLOBAL_RATE, settings.TG_GLOBAL_RATE)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self._seq = itertools.count()
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._workers = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.retry_after_count = 0
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._workers:
+            return
+        self._loop = loop
+        self._queue = asyncio.PriorityQueue()
+        self._workers = [loop.create_task(self._worker()) for _ in range(settings.TG_SEND_WORKERS)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._loop = None
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Дешевая чистка: выкидываем бакеты чатов, которые давно молчат
+            if len(self.chat_buckets) > 10000:
+                self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if not b.is_idle()}
+            bucket = TokenBucket(settings.TG_CHAT_RATE, settings.TG_CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def enqueue(self, chat_id: int, call: Callable[[], Awaitable[Any]], priority: int = INTERACTIVE) -> asyncio.Future:
+        """Ставит отправку в очередь и сразу возвращает future с результатом"""
+        self.start()
+        future = self._loop.create_future()
+        self._queue.put_nowait((priority, next(self._seq), chat_id, call, future, 0))
+        return future
+
+    async def submit(self, chat_id: int, call: Callable[[], Awaitable[Any]], priority: int = INTERACTIVE) -> Any:
+        return await self.enqueue(chat_id, call, priority)
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
+            priority, seq, chat_id, call, future, retries = item
+            if future.cancelled():
+                continue
+
+            # Пока ждем глобальный бакет, чат могли поставить на паузу — проверяем оба заново
+            chat_bucket = self._chat_bucket(chat_id)
+            while True:
+                wait = chat_bucket.delay()
+                if wait > 0:
+                    break
+                global_wait = self.global_bucket.delay()
+                if global_wait <= 0:
+                    break
+                await asyncio.sleep(global_wait)
+            if wait > 0:
+                # Чат еще на паузе — возвращаем в очередь позже, не блокируя остальных
+                self._loop.call_later(wait, self._queue.put_nowait, item)
+                continue
+
+            chat_was_idle = chat_bucket.is_idle()
+            self.global_bucket.consume()
+            chat_bucket.consume()
+            try:
+                result = await call()
+            except TelegramRetryAfter as e:
+                self.retry_after_count += 1
+                chat_bucket.pause(e.retry_after)
+                if chat_was_idle:
+                    self.global_bucket.pause(e.retry_after)
+                if retries >= settings.TG_SEND_MAX_RETRIES:
+                    logger.error(f"RetryAfter {e.retry_after}s for chat {chat_id}, giving up after {retries} retries")
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                scope = "bot" if chat_was_idle else "chat"
+                logger.warning(f"RetryAfter {e.retry_after}s for chat {chat_id} ({scope} limit), requeue")
+                self._queue.put_nowait((priority, seq, chat_id, call, future, retries + 1))
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+
+send_scheduler = SendScheduler()
+
+# --- ОБЕРТКИ ---
+
+async def answer(message: types.Message, text: str, priority: int = INTERACTIVE, **kwargs):
+    return await send_scheduler.submit(message.chat.id, lambda: message.answer(text, **kwargs), priority)
+
+async def send_message(bot: Bot, chat_id: int, text: str, priority: int = INTERACTIVE, **kwargs):
+    return await send_scheduler.submit(chat_id, lambda: bot.send_message(chat_id=chat_id, text=text, **kwargs), priority)
+
+async def send_photo(bot: Bot, chat_id: int, photo: Any, priority: int = INTERACTIVE, **kwargs):
+    return await send_scheduler.submit(chat_id, lambda: bot.send_photo(chat_id=chat_id, photo=photo, **kwargs), priority)
@@ -0,0 +1,158 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from ..core.config import settings
+from ..core.db import AsyncSessionLocal, dialect_insert
+from ..core.models import FSMRecord
+
+logger = logging.getLogger(__name__)
+
+# (state, data)
+Entry = Tuple[Optional[str], Dict[str, Any]]
+
+
+class SQLAlchemyStorage(BaseStorage):
+    """
+    FSM-хранилище в БД приложения вместо MemoryStorage.
+    Перед таблицей стоит небольшой LRU, изменения пишутся пачками раз в FSM_FLUSH_INTERVAL,
+    брошенные состояния удаляются по FSM_STATE_TTL_HOURS.
+    shared (по умолчанию BOT_REPLICAS > 1): процессов несколько — чтение всегда из БД,
+    запись сразу (write-through), иначе апдейт может попасть на реплику со старым состоянием.
+    """
+
+    def __init__(self, session_factory: async_sessionmaker = AsyncSessionLocal, shared: Optional[bool] = None):
+        self.session_factory = session_factory
+        self.shared = settings.BOT_REPLICAS > 1 if shared is None else shared
+        # key -> (loaded_at, entry)
+        self._cache: "OrderedDict[str, Tuple[float, Entry]]" = OrderedDict()
+        self._dirty: Dict[str, Tuple[Entry, datetime]] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self._last_purge = 0.0
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part or "") for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+        ))
+
+    def _cutoff(self) -> datetime:
+        return datetime.utcnow() - timedelta(hours=settings.FSM_STATE_TTL_HOURS)
+
+    def _remember(self, k: str, entry: Entry):
+        self._cache[k] = (time.monotonic(), entry)
+        self._cache.move_to_end(k)
+        while len(self._cache) > settings.FSM_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    async def _load(self, k: str) -> Entry:
+        if k in self._dirty:
+            return self._dirty[k][0]
+        cached = self._cache.get(k)
+        # Короткий TTL кэша; при нескольких репликах кэшу не верим вовсе
+        if cached and not self.shared and time.monotonic() - cached[0] < settings.FSM_CACHE_TTL:
+            self._cache.move_to_end(k)
+            return cached[1]
+
+        async with self.session_factory() as session:
+            row = await session.get(FSMRecord, k)
+        if row and row.updated_at and row.updated_at >= self._cutoff():
+            entry = (row.state, json.loads(row.data) if row.data else {})
+        else:
+            entry = (None, {})
+        self._remember(k, entry)
+        return entry
+
+    async def _write(self, k: str, entry: Entry):
+        self._remember(k, entry)
+        self._dirty[k] = (entry, datetime.utcnow())
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.get_running_loop().create_task(self._flush_loop())
+        if self.shared:
+            # Write-through: неудачная запись останется в _dirty, ее повторит фоновый flush
+            await self.flush()
+
+    # --- BaseStorage ---
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = self._key(key)
+        _, data = await self._load(k)
+        await self._write(k, (state.state if isinstance(state, State) else state, data))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(self._key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        k = self._key(key)
+        state, _ = await self._load(k)
+        await self._write(k, (state, dict(data)))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._load(self._key(key)))[1])
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+
+    # --- ЗАПИСЬ ПАЧКАМИ ---
+
+    def _upsert(self, session: AsyncSession, rows):
+        stmt = dialect_insert(session)(FSMRecord).values(rows)
+        return stmt.on_conflict_do_update(
+            index_elements=[FSMRecord.key],
+            set_={"state": stmt.excluded.state, "data": stmt.excluded.data, "updated_at": stmt.excluded.updated_at},
+        )
+
+    async def flush(self):
+        batch, self._dirty = self._dirty, {}
+        if not batch:
+            return
+
+        rows, cleared = [], []
+        for k, ((state, data), updated_at) in batch.items():
+            if state is None and not data:
+                cleared.append(k)
+            else:
+                rows.append({"key": k, "state": state, "data": json.dumps(data, ensure_ascii=False), "updated_at": updated_at})
+
+        try:
+            async with self.session_factory() as session:
+                if rows:
+                    await session.execute(self._upsert(session, rows))
+                if cleared:
+                    await session.execute(delete(FSMRecord).where(FSMRecord.key.in_(cleared)))
+                await session.commit()
+        except Exception as e:
+            logger.error(f"FSM flush failed, will retry: {e}")
+            # Возвращаем пачку, не затирая более свежие изменения
+            for k, value in batch.items():
+                self._dirty.setdefault(k, value)
+
+    async def purge_expired(self):
+        cutoff = self._cutoff()
+        async with self.session_factory() as session:
+            await session.execute(delete(FSMRecord).where(FSMRecord.updated_at < cutoff))
+            await session.commit()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(settings.FSM_FLUSH_INTERVAL)
+            await self.flush()
+            if time.monotonic() - self._last_purge > 3600:
+                self._last_purge = time.monotonic()
+                try:
+                    await self.purge_expired()
+                except Exception as e:
+                    logger.error(f"FSM purge failed: {e}")
@@ -0,0 +1,31 @@
+INSTRUCTION_TEXT = (
+    "<b>🚀 Настройка подключения:</b>\n\n"
+    "1. Скачай приложение:\n"
+    "📱 <b>Android:</b> <a href='https://play.google.com/store/apps/details?id=com.v2ray.ang'>v2rayNG (Google Play)</a>\n"
+    "🍏 <b>iOS:</b> <a href='https://apps.apple.com/us/app/v2box-v2ray-client/id6446814690'>V2Box (AppStore)</a>\n"
+    "💻 <b>PC (Windows):</b> <a href='https://github.com/hiddify/hiddify-next/releases/latest/download/Hiddify-Windows-Setup-x64.exe'>Скачать Hiddify</a>\n\n"
+    "2. Скопируй ключ (начинается с <code>vless://</code>).\n"
+    "3. Вставь ключ в приложение и нажми подключиться."
+)
+
+WELCOME_TEXT = (
+    "Привет, <b>{name}</b>! 👋\n\n"
+    "Я бот для выдачи скоростного доступа в сеть.\n"
+    "Youtube 4K, Instagram, Игры — без ограничений скорости.\n\n"
+    "🔐 Трафик шифруется. Логи не ведутся.\n"
+    "Жми <b>«⚡️ Купить доступ»</b>, чтобы начать."
+)
+
+# Понятные юзеру тексты для ошибок Marzban, когда продолжать нет смысла
+MARZBAN_ERROR_TEXT = {
+    "circuit_open": "⚠️ Сервер временно недоступен. Попробуйте через пару минут.",
+    "deadline": "⏳ Сервер отвечает слишком долго. Попробуйте еще раз чуть позже.",
+    "timeout": "⏳ Сервер отвечает слишком долго. Попробуйте еще раз чуть позже.",
+}
+
+def key_message(title: str, sub_url: str, vless_key: str) -> str:
+    return (
+        f"{title}\n\n"
+        f"<b>Ваш ключ (ссылка):</b>\n{sub_url}\n\n"
+        f"<b>Ваш ключ (VLESS):</b>\n<code>{vless_key}</code>"
+    )
@@ -8,12 +8,56 @@ class Settings(BaseSettings):
     BOT_TOKEN: str = os.getenv("BOT_TOKEN", "")
     ADMIN_ID: int = int(os.getenv("ADMIN_ID", "0"))
     
+    # Режим получения апдейтов: polling (разработка) или webhook (несколько воркеров за балансировщиком)
+    BOT_MODE: str = os.getenv("BOT_MODE", "polling")
+    WEBHOOK_URL: str = os.getenv("WEBHOOK_URL", "")
+    WEBHOOK_PATH: str = os.getenv("WEBHOOK_PATH", "/webhook")
+    # Обязателен в режиме webhook: сверяется с заголовком X-Telegram-Bot-Api-Secret-Token
+    WEBHOOK_SECRET: str = os.getenv("WEBHOOK_SECRET", "")
+    # При нескольких репликах выключите, иначе остановка одной снимет вебхук у всех
+    WEBHOOK_DELETE_ON_SHUTDOWN: bool = os.getenv("WEBHOOK_DELETE_ON_SHUTDOWN", "true").lower() == "true"
+    
     DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./data/bot.db")
+    # SQLite: ожидание блокировки (мс), mmap (байт), кэш страниц (КиБ)
+    SQLITE_BUSY_TIMEOUT_MS: int = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+    SQLITE_MMAP_SIZE: int = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+    SQLITE_CACHE_SIZE_KB: int = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+    # PostgreSQL: пул соединений
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "10"))
+    DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+    DB_POOL_PRE_PING: bool = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+    DB_POOL_RECYCLE: int = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+    DB_STATEMENT_CACHE_SIZE: int = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500"))
     
     MARZBAN_HOST: str = os.getenv("MARZBAN_HOST", "")
     MARZBAN_USERNAME: str = os.getenv("MARZBAN_USERNAME", "")
     MARZBAN_PASSWORD: str = os.getenv("MARZBAN_PASSWORD", "")
     
+    # Пул соединений к Marzban (один клиент на хост, keep-alive)
+    MARZBAN_POOL_LIMIT: int = int(os.getenv("MARZBAN_POOL_LIMIT", "100"))
+    MARZBAN_POOL_LIMIT_PER_HOST: int = int(os.getenv("MARZBAN_POOL_LIMIT_PER_HOST", "20"))
+    MARZBAN_KEEPALIVE_TIMEOUT: int = int(os.getenv("MARZBAN_KEEPALIVE_TIMEOUT", "60"))
+    # Кэш get_user: время жизни записи (сек) и максимум юзеров в памяти
+    MARZBAN_USER_CACHE_TTL: int = int(os.getenv("MARZBAN_USER_CACHE_TTL", "30"))
+    MARZBAN_USER_CACHE_SIZE: int = int(os.getenv("MARZBAN_USER_CACHE_SIZE", "1024"))
+    # Таймауты Marzban (сек): соединение, логин, чтение (GET) и запись (POST/PUT/DELETE)
+    MARZBAN_TIMEOUT_CONNECT: float = float(os.getenv("MARZBAN_TIMEOUT_CONNECT", "3"))
+    MARZBAN_TIMEOUT_AUTH: float = float(os.getenv("MARZBAN_TIMEOUT_AUTH", "5"))
+    MARZBAN_TIMEOUT_READ: float = float(os.getenv("MARZBAN_TIMEOUT_READ", "5"))
+    MARZBAN_TIMEOUT_WRITE: float = float(os.getenv("MARZBAN_TIMEOUT_WRITE", "10"))
+    # Бюджет на все вызовы Marzban в одном апдейте и минимальный остаток для нового вызова
+    UPDATE_DEADLINE: float = float(os.getenv("UPDATE_DEADLINE", "20"))
+    MARZBAN_MIN_CALL_BUDGET: float = float(os.getenv("MARZBAN_MIN_CALL_BUDGET", "1"))
+    # Повторы идемпотентных запросов: число попыток, базовая и максимальная задержка (сек)
+    MARZBAN_RETRY_ATTEMPTS: int = int(os.getenv("MARZBAN_RETRY_ATTEMPTS", "3"))
+    MARZBAN_RETRY_BASE_DELAY: float = float(os.getenv("MARZBAN_RETRY_BASE_DELAY", "0.2"))
+    MARZBAN_RETRY_MAX_DELAY: float = float(os.getenv("MARZBAN_RETRY_MAX_DELAY", "2"))
+    # Предохранитель: сколько сбоев подряд открывает его и через сколько секунд пробовать снова
+    MARZBAN_BREAKER_THRESHOLD: int = int(os.getenv("MARZBAN_BREAKER_THRESHOLD", "5"))
+    MARZBAN_BREAKER_RESET: float = float(os.getenv("MARZBAN_BREAKER_RESET", "30"))
+    # За сколько секунд до истечения JWT обновлять токен заранее
+    MARZBAN_TOKEN_REFRESH_MARGIN: int = int(os.getenv("MARZBAN_TOKEN_REFRESH_MARGIN", "60"))
+    
     # LYRA: Исправлено. Теперь по умолчанию берем первый попавшийся тег (авто-поиск)
     INBOUND_TAG: str = os.getenv("INBOUND_TAG", "") 
     
@@ -21,6 +65,62 @@ class Settings(BaseSettings):
     # Если в .env пусто, то и flow будет пустым ("none"), чтобы галочка ставилась.
     VLESS_FLOW: str = os.getenv("VLESS_FLOW", "")
     
+    # Почасовая проверка истекших подписок: размер пачки и параллельность запросов к Marzban
+    EXPIRY_BATCH_SIZE: int = int(os.getenv("EXPIRY_BATCH_SIZE", "200"))
+    EXPIRY_CONCURRENCY: int = int(os.getenv("EXPIRY_CONCURRENCY", "10"))
+    
+    # Лимиты исходящих сообщений Telegram (сообщений в секунду)
+    TG_GLOBAL_RATE: float = float(os.getenv("TG_GLOBAL_RATE", "30"))
+    TG_CHAT_RATE: float = float(os.getenv("TG_CHAT_RATE", "1"))
+    TG_CHAT_BURST: float = float(os.getenv("TG_CHAT_BURST", "3"))
+    TG_SEND_WORKERS: int = int(os.getenv("TG_SEND_WORKERS", "8"))
+    # Сколько раз повторять сообщение после RetryAfter, прежде чем вернуть ошибку
+    TG_SEND_MAX_RETRIES: int = int(os.getenv("TG_SEND_MAX_RETRIES", "5"))
+    
+    # Как часто перечитывать тарифы из БД (на случай правок из другого процесса), минут
+    PLAN_CATALOG_REFRESH_MINUTES: int = int(os.getenv("PLAN_CATALOG_REFRESH_MINUTES", "5"))
+    
+    # Сколько процессов обслуживают бота (воркеры uvicorn × контейнеры). Кэш FSM и запись пачкой
+    # рассчитаны на один процесс: при >1 состояние читается из БД и пишется сразу (write-through),
+    # иначе реплика с устаревшим кэшем не узнает о waiting_for_receipt и потеряет чек
+    BOT_REPLICAS: int = int(os.getenv("BOT_REPLICAS", os.getenv("WEB_CONCURRENCY", "1")))
+    
+    # FSM в БД: размер LRU, сколько секунд доверять кэшу, период записи пачкой (сек), TTL брошенных состояний
+    FSM_CACHE_SIZE: int = int(os.getenv("FSM_CACHE_SIZE", "5000"))
+    FSM_CACHE_TTL: float = float(os.getenv("FSM_CACHE_TTL", "30"))
+    FSM_FLUSH_INTERVAL: float = float(os.getenv("FSM_FLUSH_INTERVAL", "1"))
+    FSM_STATE_TTL_HOURS: int = int(os.getenv("FSM_STATE_TTL_HOURS", "24"))
+    
+    # Выдача доступа из outbox: параллельность, опрос (сек), таймаут захвата (сек), попытки и задержки (сек)
+    PROVISIONING_WORKERS: int = int(os.getenv("PROVISIONING_WORKERS", "4"))
+    PROVISIONING_POLL_INTERVAL: float = float(os.getenv("PROVISIONING_POLL_INTERVAL", "2"))
+    PROVISIONING_LOCK_TIMEOUT: int = int(os.getenv("PROVISIONING_LOCK_TIMEOUT", "120"))
+    PROVISIONING_MAX_ATTEMPTS: int = int(os.getenv("PROVISIONING_MAX_ATTEMPTS", "8"))
+    PROVISIONING_RETRY_BASE_DELAY: float = float(os.getenv("PROVISIONING_RETRY_BASE_DELAY", "5"))
+    PROVISIONING_RETRY_MAX_DELAY: float = float(os.getenv("PROVISIONING_RETRY_MAX_DELAY", "300"))
+    
+    # Сверка подписок с Marzban: период (мин), размер страницы /api/users, страниц за прогон на сервер
+    MARZBAN_SYNC_INTERVAL_MINUTES: int = int(os.getenv("MARZBAN_SYNC_INTERVAL_MINUTES", "15"))
+    MARZBAN_SYNC_PAGE_SIZE: int = int(os.getenv("MARZBAN_SYNC_PAGE_SIZE", "500"))
+    MARZBAN_SYNC_MAX_PAGES: int = int(os.getenv("MARZBAN_SYNC_MAX_PAGES", "20"))
+    
+    # Пакетное одобрение платежей из админки: параллельных запросов к Marzban
+    BULK_PAYMENT_CONCURRENCY: int = int(os.getenv("BULK_PAYMENT_CONCURRENCY", "10"))
+    
+    # Антифлуд входящих апдейтов на юзера: апдейтов в секунду и запас; HEAVY — профиль и покупка
+    # (ходят в БД и Marzban). Простаивающие корзины чистятся раз в THROTTLE_IDLE_TTL сек,
+    # "не так быстро" — не чаще раза в THROTTLE_NOTICE_INTERVAL сек. Rate 0 выключает лимит
+    THROTTLE_RATE: float = float(os.getenv("THROTTLE_RATE", "1"))
+    THROTTLE_BURST: float = float(os.getenv("THROTTLE_BURST", "5"))
+    THROTTLE_HEAVY_RATE: float = float(os.getenv("THROTTLE_HEAVY_RATE", "0.5"))
+    THROTTLE_HEAVY_BURST: float = float(os.getenv("THROTTLE_HEAVY_BURST", "3"))
+    THROTTLE_IDLE_TTL: float = float(os.getenv("THROTTLE_IDLE_TTL", "300"))
+    THROTTLE_NOTICE_INTERVAL: float = float(os.getenv("THROTTLE_NOTICE_INTERVAL", "10"))
+    
+    # Лидер среди реплик для фоновых задач: срок аренды и период продления (сек)
+    LEADER_LEASE_TTL: float = float(os.getenv("LEADER_LEASE_TTL", "30"))
+    LEADER_HEARTBEAT_INTERVAL: float = float(os.getenv("LEADER_HEARTBEAT_INTERVAL", "10"))
+    
     PAYMENT_INFO: str = os.getenv("PAYMENT_INFO", "Transfer RUB to Ozon Bank: +79990000000")
 
     class Config:
@@ -1,10 +1,106 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
+import logging
+import time
+from typing import Any, Dict
+
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase
 from .config import settings
+from .metrics import DB_QUERY_LATENCY
+
+logger = logging.getLogger(__name__)
+
+def engine_options(url: str) -> Dict[str, Any]:
+    """Профиль движка по DATABASE_URL: SQLite и PostgreSQL настраиваются по-разному"""
+    if url.startswith("sqlite"):
+        # Таймаут драйвера (сек) совпадает с busy_timeout, чтобы не падать раньше SQLite
+        return {"connect_args": {"timeout": settings.SQLITE_BUSY_TIMEOUT_MS / 1000}}
+
+    options: Dict[str, Any] = {
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+    }
+    if "asyncpg" in url:
+        options["connect_args"] = {"prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE}
+    return options
+
+def sqlite_pragmas() -> Dict[str, Any]:
+    return {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": settings.SQLITE_BUSY_TIMEOUT_MS,
+        "mmap_size": settings.SQLITE_MMAP_SIZE,
+        # Отрицательное значение — размер в КиБ
+        "cache_size": -settings.SQLITE_CACHE_SIZE_KB,
+    }
+
+def build_engine(url: str) -> AsyncEngine:
+    engine = create_async_engine(url, echo=False, **engine_options(url))
+
+    if engine.dialect.name == "sqlite":
+        @event.listens_for(engine.sync_engine, "connect")
+        def _apply_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in sqlite_pragmas().items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            cursor.close()
 
-engine = create_async_engine(settings.DATABASE_URL, echo=False)
+    instrument_engine(engine)
+    return engine
+
+def instrument_engine(engine: AsyncEngine):
+    """Время каждого SQL-запроса в db_query_duration_seconds (метка — SELECT/INSERT/...)"""
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        DB_QUERY_LATENCY.observe(statement.lstrip().split(None, 1)[0].upper(), value=time.perf_counter() - started)
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def _error(exception_context):
+        # Упавший запрос не доходит до after_cursor_execute — не оставляем мусор в стеке
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_started"):
+            conn.info["query_started"].pop()
+
+async def log_engine_settings(engine: AsyncEngine):
+    """Пишет в лог фактические настройки БД (PRAGMA читаются из живого соединения)"""
+    if engine.dialect.name == "sqlite":
+        async with engine.connect() as conn:
+            effective = {}
+            for name in sqlite_pragmas():
+                effective[name] = (await conn.exec_driver_sql(f"PRAGMA {name}")).scalar()
+        logger.info(f"DB engine: sqlite {effective}")
+    else:
+        pool = engine.pool
+        logger.info(
+            f"DB engine: {engine.dialect.name} pool={type(pool).__name__} "
+            f"size={settings.DB_POOL_SIZE} overflow={settings.DB_MAX_OVERFLOW} "
+            f"pre_ping={settings.DB_POOL_PRE_PING} recycle={settings.DB_POOL_RECYCLE}s "
+            f"statement_cache={settings.DB_STATEMENT_CACHE_SIZE}"
+        )
+
+engine = build_engine(settings.DATABASE_URL)
 AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
+# INSERT с ON CONFLICT есть только в диалектных insert()
+_DIALECT_INSERTS = {"sqlite": sqlite_insert, "postgresql": pg_insert}
+
+def dialect_insert(session: AsyncSession):
+    """insert() диалекта сессии для upsert'ов. Бот работает только на SQLite и PostgreSQL"""
+    name = session.bind.dialect.name
+    try:
+        return _DIALECT_INSERTS[name]
+    except KeyError:
+        raise ValueError(f"Upsert is not supported for dialect '{name}'") from None
+
 class Base(DeclarativeBase):
     pass
 
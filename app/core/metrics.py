@@ -0,0 +1,136 @@
+"""
+Минимальные метрики в текстовом формате Prometheus (без внешних зависимостей).
+Запись — пара операций над dict, поэтому метрики можно держать включенными в проде.
+"""
+import bisect
+import functools
+import time
+from typing import Dict, List, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name, self.documentation, self.labelnames = name, documentation, tuple(labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, *labels, value: float):
+        self.values[labels] = value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name, self.documentation, self.labelnames = name, documentation, tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [счетчики по бакетам (+Inf последним), сумма]
+        self.values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, *labels, value: float):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {total}")
+            lines.append(f"{self.name}_count{label_str} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def track_job(name: str):
+    """Декоратор для задач планировщика: длительность и время последнего прогона"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                JOB_DURATION.set(name, value=time.perf_counter() - started)
+                JOB_LAST_RUN.set(name, value=time.time())
+        return wrapper
+    return decorator
+
+
+registry = Registry()
+
+HANDLER_LATENCY = registry.register(Histogram(
+    "bot_handler_duration_seconds", "Время обработки апдейта хендлером aiogram", ["handler"]
+))
+DB_QUERIES_PER_UPDATE = registry.register(Histogram(
+    "bot_db_queries_per_update", "Число запросов к БД на один апдейт", ["handler"], buckets=(0, 1, 2, 3, 5, 8, 13, 21)
+))
+MARZBAN_LATENCY = registry.register(Histogram(
+    "marzban_request_duration_seconds", "Время запроса к Marzban", ["operation", "status"]
+))
+DB_QUERY_LATENCY = registry.register(Histogram(
+    "db_query_duration_seconds", "Время SQL-запроса", ["statement"], buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+))
+JOB_DURATION = registry.register(Gauge(
+    "scheduler_job_last_duration_seconds", "Длительность последнего прогона фоновой задачи", ["job"]
+))
+JOB_LAST_RUN = registry.register(Gauge(
+    "scheduler_job_last_run_timestamp", "Время последнего прогона фоновой задачи (unix)", ["job"]
+))
+PENDING_TRANSACTIONS = registry.register(Gauge(
+    "transactions_pending", "Транзакции в статусе pending"
+))
+EXPIRY_BACKLOG = registry.register(Gauge(
+    "subscriptions_expiry_backlog", "Активные подписки с истекшим сроком, ждущие отключения"
+))
+OUTBOX_PENDING = registry.register(Gauge(
+    "provisioning_outbox_pending", "Заявки на выдачу доступа в очереди"
+))
+THROTTLED_UPDATES = registry.register(Counter(
+    "bot_throttled_updates_total", "Апдейты, отброшенные антифлудом", ["handler"]
+))
+SCHEDULER_LEADER = registry.register(Gauge(
+    "scheduler_is_leader", "1, если эта реплика держит аренду и выполняет фоновые задачи"
+))
@@ -0,0 +1,151 @@
+"""
+Простые версионные миграции схемы.
+
+create_all создает только отсутствующие таблицы, поэтому индексы и колонки
+для уже развернутых баз добавляются здесь. Каждая миграция — функция от
+синхронного Connection, применяется один раз и записывается в schema_migrations.
+
+Запуск вручную: python -m app.core.migrations
+"""
+import asyncio
+import logging
+from datetime import date, datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, cast, func, inspect, literal, select, update
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .db import Base
+from . import models, search
+
+logger = logging.getLogger(__name__)
+
+schema_migrations = Table(
+    "schema_migrations",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime, default=datetime.utcnow),
+)
+
+# --- ПОМОЩНИКИ ---
+
+def _create_indexes(conn: Connection, model, *names: str):
+    for index in model.__table__.indexes:
+        if index.name in names:
+            index.create(conn, checkfirst=True)
+
+def _add_column(conn: Connection, table: str, column: str, ddl: str):
+    existing = {c["name"] for c in inspect(conn).get_columns(table)}
+    if column not in existing:
+        conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+# --- МИГРАЦИИ ---
+
+def _m001_hot_path_indexes(conn: Connection):
+    _create_indexes(conn, models.User, "ix_users_username")
+    _create_indexes(conn, models.Transaction, "ix_transactions_user_id_status")
+    _create_indexes(conn, models.Subscription, "ix_subscriptions_user_id_id", "ix_subscriptions_status_expire_date")
+
+def _m002_server_sharding(conn: Connection):
+    _add_column(conn, "servers", "weight", "INTEGER DEFAULT 1")
+    _add_column(conn, "servers", "is_active", "BOOLEAN DEFAULT TRUE")
+    _add_column(conn, "subscriptions", "server_id", "INTEGER")
+
+def _as_date(value) -> date:
+    # SQLite отдает date() строкой, PostgreSQL — датой
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+def _m003_stats_rollups(conn: Connection):
+    """Заполняет сводки статистики по уже накопленным данным (дальше они ведутся инкрементально)"""
+    tx = models.Transaction.__table__
+    tx_day = func.date(tx.c.created_at)
+    tx_plan = func.coalesce(tx.c.plan_id, 0)
+    revenue = conn.execute(
+        select(tx_day, tx_plan, tx.c.status, func.count(), func.coalesce(func.sum(tx.c.amount), 0))
+        .where(tx.c.created_at.is_not(None), tx.c.status.is_not(None))
+        .group_by(tx_day, tx_plan, tx.c.status)
+    ).all()
+    if revenue:
+        conn.execute(models.DailyRevenue.__table__.insert(), [
+            {"day": _as_date(day), "plan_id": plan_id, "status": status, "count": count, "amount": amount}
+            for day, plan_id, status, count, amount in revenue
+        ])
+
+    activity = {}
+    for table, field, condition in (
+        (models.User.__table__, "new_users", None),
+        (models.ProvisioningJob.__table__, "activations", models.ProvisioningJob.__table__.c.status == "done"),
+    ):
+        day = func.date(table.c.created_at)
+        query = select(day, func.count()).where(table.c.created_at.is_not(None)).group_by(day)
+        if condition is not None:
+            query = query.where(condition)
+        for value, count in conn.execute(query):
+            row = activity.setdefault(_as_date(value), {"new_users": 0, "activations": 0, "expirations": 0})
+            row[field] = count
+    if activity:
+        conn.execute(models.DailyActivity.__table__.insert(), [{"day": day, **counts} for day, counts in activity.items()])
+
+def _m004_admin_search(conn: Connection):
+    search.install(conn)
+
+def _m005_key_qr_cache(conn: Connection):
+    _add_column(conn, "subscriptions", "qr_file_id", "VARCHAR")
+    _add_column(conn, "subscriptions", "qr_key", "VARCHAR")
+
+def _m006_subscription_marzban_username(conn: Connection):
+    """Логин Marzban на подписке; старые строки — по нику из users, как его выдавал бот"""
+    _add_column(conn, "subscriptions", "marzban_username", "VARCHAR")
+    subs, users = models.Subscription.__table__, models.User.__table__
+    nickname = select(users.c.username).where(users.c.telegram_id == subs.c.user_id).scalar_subquery()
+    conn.execute(
+        update(subs)
+        .where(subs.c.marzban_username.is_(None))
+        .values(marzban_username=func.coalesce(nickname, literal("user_") + cast(subs.c.user_id, String)))
+    )
+
+def _m007_pending_transactions_index(conn: Connection):
+    _create_indexes(conn, models.Transaction, "ix_transactions_pending")
+
+def _m008_active_by_plan_index(conn: Connection):
+    _create_indexes(conn, models.Subscription, "ix_subscriptions_status_plan_id")
+
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "hot_path_indexes", _m001_hot_path_indexes),
+    (2, "server_sharding", _m002_server_sharding),
+    (3, "stats_rollups", _m003_stats_rollups),
+    (4, "admin_search", _m004_admin_search),
+    (5, "key_qr_cache", _m005_key_qr_cache),
+    (6, "subscription_marzban_username", _m006_subscription_marzban_username),
+    (7, "pending_transactions_index", _m007_pending_transactions_index),
+    (8, "active_by_plan_index", _m008_active_by_plan_index),
+]
+
+def _upgrade(conn: Connection) -> List[int]:
+    Base.metadata.create_all(conn)
+    schema_migrations.create(conn, checkfirst=True)
+    applied = set(conn.execute(select(schema_migrations.c.version)).scalars())
+
+    done = []
+    for version, name, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        logger.info(f"Applying migration {version:03d}_{name}")
+        migrate(conn)
+        conn.execute(schema_migrations.insert().values(version=version, name=name, applied_at=datetime.utcnow()))
+        done.append(version)
+    return done
+
+async def run_migrations(engine: AsyncEngine) -> List[int]:
+    """Создает недостающие таблицы и применяет новые миграции в одной транзакции"""
+    async with engine.begin() as conn:
+        return await conn.run_sync(_upgrade)
+
+if __name__ == "__main__":
+    from .db import engine
+
+    logging.basicConfig(level=logging.INFO)
+    applied = asyncio.run(run_migrations(engine))
+    print(f"✅ Миграции применены: {applied or 'нечего применять'}")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, BigInteger, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, BigInteger, Date, DateTime, ForeignKey, Index, Text, text
 from datetime import datetime
 # LYRA: Импортируем Base из db.py, чтобы main.py видел эти модели при создании таблиц
 from .db import Base 
@@ -11,13 +11,16 @@ class Server(Base):
     host_url = Column(String, nullable=False) 
     username = Column(String, nullable=True)
     password = Column(String, nullable=True)
+    # Доля новых юзеров при распределении по нагрузке
+    weight = Column(Integer, default=1)
+    is_active = Column(Boolean, default=True)
 
 class User(Base):
     __tablename__ = "users"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     telegram_id = Column(BigInteger, unique=True, nullable=False)
-    username = Column(String, nullable=True)
+    username = Column(String, nullable=True, index=True)
     full_name = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     
@@ -45,12 +48,109 @@ class Transaction(Base):
     status = Column(String, default="pending")  
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        Index("ix_transactions_user_id_status", "user_id", "status"),
+        # Частичный индекс только по ожидающим: счетчик для /metrics не зависит от размера истории
+        Index(
+            "ix_transactions_pending", "status",
+            sqlite_where=text("status = 'pending'"),
+            postgresql_where=text("status = 'pending'"),
+        ),
+    )
+
 class Subscription(Base):
     __tablename__ = "subscriptions"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(BigInteger, nullable=False)
     plan_id = Column(Integer, nullable=True) 
+    # Сервер Marzban, где живет юзер (NULL — основной MARZBAN_HOST из настроек)
+    server_id = Column(Integer, nullable=True)
     marzban_key = Column(String, nullable=True)
+    # Логин в Marzban (никнейм на момент выдачи или user_ID) — ник в Telegram может смениться
+    marzban_username = Column(String, nullable=True)
     status = Column(String, default="active") 
     expire_date = Column(DateTime, nullable=True)
+    # QR-код ключа, уже загруженный в Telegram, и ключ, для которого он нарисован
+    qr_file_id = Column(String, nullable=True)
+    qr_key = Column(String, nullable=True)
+
+    __table_args__ = (
+        # Профиль и покупка: последняя подписка юзера
+        Index("ix_subscriptions_user_id_id", "user_id", "id"),
+        # Почасовая проверка истекших
+        Index("ix_subscriptions_status_expire_date", "status", "expire_date"),
+        # Активные по тарифам на странице статистики: покрывающий, таблицу не читаем
+        Index("ix_subscriptions_status_plan_id", "status", "plan_id"),
+    )
+
+class FSMRecord(Base):
+    """Состояние FSM aiogram (см. app/bot/storage.py)"""
+    __tablename__ = "fsm_states"
+
+    key = Column(String, primary_key=True)
+    state = Column(String, nullable=True)
+    data = Column(Text, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class ProvisioningJob(Base):
+    """Outbox покупок: пишется в одной транзакции с Transaction, выдачу делает воркер"""
+    __tablename__ = "provisioning_outbox"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    transaction_id = Column(Integer, nullable=True, unique=True)
+    user_id = Column(BigInteger, nullable=False)
+    username = Column(String, nullable=False)
+    plan_id = Column(Integer, nullable=False)
+    status = Column(String, default="pending")  # pending / processing / done / failed / cancelled
+    attempts = Column(Integer, default=0)
+    # Фиксируются при первой попытке, чтобы повтор не добавил дни второй раз
+    server_id = Column(Integer, nullable=True)
+    expire_ts = Column(BigInteger, nullable=True)
+    last_error = Column(String, nullable=True)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    locked_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_provisioning_outbox_status_next_attempt_at", "status", "next_attempt_at"),
+    )
+
+class SyncCheckpoint(Base):
+    """Позиция постраничной сверки с Marzban (см. app/services/sync_service.py)"""
+    __tablename__ = "sync_checkpoints"
+
+    key = Column(String, primary_key=True)
+    next_offset = Column(Integer, default=0)
+    last_full_sync_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class LeaderLease(Base):
+    """Аренда лидерства между репликами (см. app/services/leader.py)"""
+    __tablename__ = "leader_leases"
+
+    name = Column(String, primary_key=True)
+    holder = Column(String, nullable=True)
+    # Fencing token: растет при каждом захвате, старый лидер с прежним токеном уже не продлит аренду
+    token = Column(BigInteger, nullable=False, default=0)
+    expires_at = Column(DateTime, nullable=False)
+    renewed_at = Column(DateTime, nullable=True)
+
+class DailyRevenue(Base):
+    """Суточная сводка платежей по тарифу и статусу (см. app/services/stats_service.py)"""
+    __tablename__ = "stats_daily_revenue"
+
+    day = Column(Date, primary_key=True)
+    plan_id = Column(Integer, primary_key=True)  # 0 — платеж без тарифа
+    status = Column(String, primary_key=True)
+    count = Column(Integer, default=0)
+    amount = Column(BigInteger, default=0)
+
+class DailyActivity(Base):
+    """Суточные счетчики: новые юзеры, выдачи доступа, истекшие подписки"""
+    __tablename__ = "stats_daily_activity"
+
+    day = Column(Date, primary_key=True)
+    new_users = Column(Integer, default=0)
+    activations = Column(Integer, default=0)
+    expirations = Column(Integer, default=0)
@@ -0,0 +1,129 @@
+"""
+Общие запросы к БД: юзер, последняя подписка, платеж с тарифом — одним оператором,
+регистрация и продление — upsert'ом (INSERT … ON CONFLICT) вместо SELECT + INSERT/UPDATE.
+Функции не коммитят: транзакцией управляет вызывающий код.
+"""
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from .db import dialect_insert
+from .models import Plan, ProvisioningJob, Subscription, Transaction, User
+
+class UserOverview(NamedTuple):
+    user: Optional[User]
+    subscription: Optional[Subscription]
+    plan: Optional[Plan]
+
+class TransactionBundle(NamedTuple):
+    transaction: Transaction
+    plan: Optional[Plan]
+    user: Optional[User]
+    subscription: Optional[Subscription]
+    job: Optional[ProvisioningJob]
+
+def _latest_subscription_id(user_id):
+    # max(id) по индексу ix_subscriptions_user_id_id; user_id — значение или колонка внешнего запроса.
+    # Алиас, чтобы подзапрос не скоррелировал с subscriptions самого запроса
+    latest = aliased(Subscription)
+    return select(func.max(latest.id)).where(latest.user_id == user_id).scalar_subquery()
+
+def marzban_login(user_id: int, user: Optional[User], sub: Optional[Subscription]) -> str:
+    """Логин юзера в Marzban: сохраненный в подписке (ник мог смениться), у старых строк — ник или user_ID"""
+    if sub is not None and sub.marzban_username:
+        return sub.marzban_username
+    return (user.username if user is not None else None) or f"user_{user_id}"
+
+# Запросы отдельно от выполнения: их планы проверяет tests/test_schema.py
+
+def latest_subscription_query(user_id: int):
+    return select(Subscription).where(Subscription.id == _latest_subscription_id(user_id))
+
+def user_overview_query(telegram_id: int):
+    return (
+        select(User, Subscription, Plan)
+        .select_from(User)
+        .outerjoin(Subscription, Subscription.id == _latest_subscription_id(User.telegram_id))
+        .outerjoin(Plan, Plan.id == Subscription.plan_id)
+        .where(User.telegram_id == telegram_id)
+    )
+
+def transactions_query(transaction_ids: Sequence[int]):
+    return (
+        select(Transaction, Plan, User, Subscription, ProvisioningJob)
+        .select_from(Transaction)
+        .outerjoin(Plan, Plan.id == Transaction.plan_id)
+        .outerjoin(User, User.telegram_id == Transaction.user_id)
+        .outerjoin(Subscription, Subscription.id == _latest_subscription_id(Transaction.user_id))
+        .outerjoin(ProvisioningJob, ProvisioningJob.transaction_id == Transaction.id)
+        .where(Transaction.id.in_(transaction_ids))
+    )
+
+async def latest_subscription(session: AsyncSession, user_id: int) -> Optional[Subscription]:
+    result = await session.execute(latest_subscription_query(user_id))
+    return result.scalar_one_or_none()
+
+async def get_user_overview(session: AsyncSession, telegram_id: int) -> UserOverview:
+    """Юзер, его последняя подписка и ее тариф — одним запросом"""
+    row = (await session.execute(user_overview_query(telegram_id))).first()
+    return UserOverview(*row) if row else UserOverview(None, None, None)
+
+async def load_transactions(session: AsyncSession, transaction_ids: Sequence[int]) -> List[TransactionBundle]:
+    """Платежи с тарифом, юзером, последней подпиской и заявкой outbox — одним запросом"""
+    rows = (await session.execute(transactions_query(transaction_ids))).all()
+    return [TransactionBundle(*row) for row in rows]
+
+async def load_transaction(session: AsyncSession, transaction_id: int) -> Optional[TransactionBundle]:
+    bundles = await load_transactions(session, [transaction_id])
+    return bundles[0] if bundles else None
+
+async def register_user(session: AsyncSession, telegram_id: int, username: Optional[str], full_name: Optional[str]) -> bool:
+    """Заводит юзера, если его еще нет. True — строка действительно вставлена"""
+    res = await session.execute(
+        dialect_insert(session)(User.__table__)
+        .values(telegram_id=telegram_id, username=username, full_name=full_name, created_at=datetime.utcnow())
+        .on_conflict_do_nothing(index_elements=["telegram_id"])
+    )
+    return res.rowcount == 1
+
+async def renew_subscription(session: AsyncSession, user_id: int, **fields) -> Subscription:
+    """
+    Обновляет последнюю подписку юзера или создает первую — одним INSERT … ON CONFLICT(id).
+    Ключ конфликта — id последней подписки; у нового юзера его нет, и строка вставляется.
+    Меняются только переданные поля (server_id, plan_id, marzban_key, status, expire_date).
+    """
+    latest_id = _latest_subscription_id(user_id)
+    if session.bind.dialect.name == "postgresql":
+        # В PostgreSQL NULL в serial-колонку не подставит следующий id — берем его из последовательности
+        latest_id = func.coalesce(latest_id, func.nextval(func.pg_get_serial_sequence("subscriptions", "id")))
+    stmt = dialect_insert(session)(Subscription).values(id=latest_id, user_id=user_id, **fields)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Subscription.id],
+        set_={name: stmt.excluded[name] for name in fields},
+    ).returning(Subscription)
+    result = await session.execute(stmt, execution_options={"populate_existing": True})
+    return result.scalar_one()
+
+async def save_qr_file_id(session: AsyncSession, subscription_id: int, key: str, file_id: str):
+    """Запоминает file_id QR-кода, если ключ подписки не сменился, пока картинка уходила"""
+    await session.execute(
+        update(Subscription)
+        .where(Subscription.id == subscription_id, Subscription.marzban_key == key)
+        .values(qr_file_id=file_id, qr_key=key)
+        .execution_options(synchronize_session=False)
+    )
+
+async def queue_depths(session: AsyncSession, now: datetime) -> Dict[str, int]:
+    """Ожидающие платежи, непогашенные истекшие подписки и очередь outbox — одним запросом"""
+    row = (await session.execute(select(
+        select(func.count()).select_from(Transaction)
+        .where(Transaction.status == "pending").scalar_subquery().label("pending_transactions"),
+        select(func.count()).select_from(Subscription)
+        .where(Subscription.status == "active", Subscription.expire_date < now).scalar_subquery().label("expiry_backlog"),
+        select(func.count()).select_from(ProvisioningJob)
+        .where(ProvisioningJob.status.in_(("pending", "processing"))).scalar_subquery().label("outbox_pending"),
+    ))).one()
+    return dict(row._mapping)
@@ -0,0 +1,118 @@
+"""
+Поиск для админки без LIKE-сканов.
+
+SQLite: внешняя FTS5-таблица users_fts над users (username, full_name, telegram_id),
+ее держат в актуальном состоянии триггеры на INSERT/UPDATE/DELETE. Поиск — по префиксам слов.
+PostgreSQL: GIN-индексы pg_trgm, которые подхватывает обычный ILIKE '%…%'.
+Платежи ищутся по юзеру через тот же поиск и индекс transactions(user_id, status).
+"""
+import logging
+import re
+import sqlite3
+from typing import Optional
+
+from sqlalchemy import Integer, column, false, or_, select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql.elements import ColumnElement
+
+from .models import Transaction, User
+
+logger = logging.getLogger(__name__)
+
+def _probe_fts5() -> bool:
+    # aiosqlite работает поверх того же sqlite3, проверяем сборку один раз
+    try:
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE VIRTUAL TABLE probe USING fts5(x)")
+        conn.close()
+        return True
+    except sqlite3.Error:
+        return False
+
+FTS5_AVAILABLE = _probe_fts5()
+
+_SQLITE_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts "
+    "USING fts5(username, full_name, telegram_id, content='users', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN "
+    "INSERT INTO users_fts(rowid, username, full_name, telegram_id) "
+    "VALUES (new.id, new.username, new.full_name, new.telegram_id); END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, username, full_name, telegram_id) "
+    "VALUES ('delete', old.id, old.username, old.full_name, old.telegram_id); END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF username, full_name, telegram_id ON users BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, username, full_name, telegram_id) "
+    "VALUES ('delete', old.id, old.username, old.full_name, old.telegram_id); "
+    "INSERT INTO users_fts(rowid, username, full_name, telegram_id) "
+    "VALUES (new.id, new.username, new.full_name, new.telegram_id); END",
+    # Индексируем то, что уже лежит в users
+    "INSERT INTO users_fts(users_fts) VALUES ('rebuild')",
+)
+
+_POSTGRES_DDL = (
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm ON users USING gin (username gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_full_name_trgm ON users USING gin (full_name gin_trgm_ops)",
+)
+
+def install(conn: Connection):
+    """Создает поисковые индексы под текущую СУБД (вызывается из миграции)"""
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        if not FTS5_AVAILABLE:
+            logger.warning("SQLite собран без FTS5 — поиск в админке останется на LIKE")
+            return
+        for statement in _SQLITE_DDL:
+            conn.exec_driver_sql(statement)
+    elif dialect == "postgresql":
+        try:
+            with conn.begin_nested():
+                conn.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        except Exception as e:
+            logger.warning(f"pg_trgm недоступен ({e}) — поиск в админке останется без индекса")
+            return
+        for statement in _POSTGRES_DDL:
+            conn.exec_driver_sql(statement)
+
+def fts_query(term: str) -> Optional[str]:
+    """'ivan_pet' -> '"ivan"* "pet"*': каждое слово как префикс, все слова обязательны"""
+    tokens = re.findall(r"[^\W_]+", term.lower())
+    if not tokens:
+        return None
+    return " ".join(f'"{token}"*' for token in tokens)
+
+def _like(term: str) -> str:
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+def _as_id(term: str) -> Optional[int]:
+    return int(term) if term.isdigit() and len(term) <= 18 else None
+
+def user_filter(dialect: str, term: str) -> ColumnElement:
+    """WHERE для users: ник, имя или Telegram ID"""
+    term = term.strip()
+    clauses = []
+    number = _as_id(term)
+    if number is not None:
+        clauses.append(User.telegram_id == number)
+
+    if dialect == "sqlite" and FTS5_AVAILABLE:
+        query = fts_query(term)
+        if query:
+            matches = (
+                text("SELECT rowid FROM users_fts WHERE users_fts MATCH :fts_query")
+                .bindparams(fts_query=query)
+                .columns(column("rowid", Integer))
+            )
+            clauses.append(User.id.in_(matches))
+    else:
+        pattern = _like(term)
+        clauses += [User.username.ilike(pattern, escape="\\"), User.full_name.ilike(pattern, escape="\\")]
+    return or_(false(), *clauses)
+
+def transaction_filter(dialect: str, term: str) -> ColumnElement:
+    """WHERE для transactions: номер платежа или любой признак юзера"""
+    clauses = [Transaction.user_id.in_(select(User.telegram_id).where(user_filter(dialect, term)))]
+    number = _as_id(term.strip())
+    if number is not None:
+        clauses += [Transaction.id == number, Transaction.user_id == number]
+    return or_(*clauses)
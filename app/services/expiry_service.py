@@ -0,0 +1,99 @@
+import asyncio
+import logging
+from datetime import datetime
+from functools import partial
+from typing import Dict, Optional
+
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from ..core.config import settings
+from ..core.db import AsyncSessionLocal
+from ..core.models import Subscription, User
+from .server_pool import ServerPool
+from .stats_service import record_activity
+from ..bot.sender import send_scheduler, BULK
+
+logger = logging.getLogger(__name__)
+
+EXPIRED_TEXT = "⚠️ Ваша подписка VPN истекла. Пожалуйста, продлите её в меню."
+
+async def _disable_in_marzban(servers: ServerPool, sub_id: int, username: str, server_id: Optional[int], semaphore: asyncio.Semaphore):
+    async with semaphore:
+        res = await servers.api_for(server_id).modify_user(username, {"status": "disabled"})
+    # Юзера уже нет в Marzban — отключать нечего
+    return sub_id, bool(res) or getattr(res, "error", None) == "not_found"
+
+def expired_batch_query(now: datetime, last_id: int, limit: int):
+    """Следующая пачка истекших подписок после last_id с логином Marzban"""
+    return (
+        select(
+            Subscription.id, Subscription.user_id, Subscription.server_id,
+            func.coalesce(Subscription.marzban_username, User.username).label("username")
+        )
+        .outerjoin(User, User.telegram_id == Subscription.user_id)
+        .where(
+            Subscription.status == "active",
+            Subscription.expire_date < now,
+            Subscription.id > last_id
+        )
+        .order_by(Subscription.id)
+        .limit(limit)
+    )
+
+async def sweep_expired_subscriptions(servers: ServerPool, bot=None, session_factory: async_sessionmaker = AsyncSessionLocal) -> Dict[int, str]:
+    """
+    Отключает истекшие подписки пачками.
+    Каждая пачка коммитится отдельно, поэтому падение посередине не теряет прогресс.
+    Подписки, которые Marzban не отключил, остаются active и попадут в следующий прогон.
+    Возвращает исход по каждой подписке: {sub_id: "expired" | "failed"}.
+    """
+    await servers.ensure_loaded()
+    now = datetime.utcnow()
+    semaphore = asyncio.Semaphore(settings.EXPIRY_CONCURRENCY)
+    outcomes: Dict[int, str] = {}
+    last_id = 0
+
+    while True:
+        # Keyset-пагинация по id: проваленные строки остаются active, но повторно в этом прогоне не берутся
+        async with session_factory() as session:
+            result = await session.execute(expired_batch_query(now, last_id, settings.EXPIRY_BATCH_SIZE))
+            chunk = result.all()
+            if not chunk:
+                break
+            last_id = chunk[-1].id
+
+            results = await asyncio.gather(*(
+                _disable_in_marzban(servers, row.id, row.username or f"user_{row.user_id}", row.server_id, semaphore)
+                for row in chunk
+            ))
+            expired_ids = [sub_id for sub_id, ok in results if ok]
+
+            if expired_ids:
+                res = await session.execute(
+                    update(Subscription)
+                    .where(Subscription.id.in_(expired_ids), Subscription.status == "active")
+                    .values(status="expired")
+                )
+                await record_activity(session, "expirations", res.rowcount)
+                await session.commit()
+
+        user_ids = {row.id: row.user_id for row in chunk}
+        for sub_id, ok in results:
+            outcomes[sub_id] = "expired" if ok else "failed"
+            if not ok:
+                logger.warning(f"Subscription {sub_id}: Marzban disable failed, will retry next run")
+
+        # Уведомляем только после коммита пачки. Фоновый приоритет: ответы юзерам уходят раньше
+        if bot is not None:
+            notifications = [
+                send_scheduler.enqueue(user_ids[sub_id], partial(bot.send_message, chat_id=user_ids[sub_id], text=EXPIRED_TEXT), BULK)
+                for sub_id in expired_ids
+            ]
+            for sub_id, res in zip(expired_ids, await asyncio.gather(*notifications, return_exceptions=True)):
+                if isinstance(res, Exception):
+                    logger.error(f"Failed to notify user {user_ids[sub_id]}: {res}")
+
+    failed = sum(1 for o in outcomes.values() if o == "failed")
+    logger.info(f"Expiry sweep done: {len(outcomes) - failed} expired, {failed} failed")
+    return outcomes
@@ -0,0 +1,146 @@
+import asyncio
+import functools
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import or_, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from ..core.config import settings
+from ..core.db import AsyncSessionLocal, dialect_insert
+from ..core.metrics import SCHEDULER_LEADER
+from ..core.models import LeaderLease
+
+logger = logging.getLogger(__name__)
+
+_leases = LeaderLease.__table__
+
+
+class LeaderElector:
+    """
+    Лидер среди реплик через аренду в таблице leader_leases.
+    Лидер продлевает аренду раз в heartbeat; если он умер, аренда истекает через ttl
+    и ее забирает другая реплика с новым fencing token. Продление проверяет токен,
+    поэтому зависший старый лидер, у которого аренду уже забрали, не продлит ее и не запустит задачу.
+    Часы реплик должны быть синхронизированы (NTP) с запасом много меньше ttl.
+    """
+
+    def __init__(
+        self,
+        name: str = "scheduler",
+        session_factory: async_sessionmaker = AsyncSessionLocal,
+        ttl: float = settings.LEADER_LEASE_TTL,
+        heartbeat: float = settings.LEADER_HEARTBEAT_INTERVAL,
+    ):
+        self.name = name
+        self.session_factory = session_factory
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.token: Optional[int] = None
+        self._valid_until = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def is_leader(self) -> bool:
+        # Локальный срок считается от начала запроса, поэтому заканчивается не позже аренды в БД
+        return self.token is not None and time.monotonic() < self._valid_until
+
+    def _lost(self):
+        if self.token is not None:
+            logger.warning(f"Leader lease '{self.name}' lost (token {self.token})")
+        self.token = None
+        self._valid_until = 0.0
+
+    async def _acquire(self, session: AsyncSession, now: datetime) -> Optional[int]:
+        insert = dialect_insert(session)
+        # Строка аренды создается один раз, сразу истекшей
+        await session.execute(
+            insert(_leases).values(name=self.name, token=0, expires_at=now).on_conflict_do_nothing(index_elements=["name"])
+        )
+        res = await session.execute(
+            update(_leases)
+            .where(_leases.c.name == self.name, or_(_leases.c.expires_at <= now, _leases.c.holder == self.holder))
+            .values(holder=self.holder, token=_leases.c.token + 1, expires_at=now + timedelta(seconds=self.ttl), renewed_at=now)
+            .returning(_leases.c.token)
+        )
+        return res.scalar_one_or_none()
+
+    async def _renew(self, session: AsyncSession, now: datetime) -> bool:
+        # Токен не менялся — значит, никто другой лидером не был, даже если срок успел выйти
+        res = await session.execute(
+            update(_leases)
+            .where(_leases.c.name == self.name, _leases.c.holder == self.holder, _leases.c.token == self.token)
+            .values(expires_at=now + timedelta(seconds=self.ttl), renewed_at=now)
+        )
+        return res.rowcount == 1
+
+    async def heartbeat(self) -> bool:
+        """Продлевает аренду или пытается ее захватить. Возвращает, лидер ли эта реплика"""
+        started = time.monotonic()
+        now = datetime.utcnow()
+        async with self.session_factory() as session:
+            if self.token is not None:
+                if not await self._renew(session, now):
+                    self._lost()
+            else:
+                token = await self._acquire(session, now)
+                if token is not None:
+                    self.token = token
+                    logger.info(f"Leader lease '{self.name}' acquired by {self.holder} (token {token})")
+            await session.commit()
+        if self.token is not None:
+            self._valid_until = started + self.ttl
+        SCHEDULER_LEADER.set(value=int(self.is_leader))
+        return self.is_leader
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                # БД недоступна: лидерство истечет само по локальному сроку
+                logger.error(f"Leader heartbeat failed: {e}")
+                SCHEDULER_LEADER.set(value=int(self.is_leader))
+            await asyncio.sleep(self.heartbeat_interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.token is None:
+            return
+        # Отдаем аренду сразу, чтобы другая реплика не ждала ttl
+        try:
+            async with self.session_factory() as session:
+                await session.execute(
+                    update(_leases)
+                    .where(_leases.c.name == self.name, _leases.c.holder == self.holder, _leases.c.token == self.token)
+                    .values(holder=None, expires_at=datetime.utcnow())
+                )
+                await session.commit()
+        except Exception as e:
+            logger.error(f"Failed to release leader lease: {e}")
+        self._lost()
+        SCHEDULER_LEADER.set(value=0)
+
+    def only(self, func):
+        """Декоратор задачи планировщика: выполняется только на лидере, токен сверяется с БД перед запуском"""
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not self.is_leader or not await self.heartbeat():
+                logger.debug(f"Skip {func.__name__}: not the leader")
+                return None
+            return await func(*args, **kwargs)
+        return wrapper
+
+leader = LeaderElector()
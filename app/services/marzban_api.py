@@ -1,71 +1,290 @@
 import aiohttp
+import asyncio
+import base64
+import json
 import logging
-from typing import Optional, Dict, Any, List, Union
+import random
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, List, Tuple, Union
 from ..core.config import settings
+from ..core.metrics import MARZBAN_LATENCY
 
 logger = logging.getLogger(__name__)
 
+def _decode_jwt_exp(token: Optional[str]) -> Optional[int]:
+    """Достает exp из JWT без проверки подписи (нам нужен только срок жизни)"""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return None
+
+# --- ДЕДЛАЙН АПДЕЙТА ---
+# Общий бюджет времени на все вызовы Marzban внутри одного апдейта Telegram
+_deadline: ContextVar[Optional[float]] = ContextVar("marzban_deadline", default=None)
+
+@contextmanager
+def deadline_scope(seconds: float):
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+def remaining_budget() -> Optional[float]:
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+@dataclass
+class MarzbanResult:
+    """
+    Результат вызова Marzban. Ложен при ошибке, тип ошибки в error:
+    not_found, auth, http_error, network, timeout, circuit_open, deadline.
+    """
+    ok: bool
+    data: Optional[Dict[str, Any]] = None
+    status: Optional[int] = None
+    error: Optional[str] = None
+
+    def __bool__(self) -> bool:
+        return self.ok
+
+class CircuitBreaker:
+    """
+    Предохранитель на хост: после N подряд сбоев панель считается лежащей (open)
+    и вызовы сразу отклоняются. Через reset_timeout пропускается одна пробная
+    заявка (half_open): успех закрывает предохранитель, сбой снова открывает.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_started = 0.0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+        # Одна проба за раз; зависшая проба не блокирует предохранитель дольше reset_timeout
+        if self.state == "half_open" and time.monotonic() - self._probe_started >= self.reset_timeout:
+            self._probe_started = time.monotonic()
+            return True
+        return False
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self._probe_started = 0.0
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_started = 0.0
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning(f"Circuit opened after {self.failures} failures")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"state": self.state, "failures": self.failures}
+
 class MarzbanAPI:
-    def __init__(self):
-        self.host = settings.MARZBAN_HOST.rstrip('/')
-        self.username = settings.MARZBAN_USERNAME
-        self.password = settings.MARZBAN_PASSWORD
+    def __init__(self, host: Optional[str] = None, username: Optional[str] = None, password: Optional[str] = None):
+        self.host = (host or settings.MARZBAN_HOST).rstrip('/')
+        self.username = username or settings.MARZBAN_USERNAME
+        self.password = password or settings.MARZBAN_PASSWORD
         self.token: Optional[str] = None
-        self.cached_tag: Optional[str] = None 
+        self.token_exp: Optional[int] = None
+        self._token_lock = asyncio.Lock()
+        self.cached_tag: Optional[str] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        # LRU+TTL кэш get_user: username -> (expires_at, data)
+        self._user_cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._user_inflight: Dict[str, asyncio.Future] = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.breaker = CircuitBreaker(settings.MARZBAN_BREAKER_THRESHOLD, settings.MARZBAN_BREAKER_RESET)
+
+    def set_credentials(self, username: Optional[str], password: Optional[str]):
+        """Новые логин/пароль из ServerAdmin: старый токен и счет сбоев (401) больше не в силе"""
+        username = username or settings.MARZBAN_USERNAME
+        password = password or settings.MARZBAN_PASSWORD
+        if (username, password) == (self.username, self.password):
+            return
+        self.username, self.password = username, password
+        self.token = None
+        self.token_exp = None
+        self.breaker = CircuitBreaker(settings.MARZBAN_BREAKER_THRESHOLD, settings.MARZBAN_BREAKER_RESET)
+
+    async def open(self) -> aiohttp.ClientSession:
+        """Одна долгоживущая сессия с keep-alive пулом соединений на весь процесс"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=settings.MARZBAN_POOL_LIMIT,
+                limit_per_host=settings.MARZBAN_POOL_LIMIT_PER_HOST,
+                keepalive_timeout=settings.MARZBAN_KEEPALIVE_TIMEOUT,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
 
     async def _get_token(self) -> Optional[str]:
         url = f"{self.host}/api/admin/token"
         data = {"username": self.username, "password": self.password}
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, data=data, ssl=False) as response:
-                    if response.status == 200:
-                        self.token = (await response.json()).get("access_token")
-                        return self.token
-                    logger.error(f"Auth failed: {response.status}")
-                    return None
+            session = await self.open()
+            async with session.post(url, data=data, ssl=False, timeout=self._timeout(settings.MARZBAN_TIMEOUT_AUTH)) as response:
+                if response.status == 200:
+                    self.token = (await response.json()).get("access_token")
+                    self.token_exp = _decode_jwt_exp(self.token)
+                    return self.token
+                logger.error(f"Auth failed: {response.status}")
+                return None
         except Exception as e:
             logger.error(f"Auth error: {e}")
             return None
 
-    async def _get_headers(self):
+    def _token_is_fresh(self) -> bool:
         if not self.token:
-            await self._get_token()
+            return False
+        # Если exp не удалось прочитать — доверяем токену до первого 401
+        if self.token_exp is None:
+            return True
+        return self.token_exp - settings.MARZBAN_TOKEN_REFRESH_MARGIN > time.time()
+
+    async def _ensure_token(self) -> Optional[str]:
+        """Обновляет токен заранее, до истечения exp. Параллельные вызовы ждут один общий логин"""
+        if self._token_is_fresh():
+            return self.token
+        async with self._token_lock:
+            # Пока ждали блокировку, токен мог обновить другой вызов
+            if not self._token_is_fresh():
+                await self._get_token()
+        return self.token
+
+    async def _get_headers(self):
+        await self._ensure_token()
         return {"Authorization": f"Bearer {self.token}"}
 
+    def _timeout(self, read_timeout: float) -> aiohttp.ClientTimeout:
+        """Таймауты операции, урезанные до остатка дедлайна апдейта"""
+        remaining = remaining_budget()
+        return aiohttp.ClientTimeout(
+            total=None if remaining is None else max(remaining, 0.01),
+            connect=settings.MARZBAN_TIMEOUT_CONNECT,
+            sock_read=read_timeout,
+        )
+
+    async def _request(self, method: str, path: str, **kwargs) -> Tuple[int, Any]:
+        """Единая точка запросов: при 401 сбрасывает токен и повторяет запрос ровно один раз"""
+        url = f"{self.host}{path}"
+        session = await self.open()
+        for attempt in range(2):
+            headers = await self._get_headers()
+            used_token = self.token
+            async with getattr(session, method.lower())(url, headers=headers, ssl=False, **kwargs) as response:
+                if response.status == 401 and attempt == 0:
+                    if self.token == used_token:
+                        self.token = None
+                        self.token_exp = None
+                    continue
+                try:
+                    body = await response.json(content_type=None)
+                except Exception:
+                    body = await response.text()
+                return response.status, body
+        return 401, None
+
+    async def _call(self, method: str, path: str, retry: bool = False, operation: str = "other", **kwargs) -> MarzbanResult:
+        """
+        Политика вызова: предохранитель + повтор с экспоненциальной задержкой и джиттером.
+        retry=True только для идемпотентных запросов (GET/PUT/DELETE).
+        operation — метка для метрики marzban_request_duration_seconds.
+        """
+        attempts = settings.MARZBAN_RETRY_ATTEMPTS if retry else 1
+        result = MarzbanResult(False, error="circuit_open")
+        read_timeout = settings.MARZBAN_TIMEOUT_READ if method == "GET" else settings.MARZBAN_TIMEOUT_WRITE
+        for attempt in range(attempts):
+            # Не начинаем вызов, который заведомо не успеет до дедлайна апдейта
+            remaining = remaining_budget()
+            if remaining is not None and remaining < settings.MARZBAN_MIN_CALL_BUDGET:
+                return MarzbanResult(False, error="deadline")
+            if not self.breaker.allow():
+                return result
+            started = time.monotonic()
+            try:
+                status, body = await self._request(method, path, timeout=self._timeout(read_timeout), **kwargs)
+            except asyncio.TimeoutError:
+                MARZBAN_LATENCY.observe(operation, "timeout", value=time.monotonic() - started)
+                self.breaker.record_failure()
+                result = MarzbanResult(False, error="timeout")
+                logger.warning(f"Marzban {method} {path} timed out ({attempt + 1}/{attempts})")
+            except Exception as e:
+                MARZBAN_LATENCY.observe(operation, "network", value=time.monotonic() - started)
+                self.breaker.record_failure()
+                result = MarzbanResult(False, error="network")
+                logger.warning(f"Marzban {method} {path} failed ({attempt + 1}/{attempts}): {e!r}")
+            else:
+                MARZBAN_LATENCY.observe(operation, str(status), value=time.monotonic() - started)
+                if status >= 500:
+                    self.breaker.record_failure()
+                    result = MarzbanResult(False, status=status, error="http_error")
+                else:
+                    # 4xx — ответ живой панели, на предохранитель не влияет
+                    self.breaker.record_success()
+                    if status == 200:
+                        return MarzbanResult(True, data=body, status=status)
+                    error = {404: "not_found", 401: "auth", 403: "auth"}.get(status, "http_error")
+                    return MarzbanResult(False, data=body if isinstance(body, dict) else None, status=status, error=error)
+
+            if attempt + 1 < attempts:
+                delay = min(settings.MARZBAN_RETRY_MAX_DELAY, settings.MARZBAN_RETRY_BASE_DELAY * 2 ** attempt)
+                await asyncio.sleep(random.uniform(0, delay))
+        return result
+
     async def _get_real_inbound_tag(self) -> str:
         """Находит реальный тег VLESS"""
         if self.cached_tag:
             return self.cached_tag
 
-        url = f"{self.host}/api/inbounds"
-        headers = await self._get_headers()
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers, ssl=False) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        inbounds_list = []
-                        if isinstance(data, dict):
-                            if "inbounds" in data and isinstance(data["inbounds"], list):
-                                inbounds_list = data["inbounds"]
-                            elif "data" in data and isinstance(data["data"], list):
-                                inbounds_list = data["data"]
-                            else:
-                                for key, val in data.items():
-                                    if "vless" in str(key).lower() and isinstance(val, list) and len(val) > 0:
-                                        self.cached_tag = val[0].get("tag")
-                                        return self.cached_tag
-                        elif isinstance(data, list):
-                            inbounds_list = data
-
-                        for inbound in inbounds_list:
-                            if isinstance(inbound, dict) and inbound.get("protocol") == "vless":
-                                self.cached_tag = inbound.get("tag")
+            res = await self._call("GET", "/api/inbounds", retry=True, operation="get_inbounds")
+            data = res.data
+            if res.ok:
+                inbounds_list = []
+                if isinstance(data, dict):
+                    if "inbounds" in data and isinstance(data["inbounds"], list):
+                        inbounds_list = data["inbounds"]
+                    elif "data" in data and isinstance(data["data"], list):
+                        inbounds_list = data["data"]
+                    else:
+                        for key, val in data.items():
+                            if "vless" in str(key).lower() and isinstance(val, list) and len(val) > 0:
+                                self.cached_tag = val[0].get("tag")
                                 return self.cached_tag
+                elif isinstance(data, list):
+                    inbounds_list = data
+
+                for inbound in inbounds_list:
+                    if isinstance(inbound, dict) and inbound.get("protocol") == "vless":
+                        self.cached_tag = inbound.get("tag")
+                        return self.cached_tag
         except Exception:
             pass
-        
+
         return settings.INBOUND_TAG
 
     def _fix_subscription_url(self, data: Dict[str, Any]) -> Dict[str, Any]:
@@ -75,12 +294,25 @@ class MarzbanAPI:
             data["subscription_url"] = f"{self.host}{sub_url}"
         return data
 
-    async def create_user(self, username: str, data_limit: int, expire: int) -> Optional[Dict[str, Any]]:
-        url = f"{self.host}/api/user"
-        headers = await self._get_headers()
-        
+    # --- КЭШ ЮЗЕРОВ ---
+
+    def _cache_put(self, username: str, data: Dict[str, Any]):
+        self._user_cache[username] = (time.monotonic() + settings.MARZBAN_USER_CACHE_TTL, data)
+        self._user_cache.move_to_end(username)
+        while len(self._user_cache) > settings.MARZBAN_USER_CACHE_SIZE:
+            self._user_cache.popitem(last=False)
+
+    def invalidate_user(self, username: str):
+        self._user_cache.pop(username, None)
+        # Результат запроса, начатого до инвалидации, в кэш уже не попадет
+        self._user_inflight.pop(username, None)
+
+    def cache_stats(self) -> Dict[str, int]:
+        return {"hits": self.cache_hits, "misses": self.cache_misses, "size": len(self._user_cache)}
+
+    async def create_user(self, username: str, data_limit: int, expire: int) -> MarzbanResult:
         target_tag = await self._get_real_inbound_tag()
-        
+
         # LYRA FIX: РАЗДЕЛЕНИЕ СУЩНОСТЕЙ
         # 1. Proxies отвечает за настройки протокола (flow)
         proxies = {
@@ -98,59 +330,108 @@ class MarzbanAPI:
         payload = {
             "username": username,
             "proxies": proxies,
-            "inbounds": inbounds, 
+            "inbounds": inbounds,
             "data_limit": data_limit * 1024 * 1024 * 1024,
             "expire": expire,
             "status": "active"
         }
 
         logger.info(f"📤 SENDING CORRECT PAYLOAD: {payload}")
-        
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=payload, headers=headers, ssl=False) as response:
-                    if response.status == 200:
-                        return self._fix_subscription_url(await response.json())
-                    elif response.status == 409:
-                        modify_url = f"{self.host}/api/user/{username}"
-                        async with session.put(modify_url, json=payload, headers=headers, ssl=False) as mod_resp:
-                            if mod_resp.status == 200:
-                                return self._fix_subscription_url(await mod_resp.json())
-                            return None
-                    elif response.status == 401:
-                        self.token = None
-                        return await self.create_user(username, data_limit, expire)
-                    else:
-                        logger.error(f"Error {response.status}: {await response.text()}")
-                        return None
-        except Exception as e:
-            logger.error(f"Connection error: {e}")
-            return None
+
+        self.invalidate_user(username)
+        res = await self._call("POST", "/api/user", operation="create_user", json=payload)
+        if res.status == 409:
+            res = await self._call("PUT", f"/api/user/{username}", retry=True, operation="create_user", json=payload)
+        if res.ok:
+            res.data = self._fix_subscription_url(res.data)
+            self._cache_put(username, res.data)
+        else:
+            logger.error(f"Create user {username} failed: {res.error} {res.status} {res.data}")
+        return res
 
     # Остальные методы (get/modify/delete)
-    async def get_user(self, username: str) -> Optional[Dict[str, Any]]:
-        url = f"{self.host}/api/user/{username}"
-        headers = await self._get_headers()
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers, ssl=False) as res:
-                    return self._fix_subscription_url(await res.json()) if res.status == 200 else None
-        except: return None
-
-    async def modify_user(self, username: str, payload: Dict[str, Any]) -> bool:
-        url = f"{self.host}/api/user/{username}"
-        headers = await self._get_headers()
+    async def get_user(self, username: str, fresh: bool = False) -> MarzbanResult:
+        """
+        fresh=True — мимо кэша и общего запроса: для чтения перед записью (продление считает
+        новый expire от текущего, а кэш не знает о правках из панели и других реплик)
+        """
+        if fresh:
+            self.cache_misses += 1
+            res = await self._call("GET", f"/api/user/{username}", retry=True, operation="get_user")
+            if res.ok:
+                res.data = self._fix_subscription_url(res.data)
+                self._cache_put(username, res.data)
+            return res
+
+        cached = self._user_cache.get(username)
+        if cached and cached[0] > time.monotonic():
+            self._user_cache.move_to_end(username)
+            self.cache_hits += 1
+            return MarzbanResult(True, data=cached[1], status=200)
+
+        # Параллельные запросы одного юзера ждут один общий поход в Marzban
+        inflight = self._user_inflight.get(username)
+        if inflight is not None:
+            self.cache_hits += 1
+            return await asyncio.shield(inflight)
+
+        self.cache_misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._user_inflight[username] = future
+        res = MarzbanResult(False, error="network")
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.put(url, json=payload, headers=headers, ssl=False) as res:
-                    return res.status == 200
-        except: return False
-
-    async def delete_user(self, username: str) -> bool:
-        url = f"{self.host}/api/user/{username}"
-        headers = await self._get_headers()
+            res = await self._call("GET", f"/api/user/{username}", retry=True, operation="get_user")
+            if res.ok:
+                res.data = self._fix_subscription_url(res.data)
+                if self._user_inflight.get(username) is future:
+                    self._cache_put(username, res.data)
+        finally:
+            if self._user_inflight.get(username) is future:
+                del self._user_inflight[username]
+            future.set_result(res)
+        return res
+
+    async def list_users(self, offset: int = 0, limit: int = 500) -> MarzbanResult:
+        """Страница /api/users в порядке создания: новые юзеры дописываются в конец и не сдвигают страницы"""
+        res = await self._call(
+            "GET", "/api/users", retry=True, operation="list_users",
+            params={"offset": offset, "limit": limit, "sort": "created_at"}
+        )
+        if res.ok and isinstance(res.data, dict):
+            for user in res.data.get("users") or []:
+                self._fix_subscription_url(user)
+        return res
+
+    async def modify_user(self, username: str, payload: Dict[str, Any]) -> MarzbanResult:
+        self.invalidate_user(username)
+        res = await self._call("PUT", f"/api/user/{username}", retry=True, operation="modify_user", json=payload)
+        if res.ok and isinstance(res.data, dict):
+            res.data = self._fix_subscription_url(res.data)
+            self._cache_put(username, res.data)
+        return res
+
+    async def delete_user(self, username: str) -> MarzbanResult:
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.delete(url, headers=headers, ssl=False) as res:
-                    return res.status == 200
-        except: return False
+            return await self._call("DELETE", f"/api/user/{username}", retry=True, operation="delete_user")
+        finally:
+            self.invalidate_user(username)
+
+
+# --- РЕЕСТР КЛИЕНТОВ ---
+# Один клиент на хост Marzban: токен, тег инбаунда и пул соединений общие для всего процесса
+_clients: Dict[str, MarzbanAPI] = {}
+
+def get_marzban_api(host: Optional[str] = None, username: Optional[str] = None, password: Optional[str] = None) -> MarzbanAPI:
+    key = (host or settings.MARZBAN_HOST).rstrip('/')
+    client = _clients.get(key)
+    if client is None:
+        client = MarzbanAPI(host=key, username=username, password=password)
+        _clients[key] = client
+    elif username or password:
+        # Один клиент (и пул соединений) на хост; учетные данные берем актуальные
+        client.set_credentials(username, password)
+    return client
+
+async def close_marzban_clients():
+    for client in _clients.values():
+        await client.close()
@@ -1,15 +1,19 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from datetime import datetime
+from typing import Dict, Optional, Sequence, Tuple
+import asyncio
 import time
 import logging
 
-from ..core.models import User, Transaction, Subscription, Plan
+from ..core.models import Transaction, Plan
+from ..core.repository import get_user_overview, load_transactions, marzban_login, renew_subscription
 from ..core.config import settings
 from .marzban_api import MarzbanAPI
+from .server_pool import server_pool
+from .stats_service import record_transaction, set_transaction_status
 
 logger = logging.getLogger(__name__)
-api = MarzbanAPI()
 
 async def process_new_payment(session: AsyncSession, user_id: int, amount: int, receipt_file_id: str, plan_id: int):
     """
@@ -25,18 +29,27 @@ async def process_new_payment(session: AsyncSession, user_id: int, amount: int,
         created_at=datetime.utcnow()
     )
     session.add(transaction)
+    await session.flush()
+    await record_transaction(session, transaction, None, "pending")
     await session.commit()
     
-    # 2. Находим юзера в базе бота
-    user_query = await session.execute(select(User).where(User.telegram_id == user_id))
-    user = user_query.scalar_one()
+    # 2. Находим юзера и его последнюю подписку (одним запросом)
+    user, sub, _ = await get_user_overview(session, user_id)
+    if user is None:
+        return None, "Юзер не найден в базе"
 
     # 3. Выдаем доступ (пока на 24 часа, до проверки чека)
     # Если юзер уже есть - продлеваем ему на сутки, чтобы не отключался
     # Если нет - создаем
     
-    # Сначала проверим текущий статус в Marzban
-    marzban_user = await api.get_user(user.username)
+    # Сначала проверим текущий статус в Marzban (на сервере юзера)
+    await server_pool.ensure_loaded()
+    server_id, api = server_pool.api_for_subscription(sub)
+    username = marzban_login(user_id, user, sub)
+    res = await api.get_user(username, fresh=True)
+    if not res and res.error != "not_found":
+        return None, "Ошибка связи с Marzban"
+    marzban_user = res.data
     current_ts = int(time.time())
     temp_seconds = 24 * 60 * 60 # 24 часа
 
@@ -54,50 +67,32 @@ async def process_new_payment(session: AsyncSession, user_id: int, amount: int,
     # Создаем/Обновляем в Marzban
     # ВАЖНО: Тут лимит ставим 0 (безлимит) или какой-то стартовый,
     # но полноценный лимит выставим при одобрении
-    sub_data = await api.create_user(user.username, 0, new_expire)
+    sub_data = await api.create_user(username, 0, new_expire)
     
     if not sub_data:
         return None, "Ошибка связи с Marzban"
 
-    # Сохраняем подписку в БД бота
-    sub = Subscription(
-        user_id=user_id,
-        marzban_key=sub_data.get("subscription_url", ""),
+    # Сохраняем подписку в БД бота (продлеваем последнюю или создаем первую)
+    sub = await renew_subscription(
+        session, user_id,
+        marzban_username=username,
+        server_id=server_id,
+        plan_id=plan_id,
+        marzban_key=sub_data.data.get("subscription_url", ""),
         status="active",
         expire_date=datetime.fromtimestamp(new_expire)
     )
-    session.add(sub)
     await session.commit()
     
     return sub, None
 
-async def approve_payment(session: AsyncSession, transaction_id: int):
-    """
-    Админ нажал 'Одобрить'. Начисляем полный срок тарифа.
-    """
-    # 1. Ищем транзакцию и подтягиваем План
-    stmt = select(Transaction).where(Transaction.id == transaction_id)
-    result = await session.execute(stmt)
-    transaction = result.scalar_one_or_none()
-    
-    if not transaction:
-        return False, "Транзакция не найдена"
-
-    # Получаем план, чтобы узнать duration_days
-    plan_stmt = select(Plan).where(Plan.id == transaction.plan_id)
-    plan_res = await session.execute(plan_stmt)
-    plan = plan_res.scalar_one_or_none()
-
-    if not plan:
-        return False, "Тариф не найден в базе"
-
-    # 2. Ищем юзера
-    user_stmt = select(User).where(User.telegram_id == transaction.user_id)
-    user_res = await session.execute(user_stmt)
-    user = user_res.scalar_one()
-
-    # 3. --- ГЛАВНАЯ МАГИЯ: СУММИРОВАНИЕ ВРЕМЕНИ ---
-    marzban_user = await api.get_user(user.username)
+async def _extend_in_marzban(api: MarzbanAPI, username: str, plan: Plan) -> Tuple[Optional[int], Optional[str]]:
+    """Продлевает юзера на срок тарифа. Возвращает (новый expire, None) или (None, ошибка)"""
+    res = await api.get_user(username, fresh=True)
+    # Без ответа Marzban не знаем текущий срок — не рискуем обнулить оплаченные дни
+    if not res and res.error != "not_found":
+        return None, "Marzban недоступен, попробуйте позже"
+    marzban_user = res.data
     current_ts = int(time.time())
     
     # Переводим дни тарифа в секунды
@@ -116,12 +111,11 @@ async def approve_payment(session: AsyncSession, transaction_id: int):
         # Новый юзер
         final_expire = current_ts + add_seconds
 
-    # 4. Применяем изменения в Marzban
     # Также ставим правильный лимит ГБ из тарифа
     limit_gb = plan.limit_gb if plan.limit_gb > 0 else 0 # 0 = безлимит
     
     success = await api.modify_user(
-        user.username, 
+        username, 
         {
             "expire": final_expire,
             "data_limit": limit_gb * 1024 * 1024 * 1024 if limit_gb > 0 else 0,
@@ -130,22 +124,16 @@ async def approve_payment(session: AsyncSession, transaction_id: int):
     )
 
     if not success:
-        return False, "Не удалось обновить пользователя в Marzban"
+        return None, "Не удалось обновить пользователя в Marzban"
+    return final_expire, None
 
-    # 5. Обновляем статус транзакции и подписки в БД бота
-    transaction.status = "approved"
-    
-    # Обновим запись о подписке
-    sub_stmt = select(Subscription).where(Subscription.user_id == user.telegram_id)
-    sub_res = await session.execute(sub_stmt)
-    sub = sub_res.scalars().first()
-    
-    if sub:
-        sub.expire_date = datetime.fromtimestamp(final_expire)
-        sub.status = "active"
-    
-    await session.commit()
-    return True, "Успешно"
+async def approve_payment(session: AsyncSession, transaction_id: int):
+    """
+    Админ нажал 'Одобрить'. Начисляем полный срок тарифа.
+    Те же проверки, что у пакета: обработанный платеж или уже выданный outbox'ом второй раз не продлевается.
+    """
+    results = await approve_payments(session, [transaction_id])
+    return results[transaction_id]
 
 async def reject_payment(session: AsyncSession, transaction_id: int):
     stmt = select(Transaction).where(Transaction.id == transaction_id)
@@ -153,7 +141,7 @@ async def reject_payment(session: AsyncSession, transaction_id: int):
     transaction = result.scalar_one_or_none()
     
     if transaction:
-        transaction.status = "rejected"
+        await set_transaction_status(session, transaction, "rejected")
         await session.commit()
         
         # Опционально: можно отключать юзера в Marzban, если чек липовый
@@ -163,3 +151,75 @@ async def reject_payment(session: AsyncSession, transaction_id: int):
         
         return True, "Отклонено"
     return False, "Транзакция не найдена"
+
+# --- ПАКЕТНАЯ ОБРАБОТКА ---
+
+async def approve_payments(session: AsyncSession, transaction_ids: Sequence[int]) -> Dict[int, Tuple[bool, str]]:
+    """
+    Одобряет пачку платежей: Marzban обновляется параллельно (не больше BULK_PAYMENT_CONCURRENCY),
+    БД — одним коммитом. Платежи, которые уже выдал воркер outbox, просто помечаются approved.
+    Возвращает исход по каждому платежу: {tx_id: (ok, сообщение)}.
+    """
+    results: Dict[int, Tuple[bool, str]] = {tx_id: (False, "Транзакция не найдена") for tx_id in transaction_ids}
+    bundles = await load_transactions(session, transaction_ids)
+    await server_pool.ensure_loaded()
+    semaphore = asyncio.Semaphore(settings.BULK_PAYMENT_CONCURRENCY)
+
+    async def extend(items):
+        # Платежи одного юзера — последовательно, иначе оба продления прочитают один старый expire
+        _, api = server_pool.api_for_subscription(items[0].subscription)
+        done = []
+        async with semaphore:
+            for tx, plan, user, sub, _ in items:
+                final_expire, error = await _extend_in_marzban(api, marzban_login(user.telegram_id, user, sub), plan)
+                done.append((tx, sub, final_expire, error))
+        return done
+
+    confirm_only = []
+    by_user: Dict[int, list] = {}
+    for bundle in bundles:
+        tx, plan, user, _, job = bundle
+        if tx.status not in ("pending", "success"):
+            results[tx.id] = (False, f"Уже обработана ({tx.status})")
+        elif job is not None and job.status in ("pending", "processing"):
+            results[tx.id] = (False, "Доступ еще выдается автоматически, повторите позже")
+        elif job is not None and job.status == "done":
+            confirm_only.append(tx)
+        elif plan is None:
+            results[tx.id] = (False, "Тариф не найден в базе")
+        elif user is None:
+            results[tx.id] = (False, "Юзер не найден в базе")
+        else:
+            by_user.setdefault(user.telegram_id, []).append(bundle)
+
+    for tx in confirm_only:
+        ok = await set_transaction_status(session, tx, "approved", only_from=("pending", "success"))
+        results[tx.id] = (True, "Успешно") if ok else (False, f"Статус изменился ({tx.status})")
+
+    extended = await asyncio.gather(*(extend(items) for items in by_user.values()))
+    for tx, sub, final_expire, error in (item for done in extended for item in done):
+        if error:
+            results[tx.id] = (False, error)
+            continue
+        if not await set_transaction_status(session, tx, "approved", only_from=("pending", "success")):
+            results[tx.id] = (False, f"Статус изменился ({tx.status}), Marzban уже продлен")
+            continue
+        if sub:
+            sub.expire_date = datetime.fromtimestamp(final_expire)
+            sub.status = "active"
+        results[tx.id] = (True, "Успешно")
+
+    await session.commit()
+    return results
+
+async def reject_payments(session: AsyncSession, transaction_ids: Sequence[int]) -> Dict[int, Tuple[bool, str]]:
+    """Отклоняет пачку платежей одним коммитом. Незавершенную выдачу воркер outbox отменит сам"""
+    results: Dict[int, Tuple[bool, str]] = {tx_id: (False, "Транзакция не найдена") for tx_id in transaction_ids}
+    txs = (await session.execute(select(Transaction).where(Transaction.id.in_(transaction_ids)))).scalars().all()
+    for tx in txs:
+        if await set_transaction_status(session, tx, "rejected", only_from=("pending", "success")):
+            results[tx.id] = (True, "Отклонено")
+        else:
+            results[tx.id] = (False, f"Уже обработана ({tx.status})")
+    await session.commit()
+    return results
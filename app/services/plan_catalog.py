@@ -0,0 +1,53 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from aiogram.types import InlineKeyboardMarkup
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from ..core.db import AsyncSessionLocal
+from ..core.models import Plan
+from ..bot.keyboards import plans_keyboard
+
+logger = logging.getLogger(__name__)
+
+class PlanCatalog:
+    """
+    Тарифы в памяти процесса + готовая клавиатура магазина.
+    Тарифы меняются редко, поэтому магазин работает без запросов в БД.
+    Перезагрузка: при сохранении в админке и периодически из планировщика.
+    """
+
+    def __init__(self, session_factory: async_sessionmaker = AsyncSessionLocal):
+        self.session_factory = session_factory
+        self.plans: Dict[int, Plan] = {}
+        self.active_plans: List[Plan] = []
+        self.keyboard: Optional[InlineKeyboardMarkup] = None
+        self.version = 0
+        self._lock = asyncio.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self.version > 0
+
+    async def reload(self):
+        async with self._lock:
+            async with self.session_factory() as session:
+                result = await session.execute(select(Plan))
+                plans = list(result.scalars().all())
+            # Заменяем ссылки целиком, чтобы читатели не видели полуобновленный каталог
+            self.plans = {plan.id: plan for plan in plans}
+            self.active_plans = sorted((p for p in plans if p.is_active), key=lambda x: x.price)
+            self.keyboard = plans_keyboard(self.active_plans) if self.active_plans else None
+            self.version += 1
+        logger.info(f"Plan catalog v{self.version}: {len(self.active_plans)} active of {len(plans)}")
+
+    async def ensure_loaded(self):
+        if not self.loaded:
+            await self.reload()
+
+    def get(self, plan_id: Optional[int]) -> Optional[Plan]:
+        return self.plans.get(plan_id)
+
+plan_catalog = PlanCatalog()
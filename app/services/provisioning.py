@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Optional, Set
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from ..core.config import settings
+from ..core.db import AsyncSessionLocal
+from ..core.models import ProvisioningJob
+from ..core.repository import latest_subscription, load_transaction, renew_subscription
+from ..bot.qr import send_key_qr
+from ..bot.sender import send_message
+from ..bot.texts import INSTRUCTION_TEXT, MARZBAN_ERROR_TEXT, key_message
+from .marzban_api import MarzbanAPI
+from .plan_catalog import plan_catalog
+from .server_pool import server_pool
+from .stats_service import record_activity, set_transaction_status
+
+logger = logging.getLogger(__name__)
+
+async def get_expire_date(api: MarzbanAPI, username: str, days: int) -> int:
+    """Считает дату окончания подписки"""
+    current_ts = int(time.time())
+    seconds_add = days * 24 * 60 * 60
+
+    res = await api.get_user(username, fresh=True)
+    # Если Marzban не ответил, не считаем от "сейчас" — иначе юзер потеряет оплаченные дни
+    if not res and res.error != "not_found":
+        raise Exception(MARZBAN_ERROR_TEXT.get(res.error, f"Marzban недоступен ({res.error})"))
+
+    old_expire = (res.data or {}).get("expire") or 0
+    if old_expire > current_ts:
+        return old_expire + seconds_add
+
+    return current_ts + seconds_add
+
+def enqueue_provisioning(session: AsyncSession, user_id: int, username: str, plan_id: int, transaction_id: Optional[int] = None) -> ProvisioningJob:
+    """Кладет заявку в outbox той же сессии — коммитится вместе с транзакцией платежа"""
+    job = ProvisioningJob(user_id=user_id, username=username, plan_id=plan_id, transaction_id=transaction_id)
+    session.add(job)
+    return job
+
+
+class ProvisioningWorker:
+    """
+    Разбирает outbox: создает/продлевает юзера в Marzban, пишет подписку и присылает ключ.
+    Заявка захватывается условным UPDATE, поэтому несколько реплик не выдадут ее дважды.
+    """
+
+    def __init__(self, session_factory: async_sessionmaker = AsyncSessionLocal):
+        self.session_factory = session_factory
+        self.servers = server_pool
+        self.plans = plan_catalog
+        self.bot = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop_task: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def start(self, bot):
+        self.bot = bot
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(settings.PROVISIONING_WORKERS)
+        self._loop_task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+            self._loop_task = None
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def notify(self):
+        """Разбудить воркер сразу после коммита новой заявки"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.poll_once()
+            except Exception as e:
+                logger.error(f"Provisioning poll failed: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=settings.PROVISIONING_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def poll_once(self) -> int:
+        """Захватывает готовые заявки и запускает их обработку. Возвращает число захваченных"""
+        now = datetime.utcnow()
+        async with self.session_factory() as session:
+            # Заявки, зависшие в processing (упала реплика), возвращаем в очередь
+            await session.execute(
+                update(ProvisioningJob)
+                .where(
+                    ProvisioningJob.status == "processing",
+                    ProvisioningJob.locked_at < now - timedelta(seconds=settings.PROVISIONING_LOCK_TIMEOUT)
+                )
+                .values(status="pending")
+            )
+            result = await session.execute(
+                select(ProvisioningJob.id)
+                .where(ProvisioningJob.status == "pending", ProvisioningJob.next_attempt_at <= now)
+                .order_by(ProvisioningJob.id)
+                .limit(settings.PROVISIONING_WORKERS * 2)
+            )
+            claimed = []
+            for job_id in result.scalars().all():
+                res = await session.execute(
+                    update(ProvisioningJob)
+                    .where(ProvisioningJob.id == job_id, ProvisioningJob.status == "pending")
+                    .values(status="processing", locked_at=now)
+                )
+                if res.rowcount == 1:
+                    claimed.append(job_id)
+            await session.commit()
+
+        for job_id in claimed:
+            task = asyncio.create_task(self._run(job_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return len(claimed)
+
+    async def _run(self, job_id: int):
+        async with self._semaphore:
+            await self.process(job_id)
+
+    async def process(self, job_id: int):
+        async with self.session_factory() as session:
+            job = await session.get(ProvisioningJob, job_id)
+            try:
+                key = await self._provision(session, job)
+            except Exception as e:
+                await session.rollback()
+                await self._fail(session, job_id, str(e))
+                return
+
+        if key is not None and self.bot is not None:
+            sub_url, vless_key, plan_name, expire_ts, sub = key
+            expire_str = datetime.fromtimestamp(expire_ts).strftime('%d.%m.%Y')
+            try:
+                await send_message(
+                    self.bot, job.user_id,
+                    key_message(f"✅ <b>Доступ активирован!</b>\nТариф: {plan_name}\nДействует до: <b>{expire_str}</b>", sub_url, vless_key),
+                    parse_mode="HTML", disable_web_page_preview=True
+                )
+                await send_message(self.bot, job.user_id, INSTRUCTION_TEXT, parse_mode="HTML", disable_web_page_preview=True)
+                # Продление с тем же ключом уходит по сохраненному file_id, без рендера
+                async with self.session_factory() as session:
+                    await send_key_qr(self.bot, session, job.user_id, sub)
+            except Exception as e:
+                logger.error(f"Failed to deliver key for job {job_id}: {e}")
+
+    async def _provision(self, session: AsyncSession, job: ProvisioningJob):
+        # Платеж и последняя подписка — одним запросом (у бесплатного тарифа платежа нет)
+        if job.transaction_id is not None:
+            bundle = await load_transaction(session, job.transaction_id)
+            tx, sub = (bundle.transaction, bundle.subscription) if bundle else (None, None)
+        else:
+            tx, sub = None, await latest_subscription(session, job.user_id)
+        # Админ успел отклонить чек до выдачи — ничего не создаем
+        if tx is not None and tx.status not in ("pending", "success"):
+            job.status = "cancelled"
+            await session.commit()
+            return None
+
+        await self.plans.ensure_loaded()
+        plan = self.plans.get(job.plan_id)
+        if plan is None:
+            raise Exception(f"Тариф {job.plan_id} не найден")
+
+        # Первая попытка: фиксируем сервер и итоговую дату, повтор использует их же
+        if job.expire_ts is None:
+            await self.servers.ensure_loaded()
+            if sub is not None:
+                job.server_id = sub.server_id
+            else:
+                job.server_id, _ = self.servers.place_new_user()
+            job.expire_ts = await get_expire_date(self.servers.api_for(job.server_id), job.username, plan.duration_days)
+            await session.commit()
+
+        api = self.servers.api_for(job.server_id)
+        res = await api.create_user(username=job.username, data_limit=plan.limit_gb, expire=job.expire_ts)
+        if not res:
+            raise Exception(MARZBAN_ERROR_TEXT.get(res.error, f"Marzban не вернул данные ({res.error})"))
+
+        sub_url = res.data.get('subscription_url', '')
+        links = res.data.get('links', [])
+        vless_key = links[0] if links else "Ключ генерируется..."
+
+        sub = await renew_subscription(
+            session, job.user_id,
+            marzban_username=job.username,
+            plan_id=plan.id,
+            server_id=job.server_id,
+            marzban_key=sub_url,
+            status="active",
+            expire_date=datetime.fromtimestamp(job.expire_ts)
+        )
+
+        if tx is not None:
+            # Условный UPDATE: отказ админа, пришедший во время выдачи, не перетираем
+            await set_transaction_status(session, tx, "success", only_from=("pending",))
+        await record_activity(session, "activations")
+
+        job.status = "done"
+        job.last_error = None
+        await session.commit()
+        return sub_url, vless_key, plan.name, job.expire_ts, sub
+
+    async def _fail(self, session: AsyncSession, job_id: int, error: str):
+        job = await session.get(ProvisioningJob, job_id)
+        job.attempts += 1
+        job.last_error = error[:500]
+        if job.attempts >= settings.PROVISIONING_MAX_ATTEMPTS:
+            job.status = "failed"
+            logger.error(f"Provisioning job {job_id} failed permanently: {error}")
+        else:
+            job.status = "pending"
+            delay = min(settings.PROVISIONING_RETRY_MAX_DELAY, settings.PROVISIONING_RETRY_BASE_DELAY * 2 ** (job.attempts - 1))
+            job.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+            logger.warning(f"Provisioning job {job_id} attempt {job.attempts} failed, retry in {delay}s: {error}")
+        await session.commit()
+
+        if job.status == "failed" and self.bot is not None:
+            try:
+                await send_message(self.bot, job.user_id, "❌ Не удалось выдать доступ автоматически. Администратор уже в курсе и выдаст ключ вручную.")
+                await send_message(self.bot, settings.ADMIN_ID, f"⚠️ Выдача #{job_id} (юзер {job.user_id}) не удалась: {error}")
+            except Exception as e:
+                logger.error(f"Failed to report job {job_id}: {e}")
+
+provisioning_worker = ProvisioningWorker()
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from ..core.db import AsyncSessionLocal
+from ..core.models import Server, Subscription
+from ..core.repository import latest_subscription
+from .marzban_api import MarzbanAPI, get_marzban_api
+
+logger = logging.getLogger(__name__)
+
+class ServerPool:
+    """
+    Серверы Marzban из таблицы servers, по одному клиенту (и пулу соединений) на хост.
+    Новые юзеры распределяются по нагрузке: активные подписки / weight.
+    Подписки без server_id живут на основном MARZBAN_HOST из настроек.
+    """
+
+    def __init__(self, session_factory: async_sessionmaker = AsyncSessionLocal):
+        self.session_factory = session_factory
+        self.servers: Dict[int, Server] = {}
+        self.load: Dict[Optional[int], int] = {}
+        self.loaded = False
+        self._lock = asyncio.Lock()
+
+    async def reload(self):
+        async with self._lock:
+            async with self.session_factory() as session:
+                servers = (await session.execute(select(Server))).scalars().all()
+                counts = await session.execute(
+                    select(Subscription.server_id, func.count())
+                    .where(Subscription.status == "active")
+                    .group_by(Subscription.server_id)
+                )
+                load = dict(counts.all())
+            self.servers = {s.id: s for s in servers}
+            self.load = load
+            self.loaded = True
+        logger.info(f"Server pool: {len(self.active_servers())} active servers, load {self.load}")
+
+    async def ensure_loaded(self):
+        if not self.loaded:
+            await self.reload()
+
+    def active_servers(self) -> List[Server]:
+        return [s for s in self.servers.values() if s.is_active is not False]
+
+    def api_for(self, server_id: Optional[int]) -> MarzbanAPI:
+        server = self.servers.get(server_id)
+        if server is None:
+            return get_marzban_api()
+        return get_marzban_api(server.host_url, server.username, server.password)
+
+    def clients(self) -> List[MarzbanAPI]:
+        return [get_marzban_api()] + [self.api_for(s.id) for s in self.active_servers()]
+
+    def place_new_user(self) -> Tuple[Optional[int], MarzbanAPI]:
+        """Выбирает наименее загруженный сервер с учетом веса"""
+        candidates = self.active_servers()
+        if not candidates:
+            return None, get_marzban_api()
+        server = min(candidates, key=lambda s: (self.load.get(s.id, 0) + 1) / max(s.weight or 1, 1))
+        self.load[server.id] = self.load.get(server.id, 0) + 1
+        return server.id, self.api_for(server.id)
+
+    def api_for_subscription(self, sub: Optional[Subscription]) -> Tuple[Optional[int], MarzbanAPI]:
+        """Сервер уже загруженной подписки (без подписки — выбранный по нагрузке)"""
+        if sub is not None:
+            return sub.server_id, self.api_for(sub.server_id)
+        return self.place_new_user()
+
+    async def api_for_user(self, session: AsyncSession, telegram_id: int) -> Tuple[Optional[Subscription], Optional[int], MarzbanAPI]:
+        """Последняя подписка юзера и клиент его сервера (новому юзеру — выбранный по нагрузке)"""
+        await self.ensure_loaded()
+        sub = await latest_subscription(session, telegram_id)
+        return (sub, *self.api_for_subscription(sub))
+
+server_pool = ServerPool()
@@ -0,0 +1,128 @@
+import logging
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Optional, Sequence
+
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+
+from ..core.db import dialect_insert
+from ..core.models import DailyActivity, DailyRevenue, Plan, Subscription, Transaction
+
+logger = logging.getLogger(__name__)
+
+# Статусы, которые считаем выручкой
+PAID_STATUSES = ("success", "approved")
+
+def _today() -> date:
+    return datetime.utcnow().date()
+
+async def _add(session: AsyncSession, model, keys: Dict[str, Any], deltas: Dict[str, int]):
+    """Прибавляет дельты к строке сводки (создает ее при первом обращении) в текущей транзакции"""
+    table = model.__table__
+    stmt = dialect_insert(session)(table).values(**keys, **deltas)
+    await session.execute(stmt.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={name: table.c[name] + stmt.excluded[name] for name in deltas},
+    ))
+
+async def record_transaction(session: AsyncSession, tx: Transaction, old_status: Optional[str], new_status: str):
+    """Переносит платеж между корзинами сводки. День — дата создания платежа"""
+    day = (tx.created_at or datetime.utcnow()).date()
+    plan_id = tx.plan_id or 0
+    amount = tx.amount or 0
+    if old_status is not None:
+        await _add(session, DailyRevenue, {"day": day, "plan_id": plan_id, "status": old_status}, {"count": -1, "amount": -amount})
+    await _add(session, DailyRevenue, {"day": day, "plan_id": plan_id, "status": new_status}, {"count": 1, "amount": amount})
+
+async def record_activity(session: AsyncSession, field: str, n: int = 1):
+    """field: new_users / activations / expirations"""
+    if n:
+        await _add(session, DailyActivity, {"day": _today()}, {field: n})
+
+async def set_transaction_status(session: AsyncSession, tx: Transaction, new_status: str, only_from: Optional[Sequence[str]] = None) -> bool:
+    """
+    Меняет статус платежа условным UPDATE и в той же транзакции двигает сводку.
+    Все смены статуса идут через эту функцию: гонка админа с воркером выдачи не задвоит итоги.
+    Возвращает False, если статус уже другой или не из only_from.
+    """
+    for _ in range(3):
+        old_status = tx.status
+        if old_status == new_status or (only_from is not None and old_status not in only_from):
+            return False
+        res = await session.execute(
+            update(Transaction)
+            .where(Transaction.id == tx.id, Transaction.status == old_status)
+            .values(status=new_status)
+            .execution_options(synchronize_session=False)
+        )
+        if res.rowcount == 1:
+            set_committed_value(tx, "status", new_status)
+            await record_transaction(session, tx, old_status, new_status)
+            return True
+        # Статус поменяли параллельно — перечитываем и решаем заново
+        await session.refresh(tx, ["status"])
+    return False
+
+def active_by_plan_query():
+    """Активные подписки по тарифам — только по индексу ix_subscriptions_status_plan_id"""
+    return (
+        select(Subscription.plan_id, func.count())
+        .where(Subscription.status == "active")
+        .group_by(Subscription.plan_id)
+    )
+
+async def dashboard(session: AsyncSession, days: int = 30) -> Dict[str, Any]:
+    """Данные страницы статистики — только из сводных таблиц (и активных подписок по покрывающему индексу)"""
+    today = _today()
+    month_start = today.replace(day=1)
+    since = min(today - timedelta(days=days - 1), month_start)
+
+    plans = dict((await session.execute(select(Plan.id, Plan.name))).all())
+    revenue = (await session.execute(select(DailyRevenue).where(DailyRevenue.day >= since))).scalars().all()
+    activity = {
+        row.day: row for row in
+        (await session.execute(select(DailyActivity).where(DailyActivity.day >= since))).scalars().all()
+    }
+    active_by_plan = (await session.execute(active_by_plan_query())).all()
+
+    daily: Dict[date, Dict[str, int]] = {}
+    month_by_plan: Dict[str, Dict[str, int]] = {}
+    month = {"revenue": 0, "paid": 0, "pending": 0, "rejected": 0}
+    for row in revenue:
+        paid = row.status in PAID_STATUSES
+        if row.day >= today - timedelta(days=days - 1):
+            bucket = daily.setdefault(row.day, {"revenue": 0, "payments": 0})
+            bucket["payments"] += row.count
+            bucket["revenue"] += row.amount if paid else 0
+        if row.day >= month_start:
+            if paid:
+                month["revenue"] += row.amount
+                month["paid"] += row.count
+                plan = month_by_plan.setdefault(plans.get(row.plan_id, "—"), {"revenue": 0, "count": 0})
+                plan["revenue"] += row.amount
+                plan["count"] += row.count
+            elif row.status == "pending":
+                month["pending"] += row.count
+            else:
+                month["rejected"] += row.count
+
+    rows = []
+    for offset in range(days):
+        day = today - timedelta(days=offset)
+        act = activity.get(day)
+        rows.append({
+            "day": day,
+            "revenue": daily.get(day, {}).get("revenue", 0),
+            "payments": daily.get(day, {}).get("payments", 0),
+            "new_users": act.new_users if act else 0,
+            "activations": act.activations if act else 0,
+            "expirations": act.expirations if act else 0,
+        })
+
+    return {
+        "month": month,
+        "month_by_plan": sorted(month_by_plan.items(), key=lambda item: -item[1]["revenue"]),
+        "active_by_plan": [(plans.get(plan_id, "—"), count) for plan_id, count in active_by_plan],
+        "daily": rows,
+    }
@@ -0,0 +1,136 @@
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import bindparam, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from ..core.config import settings
+from ..core.db import AsyncSessionLocal
+from ..core.models import Subscription, SyncCheckpoint
+from .server_pool import ServerPool
+
+logger = logging.getLogger(__name__)
+
+# Статусы Marzban, при которых доступ считаем действующим
+ACTIVE_STATUSES = ("active", "on_hold")
+
+_subs = Subscription.__table__
+# executemany по id. Если строку успели поменять после снимка (выдача, отключение) — не трогаем,
+# следующий прогон сверит ее заново
+_apply_changes = (
+    update(_subs)
+    .where(
+        _subs.c.id == bindparam("b_id"),
+        _subs.c.status.is_not_distinct_from(bindparam("b_old_status")),
+        _subs.c.expire_date.is_not_distinct_from(bindparam("b_old_expire_date")),
+    )
+    .values(status=bindparam("b_status"), expire_date=bindparam("b_expire_date"), marzban_key=bindparam("b_marzban_key"))
+)
+
+async def _load_local(session: AsyncSession, server_id: Optional[int]) -> Dict[str, Dict[str, Any]]:
+    """
+    Снимок последних подписок сервера: логин Marzban -> строка.
+    Ключ — только сохраненный логин (user_ID, если его нет): текущий ник юзера может совпасть
+    со старым логином другого юзера, и тогда чужая запись из Marzban легла бы на его подписку.
+    """
+    latest = select(func.max(Subscription.id).label("id")).group_by(Subscription.user_id).subquery()
+    server_filter = Subscription.server_id.is_(None) if server_id is None else Subscription.server_id == server_id
+    result = await session.execute(
+        select(
+            Subscription.id, Subscription.user_id, Subscription.status,
+            Subscription.expire_date, Subscription.marzban_key, Subscription.marzban_username
+        )
+        .join(latest, latest.c.id == Subscription.id)
+        .where(server_filter)
+    )
+    local: Dict[str, Dict[str, Any]] = {}
+    for row in result.all():
+        entry = {"id": row.id, "status": row.status, "expire_date": row.expire_date, "marzban_key": row.marzban_key}
+        local[row.marzban_username or f"user_{row.user_id}"] = entry
+    return local
+
+def diff_users(users: List[Dict[str, Any]], local: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Параметры UPDATE только для подписок, которые разошлись с Marzban"""
+    changes = []
+    for user in users:
+        row = local.get(user.get("username"))
+        if row is None:
+            continue
+        expire = user.get("expire")
+        expire_date = datetime.fromtimestamp(expire) if expire else None
+        status = "active" if user.get("status") in ACTIVE_STATUSES else "expired"
+        if row["status"] == "active" and status == "expired":
+            # Истечение — дело почасовой проверки: она отключает, уведомляет юзера и считает expirations.
+            # Сверка только подтягивает ключ и даты и оживляет подписки, продленные в панели
+            status = "active"
+        marzban_key = user.get("subscription_url") or row["marzban_key"]
+        if (status, expire_date, marzban_key) == (row["status"], row["expire_date"], row["marzban_key"]):
+            continue
+        changes.append({
+            "b_id": row["id"],
+            "b_old_status": row["status"],
+            "b_old_expire_date": row["expire_date"],
+            "b_status": status,
+            "b_expire_date": expire_date,
+            "b_marzban_key": marzban_key,
+        })
+        row.update(status=status, expire_date=expire_date, marzban_key=marzban_key)
+    return changes
+
+async def _sync_server(servers: ServerPool, server_id: Optional[int], session_factory: async_sessionmaker, stats: Dict[str, int]):
+    api = servers.api_for(server_id)
+    key = f"marzban_users:{'default' if server_id is None else server_id}"
+    page_size = settings.MARZBAN_SYNC_PAGE_SIZE
+
+    async with session_factory() as session:
+        checkpoint = await session.get(SyncCheckpoint, key)
+        if checkpoint is None:
+            checkpoint = SyncCheckpoint(key=key, next_offset=0)
+            session.add(checkpoint)
+        local = await _load_local(session, server_id)
+        await session.commit()
+
+        for _ in range(settings.MARZBAN_SYNC_MAX_PAGES):
+            res = await api.list_users(checkpoint.next_offset, page_size)
+            if not res or not isinstance(res.data, dict):
+                logger.warning(f"Marzban sync {key}: page at {checkpoint.next_offset} failed ({res.error}), resume next run")
+                break
+            users = res.data.get("users") or []
+            changes = diff_users(users, local)
+            if changes:
+                await session.execute(_apply_changes, changes)
+
+            stats["pages"] += 1
+            stats["seen"] += len(users)
+            stats["changed"] += len(changes)
+            stats["unknown"] += sum(1 for u in users if u.get("username") not in local)
+
+            checkpoint.updated_at = datetime.utcnow()
+            total = res.data.get("total")
+            if len(users) < page_size or (total is not None and checkpoint.next_offset + len(users) >= total):
+                # Полный проход завершен, следующий прогон начнет сначала
+                checkpoint.next_offset = 0
+                checkpoint.last_full_sync_at = checkpoint.updated_at
+            else:
+                checkpoint.next_offset += len(users)
+            await session.commit()
+            if checkpoint.next_offset == 0:
+                break
+
+async def sync_marzban_users(servers: ServerPool, session_factory: async_sessionmaker = AsyncSessionLocal) -> Dict[str, int]:
+    """
+    Сверяет таблицу subscriptions с Marzban постраничным /api/users вместо get_user на каждого юзера.
+    За прогон читается не больше MARZBAN_SYNC_MAX_PAGES страниц на сервер, позиция хранится
+    в sync_checkpoints — большой сервер сверяется за несколько прогонов.
+    Пишутся только разошедшиеся строки: статус, дата окончания и ссылка подписки.
+    """
+    await servers.ensure_loaded()
+    stats = {"pages": 0, "seen": 0, "changed": 0, "unknown": 0}
+    for server_id in [None] + [s.id for s in servers.active_servers()]:
+        try:
+            await _sync_server(servers, server_id, session_factory, stats)
+        except Exception as e:
+            logger.error(f"Marzban sync failed for server {server_id}: {e}")
+    logger.info(f"Marzban sync done: {stats}")
+    return stats
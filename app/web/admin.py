@@ -1,29 +1,96 @@
-from sqladmin import Admin, ModelView
+from pathlib import Path
+
+from sqladmin import Admin, BaseView, ModelView, action, expose
+from ..core.db import AsyncSessionLocal
 from ..core.models import User, Plan, Server, Subscription, Transaction
+from ..core.search import transaction_filter, user_filter
+from ..services.payment_service import approve_payments, reject_payments
+from ..services.stats_service import dashboard
+from ..services.plan_catalog import plan_catalog
+from ..services.server_pool import server_pool
+
+class IndexedSearchMixin:
+    # Диалект выставляет setup_admin; поиск идет через app/core/search.py, а не LIKE по колонкам
+    search_dialect = "sqlite"
 
-class UserAdmin(ModelView, model=User):
-    column_list = [User.telegram_id, User.username, User.balance, User.is_banned]
-    column_searchable_list = [User.username, User.telegram_id]
+class UserAdmin(IndexedSearchMixin, ModelView, model=User):
+    column_list = [User.telegram_id, User.username, User.full_name, User.balance, User.is_banned]
+    column_searchable_list = [User.username, User.full_name, User.telegram_id]
+
+    def search_query(self, stmt, term):
+        return stmt.where(user_filter(self.search_dialect, term))
 
 class PlanAdmin(ModelView, model=Plan):
     column_list = [Plan.id, Plan.name, Plan.price, Plan.duration_days, Plan.is_active]
 
+    # Бот держит тарифы в памяти — после правки перечитываем каталог
+    async def after_model_change(self, data, model, is_created, request):
+        await plan_catalog.reload()
+
+    async def after_model_delete(self, model, request):
+        await plan_catalog.reload()
+
 class ServerAdmin(ModelView, model=Server):
-    column_list = [Server.id, Server.host_url, Server.username]
+    column_list = [Server.id, Server.host_url, Server.username, Server.weight, Server.is_active]
+
+    # Новый сервер сразу участвует в распределении юзеров
+    async def after_model_change(self, data, model, is_created, request):
+        await server_pool.reload()
+
+    async def after_model_delete(self, model, request):
+        await server_pool.reload()
 
 class SubscriptionAdmin(ModelView, model=Subscription):
     # Убедись, что plan_id здесь есть
-    column_list = [Subscription.id, Subscription.user_id, Subscription.plan_id, Subscription.expire_date, Subscription.status]
+    column_list = [Subscription.id, Subscription.user_id, Subscription.plan_id, Subscription.server_id, Subscription.expire_date, Subscription.status]
 
-class TransactionAdmin(ModelView, model=Transaction):
+class TransactionAdmin(IndexedSearchMixin, ModelView, model=Transaction):
     column_list = [Transaction.id, Transaction.user_id, Transaction.amount, Transaction.status, Transaction.created_at]
+    column_searchable_list = [Transaction.id, Transaction.user_id]
+
+    def search_query(self, stmt, term):
+        return stmt.where(transaction_filter(self.search_dialect, term))
+
+    def search_placeholder(self):
+        return "номер платежа, ID, ник или имя юзера"
+
+    @action(name="approve_selected", label="Одобрить", confirmation_message="Одобрить выбранные платежи?")
+    async def approve_selected(self, request):
+        return await self._bulk(request, "Одобрение платежей", approve_payments)
+
+    @action(name="reject_selected", label="Отклонить", confirmation_message="Отклонить выбранные платежи?")
+    async def reject_selected(self, request):
+        return await self._bulk(request, "Отклонение платежей", reject_payments)
+
+    async def _bulk(self, request, title, handler):
+        pks = [int(pk) for pk in request.query_params.get("pks", "").split(",") if pk]
+        async with AsyncSessionLocal() as session:
+            results = await handler(session, pks)
+        return await self.templates.TemplateResponse(request, "bulk_results.html", {
+            "title": title,
+            "results": sorted(results.items()),
+            "back_url": request.url_for("admin:list", identity=self.identity),
+        })
+
+class StatsAdmin(BaseView):
+    name = "Статистика"
+    icon = "fa-solid fa-chart-line"
+
+    # Выручка и активность — из суточных сводок, а не сканом transactions
+    @expose("/stats", methods=["GET"])
+    async def stats_page(self, request):
+        async with AsyncSessionLocal() as session:
+            context = await dashboard(session)
+        return await self.templates.TemplateResponse(request, "stats.html", context)
 
 # --- ВОТ ЭТА ФУНКЦИЯ ПРОПАЛА ---
 def setup_admin(app, engine):
-    admin = Admin(app, engine)
+    IndexedSearchMixin.search_dialect = engine.dialect.name
+    admin = Admin(app, engine, templates_dir=str(Path(__file__).parent / "templates"))
     admin.add_view(UserAdmin)
     admin.add_view(PlanAdmin)
     admin.add_view(ServerAdmin)
     admin.add_view(SubscriptionAdmin)
     admin.add_view(TransactionAdmin)
+    admin.add_view(StatsAdmin)
     return admin
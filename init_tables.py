@@ -1,12 +1,11 @@
 import asyncio
-from app.db.session import engine
-from app.db.base import Base
+from app.core.db import engine
+from app.core.migrations import run_migrations
 
 async def init():
     print("⏳ Подключение к базе...")
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-    print("✅ УСПЕХ: Таблицы созданы!")
+    applied = await run_migrations(engine)
+    print(f"✅ УСПЕХ: Таблицы созданы! Миграции: {applied or 'актуальны'}")
 
 if __name__ == "__main__":
     asyncio.run(init())
@@ -0,0 +1,343 @@
+"""
+Нагрузочный прогон бота без Telegram и без настоящего Marzban.
+
+Поднимает локальный двойник Marzban на aiohttp (задержка и доля ошибок настраиваются),
+кормит Dispatcher синтетическими апдейтами через настоящий router и печатает
+пропускную способность и p50/p95/p99 по шагам сценария для каждого уровня конкурентности.
+
+    python loadtest.py --concurrency 1,10,50 --users 200 --marzban-latency 0.05 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import logging
+import os
+import random
+import socket
+import tempfile
+import time
+import uuid
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+from aiohttp import web
+from aiogram.client.session.base import BaseSession
+from aiogram.types import File, Message, Update
+
+STEPS = ("start", "shop", "free_plan", "buy_paid", "receipt", "profile")
+
+# --- ДВОЙНИК MARZBAN ---
+
+class FakeMarzban:
+    """Минимальный Marzban: токен, inbounds, список и CRUD юзеров в памяти"""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.users: Dict[str, dict] = {}
+        self.requests: Counter = Counter()
+        self.app = web.Application(middlewares=[self._chaos])
+        self.app.add_routes([
+            web.post("/api/admin/token", self.token),
+            web.get("/api/inbounds", self.inbounds),
+            web.get("/api/users", self.list_users),
+            web.post("/api/user", self.create_user),
+            web.get("/api/user/{username}", self.get_user),
+            web.put("/api/user/{username}", self.modify_user),
+            web.delete("/api/user/{username}", self.delete_user),
+        ])
+        self._runner = None
+
+    async def start(self, port: int):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    @web.middleware
+    async def _chaos(self, request: web.Request, handler):
+        self.requests[f"{request.method} {request.match_info.route.resource.canonical}"] += 1
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if request.path != "/api/admin/token" and random.random() < self.error_rate:
+            return web.json_response({"detail": "injected failure"}, status=500)
+        return await handler(request)
+
+    async def token(self, request: web.Request):
+        payload = base64.urlsafe_b64encode(json.dumps({"exp": int(time.time()) + 3600}).encode()).decode().rstrip("=")
+        return web.json_response({"access_token": f"header.{payload}.signature", "token_type": "bearer"})
+
+    async def inbounds(self, request: web.Request):
+        return web.json_response({"vless": [{"tag": "VLESS TCP REALITY", "protocol": "vless"}]})
+
+    async def list_users(self, request: web.Request):
+        offset = int(request.query.get("offset", 0))
+        limit = int(request.query.get("limit", 100))
+        users = list(self.users.values())
+        return web.json_response({"users": users[offset:offset + limit], "total": len(users)})
+
+    def _user_view(self, username: str, body: dict) -> dict:
+        return {
+            "username": username,
+            "status": body.get("status", "active"),
+            "expire": body.get("expire"),
+            "data_limit": body.get("data_limit"),
+            "subscription_url": f"/sub/{username}",
+            "links": [f"vless://{uuid.uuid4()}@127.0.0.1:443?security=reality#{username}"],
+        }
+
+    async def create_user(self, request: web.Request):
+        body = await request.json()
+        username = body["username"]
+        if username in self.users:
+            return web.json_response({"detail": "User already exists"}, status=409)
+        self.users[username] = self._user_view(username, body)
+        return web.json_response(self.users[username])
+
+    async def get_user(self, request: web.Request):
+        user = self.users.get(request.match_info["username"])
+        if user is None:
+            return web.json_response({"detail": "User not found"}, status=404)
+        return web.json_response(user)
+
+    async def modify_user(self, request: web.Request):
+        username = request.match_info["username"]
+        if username not in self.users:
+            return web.json_response({"detail": "User not found"}, status=404)
+        self.users[username].update({k: v for k, v in (await request.json()).items() if k in ("status", "expire", "data_limit")})
+        return web.json_response(self.users[username])
+
+    async def delete_user(self, request: web.Request):
+        if self.users.pop(request.match_info["username"], None) is None:
+            return web.json_response({"detail": "User not found"}, status=404)
+        return web.json_response({"detail": "User successfully deleted"})
+
+# --- TELEGRAM БЕЗ СЕТИ ---
+
+# Размер синтетического файла, который «скачивает» бот
+FAKE_FILE_SIZE = 64 * 1024
+
+class FakeTelegramSession(BaseSession):
+    """Сессия бота, которая не ходит в Telegram: считает вызовы и отвечает заглушками"""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method.__returning__ is Message:
+            message_id = next(self._message_ids)
+            data = {"message_id": message_id, "date": int(time.time()), "chat": {"id": method.chat_id, "type": "private"}}
+            if type(method).__name__ == "SendPhoto":
+                # Как Telegram: загруженное фото получает file_id, отправленное по file_id — его же
+                file_id = method.photo if isinstance(method.photo, str) else f"photo_{message_id}"
+                data["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 512, "height": 512}]
+            return Message.model_validate(data, context={"bot": bot})
+        if method.__returning__ is File:
+            return File(file_id=method.file_id, file_unique_id=method.file_id, file_size=FAKE_FILE_SIZE, file_path=f"files/{method.file_id}")
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        # bot.download(): отдаем синтетический файл (например, чек) кусками по chunk_size
+        self.calls["download"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        content = f"fake file {url}".encode().ljust(FAKE_FILE_SIZE, b"\0")
+        for offset in range(0, len(content), chunk_size):
+            yield content[offset:offset + chunk_size]
+
+    async def close(self):
+        pass
+
+# --- СИНТЕТИЧЕСКИЕ АПДЕЙТЫ ---
+
+_update_ids = itertools.count(1)
+
+def _tg_user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": f"Load {uid}", "username": f"load_{uid}"}
+
+def _chat(uid: int) -> dict:
+    return {"id": uid, "type": "private"}
+
+def message_update(uid: int, text: str = None, photo: bool = False) -> Update:
+    update_id = next(_update_ids)
+    message = {"message_id": update_id, "date": int(time.time()), "chat": _chat(uid), "from": _tg_user(uid)}
+    if photo:
+        message["photo"] = [{"file_id": f"receipt_{update_id}", "file_unique_id": f"u{update_id}", "width": 800, "height": 600}]
+    else:
+        message["text"] = text
+    return Update.model_validate({"update_id": update_id, "message": message})
+
+def callback_update(uid: int, data: str) -> Update:
+    update_id = next(_update_ids)
+    return Update.model_validate({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _tg_user(uid),
+            "chat_instance": str(uid),
+            "data": data,
+            "message": {"message_id": update_id, "date": int(time.time()), "chat": _chat(uid), "text": "menu"},
+        },
+    })
+
+def build_flow(uid: int, free_plan_id: int, paid_plan_id: int):
+    """Сценарий одного юзера: старт, магазин, тест, покупка с чеком, профиль"""
+    yield "start", message_update(uid, text="/start")
+    yield "shop", message_update(uid, text="⚡️ Купить доступ")
+    yield "free_plan", callback_update(uid, f"buy_plan_{free_plan_id}")
+    yield "buy_paid", callback_update(uid, f"buy_plan_{paid_plan_id}")
+    yield "receipt", message_update(uid, photo=True)
+    yield "profile", message_update(uid, text="👤 Профиль")
+
+# --- ОТЧЕТ ---
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+def print_report(concurrency: int, elapsed: float, samples: Dict[str, List[float]], errors: int):
+    total = sum(len(v) for v in samples.values())
+    print(f"\nconcurrency={concurrency}  updates={total}  errors={errors}  {elapsed:.2f}s  {total / elapsed:.1f} upd/s")
+    print(f"{'step':<12}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    rows = [(step, samples[step]) for step in STEPS if samples[step]]
+    rows.append(("all", [x for values in samples.values() for x in values]))
+    for step, values in rows:
+        p50, p95, p99 = (percentile(values, q) * 1000 for q in (50, 95, 99))
+        print(f"{step:<12}{len(values):>8}{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}")
+
+# --- ПРОГОН ---
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def run_level(dp, bot, concurrency: int, uids, plans):
+    samples: Dict[str, List[float]] = defaultdict(list)
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        for uid in uids:
+            for step, update in build_flow(uid, *plans):
+                started = time.perf_counter()
+                try:
+                    await dp.feed_update(bot, update)
+                except Exception:
+                    errors += 1
+                samples[step].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    print_report(concurrency, time.perf_counter() - started, samples, errors)
+
+async def wait_outbox_drained(session_factory, timeout: float):
+    from sqlalchemy import func, select
+    from app.core.models import ProvisioningJob
+
+    started = time.perf_counter()
+    while True:
+        async with session_factory() as session:
+            counts = dict((await session.execute(
+                select(ProvisioningJob.status, func.count()).group_by(ProvisioningJob.status)
+            )).all())
+        queued = counts.get("pending", 0) + counts.get("processing", 0)
+        if queued == 0 or time.perf_counter() - started > timeout:
+            print(f"outbox: {counts} (drained in {time.perf_counter() - started:.2f}s)")
+            return
+        await asyncio.sleep(0.2)
+
+async def run(args):
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix="loadtest_")
+    # Настройки читаются при импорте app.*, поэтому окружение готовим до него
+    os.environ.update({
+        "BOT_TOKEN": "123456:LOADTEST",
+        "ADMIN_ID": "1",
+        "DATABASE_URL": args.database_url or f"sqlite+aiosqlite:///{workdir}/loadtest.db",
+        "MARZBAN_HOST": f"http://127.0.0.1:{port}",
+        "MARZBAN_USERNAME": "admin",
+        "MARZBAN_PASSWORD": "admin",
+    })
+    if not args.real_tg_limits:
+        # Меряем бота, а не лимиты Telegram: отправка ограничена только задержкой заглушки
+        os.environ.update({"TG_GLOBAL_RATE": "1000000", "TG_CHAT_RATE": "1000000", "TG_CHAT_BURST": "1000000"})
+
+    from aiogram import Bot, Dispatcher
+    from app.core.db import engine, AsyncSessionLocal
+    from app.core.migrations import run_migrations
+    from app.core.models import Plan
+    from app.bot.sender import send_scheduler
+    from app.bot.storage import SQLAlchemyStorage
+    from app.services.marzban_api import close_marzban_clients
+    from app.services.plan_catalog import plan_catalog
+    from app.services.provisioning import provisioning_worker
+    from app.services.server_pool import server_pool
+    from main import setup_dispatcher
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    marzban = FakeMarzban(args.marzban_latency, args.error_rate)
+    await marzban.start(port)
+
+    await run_migrations(engine)
+    async with AsyncSessionLocal() as session:
+        free_plan = Plan(name="Тест", price=0, duration_days=1, limit_gb=3, is_active=True)
+        paid_plan = Plan(name="1 Месяц", price=500, duration_days=30, limit_gb=0, is_active=True)
+        session.add_all([free_plan, paid_plan])
+        await session.commit()
+    await plan_catalog.reload()
+    await server_pool.reload()
+
+    telegram = FakeTelegramSession(args.telegram_latency)
+    bot = Bot(token=os.environ["BOT_TOKEN"], session=telegram)
+    dp = Dispatcher(storage=SQLAlchemyStorage())
+    setup_dispatcher(dp)
+    send_scheduler.start()
+    provisioning_worker.start(bot)
+
+    next_uid = itertools.count(10_000_000)
+    try:
+        for concurrency in args.concurrency:
+            uids = iter([next(next_uid) for _ in range(args.users)])
+            await run_level(dp, bot, concurrency, uids, (free_plan.id, paid_plan.id))
+            await wait_outbox_drained(AsyncSessionLocal, args.drain_timeout)
+    finally:
+        await provisioning_worker.stop()
+        await send_scheduler.stop()
+        await dp.storage.close()
+        await close_marzban_clients()
+        await marzban.stop()
+        await engine.dispose()
+
+    print(f"\nmarzban requests: {dict(marzban.requests)}")
+    print(f"telegram calls: {dict(telegram.calls)}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота на двойнике Marzban")
+    parser.add_argument("--concurrency", type=lambda s: [int(x) for x in s.split(",")], default=[1, 10, 50],
+                        help="уровни конкурентности через запятую")
+    parser.add_argument("--users", type=int, default=100, help="юзеров (сценариев) на каждый уровень")
+    parser.add_argument("--marzban-latency", type=float, default=0.02, help="средняя задержка Marzban, сек")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500 от Marzban")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="задержка вызовов Bot API, сек")
+    parser.add_argument("--real-tg-limits", action="store_true", help="не снимать лимиты отправки TG_* из настроек")
+    parser.add_argument("--database-url", default=None, help="БД для прогона (по умолчанию временная SQLite)")
+    parser.add_argument("--verbose", action="store_true", help="логи бота уровня INFO")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="сколько ждать разбора outbox после уровня, сек")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
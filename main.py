@@ -1,19 +1,30 @@
 import asyncio
+import hmac
 import logging
+from datetime import datetime
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
-from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+from aiogram import Bot, Dispatcher, types
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from sqlalchemy import select, update
-from datetime import datetime
 
 from app.core.config import settings
-from app.core.db import engine, AsyncSessionLocal, Base
-from app.core.models import Subscription
-from app.bot.handlers import router as bot_router
+from app.core.db import engine, log_engine_settings, AsyncSessionLocal
+from app.core.metrics import registry, track_job, PENDING_TRANSACTIONS, EXPIRY_BACKLOG, OUTBOX_PENDING
+from app.core.repository import queue_depths
+from app.core.migrations import run_migrations
+from app.bot.handlers import router as bot_router, THROTTLE_ROUTES
+from app.bot.sender import send_scheduler
+from app.bot.storage import SQLAlchemyStorage
+from app.bot.middlewares import DbSessionMiddleware, DeadlineMiddleware, HandlerNameMiddleware, ThrottlingMiddleware, session_stats
 from app.web.admin import setup_admin
-from app.services.marzban_api import MarzbanAPI
+from app.services.marzban_api import close_marzban_clients
+from app.services.server_pool import server_pool
+from app.services.expiry_service import sweep_expired_subscriptions
+from app.services.sync_service import sync_marzban_users
+from app.services.plan_catalog import plan_catalog
+from app.services.provisioning import provisioning_worker
+from app.services.leader import leader
 
 # Logging
 logging.basicConfig(level=logging.INFO)
@@ -21,66 +32,100 @@ logger = logging.getLogger(__name__)
 
 # Bot & Dispatcher
 bot = Bot(token=settings.BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+dp = Dispatcher(storage=SQLAlchemyStorage())
+
+heavy_rate = (settings.THROTTLE_HEAVY_RATE, settings.THROTTLE_HEAVY_BURST)
+throttling = ThrottlingMiddleware(
+    default=(settings.THROTTLE_RATE, settings.THROTTLE_BURST),
+    rates={"profile_menu": heavy_rate, "process_buy_plan": heavy_rate},
+    routes=THROTTLE_ROUTES,
+    idle_ttl=settings.THROTTLE_IDLE_TTL,
+    notice_interval=settings.THROTTLE_NOTICE_INTERVAL,
+)
 
-# Marzban API
-marzban = MarzbanAPI()
+def setup_dispatcher(dispatcher: Dispatcher):
+    """Роутер и middleware бота (общие для сервиса и loadtest.py)"""
+    dispatcher.include_router(bot_router)
+    # Антифлуд первым: отброшенный апдейт не открывает сессию и не ходит в Marzban
+    dispatcher.update.outer_middleware(throttling)
+    # Inject lazy session into handlers
+    dispatcher.update.outer_middleware(DeadlineMiddleware())
+    dispatcher.update.outer_middleware(DbSessionMiddleware())
+    dispatcher.message.middleware(HandlerNameMiddleware())
+    dispatcher.callback_query.middleware(HandlerNameMiddleware())
 
+# Общие строки (подписки, Marzban, уведомления) обходит только лидер;
+# каталог тарифов — кэш в памяти, его перечитывает каждая реплика
+@leader.only
+@track_job("expiry_sweep")
 async def check_expired_subscriptions():
     logger.info("Checking for expired subscriptions...")
-    async with AsyncSessionLocal() as session:
-        now = datetime.utcnow()
-        query = select(Subscription).where(
-            Subscription.expire_date < now,
-            Subscription.status == "active"
-        )
-        result = await session.execute(query)
-        expired_subs = result.scalars().all()
-        
-        for sub in expired_subs:
-            logger.info(f"Subscription {sub.id} for user {sub.user_id} expired.")
-            # Disable in Marzban
-            marzban_username = f"user_{sub.user_id}"
-            await marzban.modify_user(marzban_username, {"status": "disabled"})
-            
-            # Update DB
-            sub.status = "expired"
-            
-            # Notify User
-            try:
-                await bot.send_message(sub.user_id, "⚠️ Ваша подписка VPN истекла. Пожалуйста, продлите её в меню.")
-            except Exception as e:
-                logger.error(f"Failed to notify user {sub.user_id}: {e}")
-        
-        await session.commit()
+    await sweep_expired_subscriptions(server_pool, bot)
+
+@leader.only
+@track_job("marzban_sync")
+async def sync_subscriptions():
+    await sync_marzban_users(server_pool)
+
+def check_webhook_config():
+    # Без секрета любой, кто знает URL, может прислать поддельный апдейт (например, «чек»)
+    if settings.BOT_MODE == "webhook" and not settings.WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET is required in webhook mode")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # 1. Init DB
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    check_webhook_config()
+
+    # 1. Init DB + migrations, load plan catalog
+    await run_migrations(engine)
+    await log_engine_settings(engine)
+    await plan_catalog.reload()
+    
+    # 2. Load Marzban servers, open connection pools
+    await server_pool.reload()
+    for api in server_pool.clients():
+        await api.open()
     
-    # 2. Start Scheduler
+    # 3. Start Scheduler (на всех репликах; задачи над общими данными выполняет только лидер)
+    leader.start()
     scheduler = AsyncIOScheduler()
     scheduler.add_job(check_expired_subscriptions, 'interval', hours=1)
+    scheduler.add_job(sync_subscriptions, 'interval', minutes=settings.MARZBAN_SYNC_INTERVAL_MINUTES)
+    scheduler.add_job(track_job("plan_catalog_reload")(plan_catalog.reload), 'interval', minutes=settings.PLAN_CATALOG_REFRESH_MINUTES)
     scheduler.start()
     
-    # 3. Start Bot
-    dp.include_router(bot_router)
-    # Inject session into handlers
-    @dp.update.outer_middleware()
-    async def database_middleware(handler, event, data):
-        async with AsyncSessionLocal() as session:
-            data["session"] = session
-            return await handler(event, data)
-            
-    asyncio.create_task(dp.start_polling(bot))
+    # 4. Start Bot
+    send_scheduler.start()
+    provisioning_worker.start(bot)
+    setup_dispatcher(dp)
+    
+    polling_task = None
+    if settings.BOT_MODE == "webhook":
+        await bot.set_webhook(
+            url=f"{settings.WEBHOOK_URL.rstrip('/')}{settings.WEBHOOK_PATH}",
+            secret_token=settings.WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logger.info(f"Bot started in webhook mode: {settings.WEBHOOK_URL}{settings.WEBHOOK_PATH}")
+    else:
+        # Polling — для разработки и одного воркера
+        polling_task = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
     
     yield
     
     # Shutdown
+    if polling_task is not None:
+        await dp.stop_polling()
+        await asyncio.gather(polling_task, return_exceptions=True)
+    elif settings.WEBHOOK_DELETE_ON_SHUTDOWN:
+        await bot.delete_webhook()
+    await provisioning_worker.stop()
+    await send_scheduler.stop()
+    await dp.storage.close()
     await bot.session.close()
     scheduler.shutdown()
+    await leader.stop()
+    await close_marzban_clients()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -91,6 +136,50 @@ setup_admin(app, engine)
 async def root():
     return {"status": "running", "service": "VPN Shop Bot API"}
 
+@app.post(settings.WEBHOOK_PATH)
+async def telegram_webhook(request: Request):
+    if settings.BOT_MODE != "webhook":
+        raise HTTPException(status_code=404)
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not settings.WEBHOOK_SECRET or not hmac.compare_digest(token.encode(), settings.WEBHOOK_SECRET.encode()):
+        raise HTTPException(status_code=403)
+    update = types.Update.model_validate(await request.json(), context={"bot": bot})
+    try:
+        await dp.feed_update(bot, update)
+    except Exception:
+        # Ошибку хендлера не отдаем Telegram: на 500 он пришлет апдейт повторно и задвоит побочные эффекты
+        logger.exception(f"Update {update.update_id} failed")
+    return {"ok": True}
+
+@app.get("/health/marzban")
+async def marzban_health():
+    return [
+        {"host": api.host, "breaker": api.breaker.snapshot(), "user_cache": api.cache_stats()}
+        for api in server_pool.clients()
+    ]
+
+@app.get("/health/db-sessions")
+async def db_session_stats():
+    return session_stats
+
+@app.get("/health/leader")
+async def leader_status():
+    return {"holder": leader.holder, "is_leader": leader.is_leader, "token": leader.token}
+
+@app.get("/health/throttling")
+async def throttling_stats():
+    return throttling.snapshot()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    # Очереди считаем на момент скрейпа, а не на каждом изменении статуса
+    async with AsyncSessionLocal() as session:
+        depths = await queue_depths(session, datetime.utcnow())
+    PENDING_TRANSACTIONS.set(value=depths["pending_transactions"])
+    EXPIRY_BACKLOG.set(value=depths["expiry_backlog"])
+    OUTBOX_PENDING.set(value=depths["outbox_pending"])
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
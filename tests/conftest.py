@@ -0,0 +1,48 @@
+import os
+
+import pytest
+import pytest_asyncio
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+
+# main.py создает Bot при импорте — нужен токен правильного формата
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+from app.core.db import Base
+
+class FakePool:
+    """ServerPool с одним сервером: любой server_id ведет в переданный api"""
+    def __init__(self, api, server_id=None):
+        self.api = api
+        self.server_id = server_id
+
+    async def ensure_loaded(self):
+        pass
+
+    def active_servers(self):
+        return []
+
+    def place_new_user(self):
+        return self.server_id, self.api
+
+    def api_for(self, server_id):
+        return self.api
+
+    def api_for_subscription(self, sub):
+        return (sub.server_id if sub else self.server_id), self.api
+
+@pytest_asyncio.fixture
+async def engine(tmp_path):
+    """Временная SQLite со схемой из моделей"""
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/test.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield engine
+    await engine.dispose()
+
+@pytest.fixture
+def session_factory(engine):
+    return async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+@pytest.fixture
+def fake_pool():
+    return FakePool
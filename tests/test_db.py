@@ -0,0 +1,28 @@
+import pytest
+from types import SimpleNamespace
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.core.config import settings
+from app.core.db import build_engine, dialect_insert, engine_options
+
+@pytest.mark.asyncio
+async def test_sqlite_profile_applies_pragmas(tmp_path):
+    engine = build_engine(f"sqlite+aiosqlite:///{tmp_path}/wal.db")
+    async with engine.connect() as conn:
+        assert (await conn.exec_driver_sql("PRAGMA journal_mode")).scalar() == "wal"
+        assert (await conn.exec_driver_sql("PRAGMA synchronous")).scalar() == 1  # NORMAL
+        assert (await conn.exec_driver_sql("PRAGMA busy_timeout")).scalar() == settings.SQLITE_BUSY_TIMEOUT_MS
+    await engine.dispose()
+
+def test_postgres_profile_uses_tuned_pool():
+    options = engine_options("postgresql+asyncpg://user:pass@db/bot")
+    assert options["pool_pre_ping"] is settings.DB_POOL_PRE_PING
+    assert options["pool_size"] == settings.DB_POOL_SIZE
+    assert options["connect_args"] == {"prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE}
+
+def test_dialect_insert_rejects_unsupported_dialects():
+    def session(name):
+        return SimpleNamespace(bind=SimpleNamespace(dialect=SimpleNamespace(name=name)))
+    assert dialect_insert(session("sqlite")) is sqlite_insert
+    with pytest.raises(ValueError, match="mysql"):
+        dialect_insert(session("mysql"))
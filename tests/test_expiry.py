@@ -0,0 +1,65 @@
+import pytest
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock
+from sqlalchemy import select
+
+from app.core.models import Subscription, User
+from app.services.expiry_service import sweep_expired_subscriptions
+from app.services.marzban_api import MarzbanResult
+
+@pytest.mark.asyncio
+async def test_expiry_sweep_keeps_failed_rows_active(session_factory, fake_pool, monkeypatch):
+    from app.core.config import settings
+    monkeypatch.setattr(settings, "EXPIRY_BATCH_SIZE", 2)
+
+    past = datetime.utcnow() - timedelta(days=1)
+    async with session_factory() as session:
+        session.add_all([
+            Subscription(user_id=1, status="active", expire_date=past),
+            Subscription(user_id=2, status="active", expire_date=past),
+            Subscription(user_id=3, status="active", expire_date=past),
+            Subscription(user_id=4, status="active", expire_date=datetime.utcnow() + timedelta(days=1)),
+        ])
+        await session.commit()
+
+    api = AsyncMock()
+    # Marzban не смог отключить user_2
+    api.modify_user.side_effect = lambda username, payload: username != "user_2"
+    bot = AsyncMock()
+
+    outcomes = await sweep_expired_subscriptions(fake_pool(api), bot, session_factory=session_factory)
+
+    assert sorted(outcomes.values()) == ["expired", "expired", "failed"]
+    async with session_factory() as session:
+        rows = (await session.execute(select(Subscription.user_id, Subscription.status))).all()
+    assert dict(rows) == {1: "expired", 2: "active", 3: "expired", 4: "active"}
+    assert sorted(c.kwargs["chat_id"] for c in bot.send_message.call_args_list) == [1, 3]
+
+@pytest.mark.asyncio
+async def test_expiry_sweep_uses_marzban_login_of_user(session_factory, fake_pool):
+    past = datetime.utcnow() - timedelta(days=1)
+    async with session_factory() as session:
+        session.add_all([
+            User(telegram_id=1, username="alice"),
+            # Выдан под старым ником, в users уже новый
+            User(telegram_id=2, username="bob_new"),
+            Subscription(user_id=1, status="active", expire_date=past),
+            Subscription(user_id=2, marzban_username="bob", status="active", expire_date=past),
+            # Удален из панели вручную
+            Subscription(user_id=3, status="active", expire_date=past),
+        ])
+        await session.commit()
+
+    disabled = []
+    async def modify_user(username, payload):
+        if username in ("alice", "bob"):
+            disabled.append(username)
+            return MarzbanResult(True, {})
+        return MarzbanResult(False, status=404, error="not_found")
+    api = AsyncMock()
+    api.modify_user.side_effect = modify_user
+
+    outcomes = await sweep_expired_subscriptions(fake_pool(api), None, session_factory=session_factory)
+
+    assert sorted(disabled) == ["alice", "bob"]
+    assert sorted(outcomes.values()) == ["expired"] * 3
@@ -0,0 +1,33 @@
+import pytest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+from app.bot import handlers
+from app.core.models import Subscription
+from app.services.marzban_api import MarzbanResult
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("res, expected", [
+    (MarzbanResult(True, {"links": ["vless://key"]}), "<code>vless://key</code>"),
+    (MarzbanResult(False, error="circuit_open"), handlers.MARZBAN_ERROR_TEXT["circuit_open"]),
+    (MarzbanResult(False, error="deadline"), handlers.MARZBAN_ERROR_TEXT["deadline"]),
+])
+async def test_profile_shows_marzban_outcome(monkeypatch, res, expected):
+    sub = Subscription(id=1, user_id=1, marzban_username="alice", marzban_key="https://k/1", status="active")
+    api = AsyncMock()
+    api.get_user.return_value = res
+    sent = []
+
+    async def fake_answer(message, text, **kwargs):
+        sent.append(text)
+
+    monkeypatch.setattr(handlers, "latest_subscription", AsyncMock(return_value=sub))
+    monkeypatch.setattr(handlers.server_pool, "api_for", lambda server_id: api)
+    monkeypatch.setattr(handlers, "answer", fake_answer)
+    monkeypatch.setattr(handlers, "send_key_qr", AsyncMock())
+
+    message = SimpleNamespace(from_user=SimpleNamespace(id=1, username="alice_new"), bot=None, chat=SimpleNamespace(id=1))
+    await handlers.profile_menu(message, session=None)
+
+    api.get_user.assert_awaited_once_with("alice")
+    assert sent and sent[0].endswith(expected)
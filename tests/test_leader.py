@@ -0,0 +1,29 @@
+import asyncio
+import pytest
+
+from app.services.leader import LeaderElector
+
+@pytest.mark.asyncio
+async def test_single_leader_with_failover_and_fencing(session_factory):
+    a = LeaderElector(session_factory=session_factory, ttl=0.3)
+    b = LeaderElector(session_factory=session_factory, ttl=0.3)
+    assert await a.heartbeat() and not await b.heartbeat()
+
+    runs = []
+    async def sweep(replica):
+        runs.append(replica)
+    await a.only(sweep)("a")
+    await b.only(sweep)("b")
+    assert runs == ["a"]
+
+    # Лидер завис дольше ttl: аренду забирает другая реплика с новым токеном
+    await asyncio.sleep(0.35)
+    assert not a.is_leader
+    assert await b.heartbeat() and b.token == a.token + 1
+    assert not await a.heartbeat()
+    await a.only(sweep)("a")
+    assert runs == ["a"]
+
+    # Штатная остановка отдает аренду сразу, без ожидания ttl
+    await b.stop()
+    assert await a.heartbeat() and a.token == 3
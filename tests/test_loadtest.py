@@ -0,0 +1,43 @@
+import pytest
+from aiogram import Bot
+
+from app.services.marzban_api import MarzbanAPI
+from loadtest import FAKE_FILE_SIZE, FakeMarzban, FakeTelegramSession, free_port, percentile
+
+@pytest.mark.asyncio
+async def test_fake_marzban_speaks_the_client_protocol():
+    port = free_port()
+    fake = FakeMarzban()
+    await fake.start(port)
+    api = MarzbanAPI(f"http://127.0.0.1:{port}", "admin", "admin")
+    try:
+        created = await api.create_user("load_1", data_limit=1, expire=2_000_000_000)
+        assert created.ok and created.data["subscription_url"].startswith(f"http://127.0.0.1:{port}/sub/")
+
+        # Повтор создания — 409 и переход на PUT, как у настоящей панели
+        again = await api.create_user("load_1", data_limit=2, expire=2_000_000_000)
+        assert again.ok
+        assert fake.requests["PUT /api/user/{username}"] == 1
+
+        page = await api.list_users(0, 10)
+        assert page.data["total"] == 1 and page.data["users"][0]["subscription_url"].startswith("http://")
+
+        api.invalidate_user("load_2")
+        assert (await api.get_user("load_2")).error == "not_found"
+    finally:
+        await api.close()
+        await fake.stop()
+
+@pytest.mark.asyncio
+async def test_fake_telegram_serves_file_downloads():
+    session = FakeTelegramSession()
+    bot = Bot("123456:TEST", session=session)
+    content = await bot.download("receipt_1")
+    assert len(content.getvalue()) == FAKE_FILE_SIZE
+    assert session.calls["GetFile"] == 1 and session.calls["download"] == 1
+
+def test_percentile_picks_nearest_rank():
+    values = [i / 100 for i in range(1, 101)]
+    assert percentile(values, 50) == pytest.approx(0.5, abs=0.011)
+    assert percentile(values, 99) == pytest.approx(0.99, abs=0.011)
+    assert percentile([0.3], 95) == 0.3
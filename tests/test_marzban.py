@@ -1,6 +1,6 @@
 import pytest
 from unittest.mock import AsyncMock, patch
-from app.services.marzban_api import MarzbanAPI
+from app.services.marzban_api import MarzbanAPI, get_marzban_api
 
 @pytest.mark.asyncio
 async def test_marzban_auth_failure():
@@ -9,6 +9,7 @@ async def test_marzban_auth_failure():
         api = MarzbanAPI()
         token = await api._get_token()
         assert token is None
+        await api.close()
 
 @pytest.mark.asyncio
 async def test_marzban_create_user_success():
@@ -21,4 +22,189 @@ async def test_marzban_create_user_success():
         mocked_post.return_value.__aenter__.return_value.json = AsyncMock(return_value={"username": "testuser"})
         
         res = await api.create_user("testuser", 10, 123456789)
-        assert res["username"] == "testuser"
+        assert res.ok
+        assert res.data["username"] == "testuser"
+    await api.close()
+
+@pytest.mark.asyncio
+async def test_marzban_client_registry_shares_session():
+    api = get_marzban_api("http://pooled-host/")
+    assert get_marzban_api("http://pooled-host") is api
+    
+    session = await api.open()
+    assert await api.open() is session
+    
+    await api.close()
+    assert session.closed
+
+def test_marzban_client_registry_picks_up_new_credentials():
+    api = get_marzban_api("http://creds-host", "admin", "old")
+    api.token = "token-for-old-password"
+    # Пароль сменили в ServerAdmin, пул серверов перечитан
+    assert get_marzban_api("http://creds-host", "admin", "new") is api
+    assert (api.username, api.password, api.token) == ("admin", "new", None)
+
+    api.token = "token-for-new-password"
+    get_marzban_api("http://creds-host", "admin", "new")
+    assert api.token == "token-for-new-password"
+
+def _jwt(exp):
+    import base64, json
+    body = base64.urlsafe_b64encode(json.dumps({"exp": exp}).encode()).decode().rstrip("=")
+    return f"header.{body}.signature"
+
+@pytest.mark.asyncio
+async def test_marzban_token_refresh_is_single_flight():
+    import asyncio, time
+    api = MarzbanAPI()
+    calls = 0
+
+    async def fake_login():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        api.token = _jwt(int(time.time()) + 3600)
+        api.token_exp = int(time.time()) + 3600
+        return api.token
+
+    # Токен почти истек — должен обновиться один раз на всех
+    api.token = _jwt(int(time.time()) + 5)
+    api.token_exp = int(time.time()) + 5
+    with patch.object(api, "_get_token", side_effect=fake_login):
+        await asyncio.gather(*(api._ensure_token() for _ in range(20)))
+    assert calls == 1
+
+@pytest.mark.asyncio
+async def test_marzban_retries_once_on_401():
+    api = MarzbanAPI()
+    api.token = "stale_token"
+    api.host = "http://fakehost"
+
+    async def fake_login():
+        api.token = "fresh_token"
+        return api.token
+
+    with patch.object(api, "_get_token", side_effect=fake_login), \
+            patch('aiohttp.ClientSession.get') as mocked_get:
+        unauthorized = AsyncMock(status=401)
+        ok = AsyncMock(status=200)
+        ok.json = AsyncMock(return_value={"username": "testuser"})
+        mocked_get.return_value.__aenter__.side_effect = [unauthorized, ok]
+
+        res = await api.get_user("testuser")
+        assert res.data["username"] == "testuser"
+        assert mocked_get.call_count == 2
+        assert mocked_get.call_args.kwargs["headers"]["Authorization"] == "Bearer fresh_token"
+    await api.close()
+
+@pytest.mark.asyncio
+async def test_marzban_user_cache_coalesces_and_invalidates():
+    import asyncio
+    api = MarzbanAPI()
+    calls = 0
+
+    async def fake_request(method, path, **kwargs):
+        nonlocal calls
+        if method == "GET":
+            calls += 1
+            await asyncio.sleep(0.01)
+            return 200, {"username": "testuser", "expire": calls}
+        return 200, {"username": "testuser", "expire": 999}
+
+    with patch.object(api, "_request", side_effect=fake_request):
+        results = await asyncio.gather(*(api.get_user("testuser") for _ in range(10)))
+        assert calls == 1
+        assert all(r.data["expire"] == 1 for r in results)
+
+        assert (await api.get_user("testuser")).data["expire"] == 1
+        assert api.cache_stats()["misses"] == 1
+
+        # Запись обновляется ответом Marzban на изменение
+        assert await api.modify_user("testuser", {"status": "active"})
+        assert (await api.get_user("testuser")).data["expire"] == 999
+
+        assert await api.delete_user("testuser")
+        await api.get_user("testuser")
+        assert calls == 2
+
+        # Чтение перед продлением идет мимо кэша
+        assert (await api.get_user("testuser", fresh=True)).data["expire"] == 3
+        assert (await api.get_user("testuser")).data["expire"] == 3
+        assert calls == 3
+
+@pytest.mark.asyncio
+async def test_marzban_retries_idempotent_calls_then_opens_breaker(monkeypatch):
+    import aiohttp
+    from app.core.config import settings
+    monkeypatch.setattr(settings, "MARZBAN_RETRY_BASE_DELAY", 0)
+    monkeypatch.setattr(settings, "MARZBAN_BREAKER_THRESHOLD", 3)
+
+    api = MarzbanAPI()
+    calls = 0
+
+    async def flaky_request(method, path, **kwargs):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise aiohttp.ClientConnectionError("blip")
+        return 200, {"username": "testuser"}
+
+    with patch.object(api, "_request", side_effect=flaky_request):
+        res = await api.modify_user("testuser", {"status": "active"})
+    assert res.ok and calls == 2
+    assert api.breaker.state == "closed"
+
+    async def down_request(method, path, **kwargs):
+        raise aiohttp.ClientConnectionError("down")
+
+    with patch.object(api, "_request", side_effect=down_request) as mocked:
+        res = await api.delete_user("testuser")
+        assert res.error == "network"
+        assert api.breaker.state == "open"
+
+        # Пока панель лежит — отказ без сетевого запроса
+        mocked.reset_mock()
+        res = await api.get_user("testuser")
+        assert res.error == "circuit_open"
+        assert mocked.call_count == 0
+
+@pytest.mark.asyncio
+async def test_marzban_breaker_half_open_probe():
+    from app.services.marzban_api import CircuitBreaker
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+@pytest.mark.asyncio
+async def test_marzban_stops_when_update_deadline_is_spent():
+    from app.services.marzban_api import deadline_scope
+
+    api = MarzbanAPI()
+    with patch.object(api, "_request") as mocked:
+        with deadline_scope(0.1):
+            res = await api.modify_user("testuser", {"status": "active"})
+    assert res.error == "deadline"
+    assert mocked.call_count == 0
+
+@pytest.mark.asyncio
+async def test_marzban_request_timeout_is_capped_by_deadline():
+    import asyncio
+    from app.services.marzban_api import deadline_scope
+
+    api = MarzbanAPI()
+    seen = {}
+
+    async def slow_request(method, path, timeout=None, **kwargs):
+        seen["timeout"] = timeout
+        raise asyncio.TimeoutError()
+
+    with patch.object(api, "_request", side_effect=slow_request):
+        with deadline_scope(3):
+            res = await api.create_user("testuser", 0, 0)
+    assert res.error == "timeout"
+    assert seen["timeout"].total <= 3
@@ -0,0 +1,39 @@
+import pytest
+from sqlalchemy import text
+
+from app.core.db import build_engine
+from app.core.metrics import DB_QUERY_LATENCY, Histogram, Registry, track_job, JOB_DURATION
+
+def test_histogram_renders_cumulative_buckets():
+    registry = Registry()
+    hist = registry.register(Histogram("demo_seconds", "demo", ["op"], buckets=(0.1, 1)))
+    hist.observe("get", value=0.05)
+    hist.observe("get", value=0.5)
+    hist.observe("get", value=3)
+
+    body = registry.render()
+    assert 'demo_seconds_bucket{op="get",le="0.1"} 1' in body
+    assert 'demo_seconds_bucket{op="get",le="1"} 2' in body
+    assert 'demo_seconds_bucket{op="get",le="+Inf"} 3' in body
+    assert 'demo_seconds_count{op="get"} 3' in body
+    assert "# TYPE demo_seconds histogram" in body
+
+@pytest.mark.asyncio
+async def test_engine_records_query_latency(tmp_path):
+    engine = build_engine(f"sqlite+aiosqlite:///{tmp_path}/metrics.db")
+    before = DB_QUERY_LATENCY.values.get(("SELECT",), [[0], 0.0])[0][:]
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+    await engine.dispose()
+
+    assert sum(DB_QUERY_LATENCY.values[("SELECT",)][0]) > sum(before)
+
+@pytest.mark.asyncio
+async def test_track_job_sets_duration_even_on_error():
+    @track_job("broken_job")
+    async def broken():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        await broken()
+    assert ("broken_job",) in JOB_DURATION.values
@@ -0,0 +1,95 @@
+import pytest
+from datetime import datetime
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from aiogram import Bot, Dispatcher, Router, F, types
+
+from app.bot.middlewares import DbSessionMiddleware, HandlerNameMiddleware, session_stats
+
+def make_update(update_id, text_):
+    return types.Update.model_validate({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(datetime.now().timestamp()),
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "Test"},
+            "text": text_,
+        },
+    })
+
+@pytest.mark.asyncio
+async def test_lazy_session_opens_only_when_used(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/lazy.db")
+    factory = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+    router = Router()
+
+    @router.message(F.text == "help")
+    async def lazy_help(message: types.Message, session):
+        return "ok"
+
+    @router.message(F.text == "db")
+    async def lazy_db(message: types.Message, session):
+        await session.execute(text("SELECT 1"))
+        await session.execute(text("SELECT 2"))
+
+    dp = Dispatcher()
+    dp.update.outer_middleware(DbSessionMiddleware(factory))
+    dp.message.middleware(HandlerNameMiddleware())
+    dp.include_router(router)
+    bot = Bot(token="123456:TEST")
+
+    await dp.feed_update(bot, make_update(1, "help"))
+    await dp.feed_update(bot, make_update(2, "db"))
+
+    assert session_stats["lazy_help"] == {"updates": 1, "sessions": 0, "queries": 0}
+    assert session_stats["lazy_db"] == {"updates": 1, "sessions": 1, "queries": 2}
+    await bot.session.close()
+    await engine.dispose()
+
+@pytest.mark.asyncio
+async def test_throttling_sheds_flood_and_warns_once(monkeypatch):
+    from app.bot import middlewares
+    from app.bot.middlewares import ThrottlingMiddleware
+
+    notices = []
+    async def fake_send(bot, chat_id, text, **kwargs):
+        notices.append(chat_id)
+    monkeypatch.setattr(middlewares, "send_message", fake_send)
+
+    router = Router()
+    handled = []
+
+    @router.message(F.text == "👤 Профиль")
+    async def flood_profile(message: types.Message):
+        handled.append("profile")
+
+    @router.message(F.text == "help")
+    async def flood_help(message: types.Message):
+        handled.append("help")
+
+    throttling = ThrottlingMiddleware(
+        default=(0.001, 5), rates={"flood_profile": (0.001, 2)},
+        routes={"👤 Профиль": "flood_profile"}, notice_interval=60,
+    )
+    dp = Dispatcher()
+    dp.update.outer_middleware(throttling)
+    dp.include_router(router)
+    bot = Bot(token="123456:TEST")
+
+    for i in range(6):
+        await dp.feed_update(bot, make_update(100 + i, "👤 Профиль"))
+    # Корзина профиля пуста, остальные кнопки живут по своему лимиту
+    await dp.feed_update(bot, make_update(200, "help"))
+
+    assert handled == ["profile", "profile", "help"]
+    assert throttling.snapshot() == {"buckets": 2, "shed": {"flood_profile": 4}}
+    assert notices == [1]
+
+    # Простаивающие (полные) корзины выбрасываются при очередной чистке
+    for bucket in throttling.buckets.values():
+        bucket.tokens = bucket.capacity
+    throttling._sweep(throttling._swept + 1000)
+    assert throttling.buckets == {}
+    await bot.session.close()
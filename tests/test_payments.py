@@ -0,0 +1,105 @@
+import pytest
+from sqlalchemy import select
+
+from app.core.models import Plan, ProvisioningJob, Subscription, Transaction, User
+from app.services import payment_service
+from app.services.marzban_api import MarzbanResult
+
+DAY = 24 * 60 * 60
+
+class FakeApi:
+    def __init__(self):
+        self.users = {}
+        self.modified = []
+
+    async def get_user(self, username, fresh=False):
+        if username not in self.users:
+            return MarzbanResult(False, status=404, error="not_found")
+        return MarzbanResult(True, data=dict(self.users[username]), status=200)
+
+    async def modify_user(self, username, payload):
+        self.modified.append(username)
+        self.users[username] = payload
+        return MarzbanResult(True, data=payload, status=200)
+
+@pytest.mark.asyncio
+async def test_bulk_approve_reports_each_item(session_factory, fake_pool, monkeypatch):
+    api = FakeApi()
+    monkeypatch.setattr(payment_service, "server_pool", fake_pool(api))
+
+    async with session_factory() as session:
+        session.add(Plan(id=1, name="Месяц", price=500, duration_days=30))
+        session.add_all([User(telegram_id=1, username="alice"), User(telegram_id=2), User(telegram_id=3, username="carol")])
+        session.add(Subscription(user_id=1, status="expired"))
+        txs = [
+            Transaction(id=10, user_id=1, plan_id=1, amount=500, status="pending"),
+            Transaction(id=11, user_id=1, plan_id=1, amount=500, status="pending"),
+            Transaction(id=12, user_id=2, plan_id=1, amount=500, status="success"),
+            Transaction(id=13, user_id=3, plan_id=1, amount=500, status="pending"),
+            Transaction(id=14, user_id=3, plan_id=1, amount=500, status="rejected"),
+        ]
+        session.add_all(txs)
+        session.add_all([
+            ProvisioningJob(transaction_id=12, user_id=2, username="user_2", plan_id=1, status="done"),
+            ProvisioningJob(transaction_id=13, user_id=3, username="carol", plan_id=1, status="processing"),
+        ])
+        await session.commit()
+
+    async with session_factory() as session:
+        results = await payment_service.approve_payments(session, [10, 11, 12, 13, 14, 99])
+
+    assert {tx_id: ok for tx_id, (ok, _) in results.items()} == {10: True, 11: True, 12: True, 13: False, 14: False, 99: False}
+    # Два платежа одного юзера складываются, а не перетирают друг друга
+    assert api.modified == ["alice", "alice"]
+    assert api.users["alice"]["expire"] - payment_service.time.time() > 59 * DAY
+    # Выданный воркером платеж только подтверждается, Marzban не трогаем
+    assert "user_2" not in api.users
+
+    async with session_factory() as session:
+        statuses = dict((await session.execute(select(Transaction.id, Transaction.status))).all())
+        sub = (await session.execute(select(Subscription).where(Subscription.user_id == 1))).scalar_one()
+    assert statuses == {10: "approved", 11: "approved", 12: "approved", 13: "pending", 14: "rejected"}
+    assert sub.status == "active"
+
+    async with session_factory() as session:
+        rejected = await payment_service.reject_payments(session, [13, 10])
+    assert rejected == {13: (True, "Отклонено"), 10: (False, "Уже обработана (approved)")}
+
+@pytest.mark.asyncio
+async def test_single_approve_does_not_extend_twice(session_factory, fake_pool, monkeypatch):
+    api = FakeApi()
+    monkeypatch.setattr(payment_service, "server_pool", fake_pool(api))
+
+    async with session_factory() as session:
+        session.add(Plan(id=1, name="Месяц", price=500, duration_days=30))
+        session.add(User(telegram_id=1, username="alice"))
+        session.add(Transaction(id=10, user_id=1, plan_id=1, amount=500, status="success"))
+        session.add(ProvisioningJob(transaction_id=10, user_id=1, username="alice", plan_id=1, status="done"))
+        await session.commit()
+
+    # Доступ уже выдал воркер outbox: одобрение только подтверждает платеж
+    async with session_factory() as session:
+        assert await payment_service.approve_payment(session, 10) == (True, "Успешно")
+    # Повторное нажатие 'Одобрить' на обработанном платеже
+    async with session_factory() as session:
+        assert await payment_service.approve_payment(session, 10) == (False, "Уже обработана (approved)")
+    assert api.modified == []
+
+@pytest.mark.asyncio
+async def test_approve_extends_stored_marzban_login(session_factory, fake_pool, monkeypatch):
+    api = FakeApi()
+    api.users["alice"] = {"expire": int(payment_service.time.time()) + DAY}
+    monkeypatch.setattr(payment_service, "server_pool", fake_pool(api))
+
+    async with session_factory() as session:
+        session.add(Plan(id=1, name="Месяц", price=500, duration_days=30))
+        # Аккаунт выдан под ником alice, потом юзер сменил ник
+        session.add(User(telegram_id=1, username="alice_new"))
+        session.add(Subscription(user_id=1, marzban_username="alice", status="active"))
+        session.add(Transaction(id=10, user_id=1, plan_id=1, amount=500, status="pending"))
+        await session.commit()
+
+    async with session_factory() as session:
+        assert await payment_service.approve_payment(session, 10) == (True, "Успешно")
+    assert api.modified == ["alice"]
+    assert api.users["alice"]["expire"] - payment_service.time.time() > 30 * DAY
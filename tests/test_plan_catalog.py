@@ -0,0 +1,27 @@
+import pytest
+
+from app.core.models import Plan
+from app.services.plan_catalog import PlanCatalog
+
+@pytest.mark.asyncio
+async def test_plan_catalog_builds_keyboard_from_active_plans(session_factory):
+    async with session_factory() as session:
+        session.add_all([
+            Plan(name="Год", price=5000, duration_days=365, is_active=True),
+            Plan(name="Тест", price=0, duration_days=1, is_active=True),
+            Plan(name="Архив", price=100, duration_days=30, is_active=False),
+        ])
+        await session.commit()
+
+    catalog = PlanCatalog(session_factory=session_factory)
+    await catalog.ensure_loaded()
+
+    assert [p.name for p in catalog.active_plans] == ["Тест", "Год"]
+    buttons = [b.text for row in catalog.keyboard.inline_keyboard for b in row]
+    assert buttons == ["Тест — БЕСПЛАТНО", "Год — 5000₽"]
+    # Неактивный тариф не в магазине, но по id доступен (чек мог прийти после отключения)
+    assert catalog.get(3).name == "Архив"
+
+    version = catalog.version
+    await catalog.ensure_loaded()
+    assert catalog.version == version
@@ -0,0 +1,54 @@
+import asyncio
+import pytest
+from unittest.mock import AsyncMock
+from sqlalchemy import select
+
+from app.core.models import Plan, ProvisioningJob, Subscription, Transaction
+from app.services.marzban_api import MarzbanResult
+from app.services.plan_catalog import PlanCatalog
+from app.services.provisioning import ProvisioningWorker, enqueue_provisioning
+
+@pytest.mark.asyncio
+async def test_provisioning_retries_without_adding_days_twice(session_factory, fake_pool):
+    async with session_factory() as session:
+        session.add(Plan(id=1, name="Месяц", price=500, duration_days=30))
+        tx = Transaction(user_id=42, plan_id=1, amount=500, status="pending")
+        session.add(tx)
+        await session.flush()
+        enqueue_provisioning(session, 42, "nick", 1, transaction_id=tx.id)
+        await session.commit()
+
+    api = AsyncMock()
+    api.get_user.return_value = MarzbanResult(False, status=404, error="not_found")
+    api.create_user.side_effect = [
+        MarzbanResult(False, error="network"),
+        MarzbanResult(True, data={"subscription_url": "https://sub/nick", "links": ["vless://key"]}),
+    ]
+
+    worker = ProvisioningWorker(session_factory=session_factory)
+    worker.servers = fake_pool(api, server_id=7)
+    worker.plans = PlanCatalog(session_factory=session_factory)
+    worker._semaphore = asyncio.Semaphore(1)
+
+    # Первая попытка падает — заявка вернется в очередь с зафиксированной датой
+    assert await worker.poll_once() == 1
+    await asyncio.gather(*worker._tasks)
+    async with session_factory() as session:
+        job = (await session.execute(select(ProvisioningJob))).scalar_one()
+        assert job.status == "pending" and job.attempts == 1 and job.expire_ts
+        job.next_attempt_at = job.created_at
+        await session.commit()
+    first_expire = job.expire_ts
+
+    assert await worker.poll_once() == 1
+    await asyncio.gather(*worker._tasks)
+
+    assert api.get_user.call_count == 1
+    assert api.create_user.call_args.kwargs["expire"] == first_expire
+    async with session_factory() as session:
+        job = (await session.execute(select(ProvisioningJob))).scalar_one()
+        sub = (await session.execute(select(Subscription))).scalar_one()
+        tx = (await session.execute(select(Transaction))).scalar_one()
+    assert job.status == "done"
+    assert sub.server_id == 7 and sub.marzban_key == "https://sub/nick"
+    assert tx.status == "success"
@@ -0,0 +1,54 @@
+import pytest
+from types import SimpleNamespace
+
+from app.bot import qr
+from app.core.models import Subscription
+from app.core.repository import renew_subscription
+
+def test_render_qr_is_png():
+    assert qr.render_qr("https://panel.example/sub/abc").startswith(b"\x89PNG")
+
+@pytest.mark.asyncio
+async def test_qr_is_rendered_once_per_key(session_factory, monkeypatch):
+    rendered, sent = [], []
+    render = qr.render_qr
+
+    def counting_render(data):
+        rendered.append(data)
+        return render(data)
+
+    async def fake_send_photo(bot, chat_id, photo, **kwargs):
+        sent.append(photo if isinstance(photo, str) else "upload")
+        file_id = photo if isinstance(photo, str) else f"file_{len(sent)}"
+        return SimpleNamespace(photo=[SimpleNamespace(file_id=file_id)])
+
+    monkeypatch.setattr(qr, "render_qr", counting_render)
+    monkeypatch.setattr(qr, "send_photo", fake_send_photo)
+
+    async def show_profile():
+        async with session_factory() as session:
+            sub = await session.get(Subscription, sub_id)
+            await qr.send_key_qr(None, session, 1, sub)
+
+    async with session_factory() as session:
+        sub_id = (await renew_subscription(session, 1, marzban_key="https://k/1", status="active")).id
+        await session.commit()
+
+    await show_profile()
+    await show_profile()
+    assert rendered == ["https://k/1"]
+    assert sent == ["upload", "file_1"]
+
+    # Продление с тем же ключом кэш не сбрасывает, новый ключ — сбрасывает
+    async with session_factory() as session:
+        await renew_subscription(session, 1, marzban_key="https://k/1", status="active")
+        await session.commit()
+    await show_profile()
+    async with session_factory() as session:
+        await renew_subscription(session, 1, marzban_key="https://k/2", status="active")
+        await session.commit()
+    await show_profile()
+    await show_profile()
+
+    assert rendered == ["https://k/1", "https://k/2"]
+    assert sent == ["upload", "file_1", "file_1", "upload", "file_4"]
@@ -0,0 +1,66 @@
+import pytest
+from datetime import datetime
+from sqlalchemy import event, func, select
+
+from app.core.models import Plan, ProvisioningJob, Subscription, Transaction, User
+from app.core.repository import get_user_overview, latest_subscription, load_transactions, register_user, renew_subscription
+
+def count_statements(engine):
+    statements = []
+    event.listen(engine.sync_engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    return statements
+
+@pytest.mark.asyncio
+async def test_register_user_inserts_once(session_factory):
+    async with session_factory() as session:
+        assert await register_user(session, 1, "alice", "Alice")
+        assert not await register_user(session, 1, "alice_new", "Alice")
+        await session.commit()
+        users = (await session.execute(select(User))).scalars().all()
+    assert [(u.telegram_id, u.username) for u in users] == [(1, "alice")]
+
+@pytest.mark.asyncio
+async def test_renew_subscription_updates_latest_row(session_factory):
+    async with session_factory() as session:
+        first = await renew_subscription(session, 1, plan_id=1, server_id=None, marzban_key="k1", status="active")
+        # Старая история: у юзера 2 две подписки, продлевается только последняя
+        session.add_all([Subscription(user_id=2, status="expired"), Subscription(user_id=2, status="expired")])
+        await session.commit()
+
+        renewed = await renew_subscription(session, 1, marzban_key="k2", expire_date=datetime(2030, 1, 1))
+        other = await renew_subscription(session, 2, status="active")
+        await session.commit()
+
+        assert renewed.id == first.id
+        assert (renewed.plan_id, renewed.marzban_key, renewed.expire_date) == (1, "k2", datetime(2030, 1, 1))
+        assert other.id == (await latest_subscription(session, 2)).id
+        statuses = (await session.execute(select(Subscription.status).where(Subscription.user_id == 2).order_by(Subscription.id))).scalars().all()
+        assert statuses == ["expired", "active"]
+        assert await session.scalar(select(func.count()).select_from(Subscription)) == 3
+
+@pytest.mark.asyncio
+async def test_joined_lookups_take_one_statement(engine, session_factory):
+    async with session_factory() as session:
+        session.add_all([
+            Plan(id=1, name="Месяц", price=500, duration_days=30),
+            User(telegram_id=1, username="alice"),
+            Subscription(user_id=1, plan_id=1, status="expired"),
+            Subscription(user_id=1, plan_id=1, status="active"),
+            Transaction(id=10, user_id=1, plan_id=1, amount=500, status="pending"),
+            Transaction(id=11, user_id=2, plan_id=None, amount=100, status="pending"),
+            ProvisioningJob(user_id=1, username="alice", plan_id=1, transaction_id=10),
+        ])
+        await session.commit()
+
+    statements = count_statements(engine)
+    async with session_factory() as session:
+        user, sub, plan = await get_user_overview(session, 1)
+        assert (user.username, sub.status, plan.name) == ("alice", "active", "Месяц")
+        assert len(statements) == 1
+
+        bundles = {b.transaction.id: b for b in await load_transactions(session, [10, 11])}
+        assert len(statements) == 2
+        assert bundles[10].subscription is sub and bundles[10].job.transaction_id == 10
+        assert (bundles[11].plan, bundles[11].user, bundles[11].subscription, bundles[11].job) == (None, None, None, None)
+
+        assert await get_user_overview(session, 99) == (None, None, None)
@@ -0,0 +1,70 @@
+import pytest
+import pytest_asyncio
+from datetime import datetime
+from sqlalchemy import func, select, inspect, text
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.core.models import Transaction
+from app.core.migrations import run_migrations, MIGRATIONS
+from app.core.repository import latest_subscription_query, transactions_query, user_overview_query
+from app.services.expiry_service import expired_batch_query
+
+# Горячие запросы — из тех же построителей, что выполняет код
+HOT_QUERIES = {
+    "latest_subscription": latest_subscription_query(1),
+    "user_overview": user_overview_query(1),
+    "transactions": transactions_query([1, 2]),
+    "expired_sweep": expired_batch_query(datetime(2030, 1, 1), 0, 200),
+}
+
+@pytest_asyncio.fixture
+async def engine(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/schema.db")
+    yield engine
+    await engine.dispose()
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("name", HOT_QUERIES)
+async def test_hot_queries_use_indexes(engine, name):
+    await run_migrations(engine)
+    compiled = HOT_QUERIES[name].compile(dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True})
+    async with engine.connect() as conn:
+        plan = (await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}")).all()
+    details = [row[-1] for row in plan]
+    # Только поиск по индексу: SCAN … USING INDEX — тоже полный проход
+    assert any(d.startswith("SEARCH") for d in details), details
+    assert not any(d.startswith("SCAN") for d in details), details
+
+@pytest.mark.asyncio
+async def test_migrations_add_indexes_to_existing_db(engine):
+    # База "старой" версии: таблица без индексов
+    async with engine.begin() as conn:
+        await conn.execute(text(
+            "CREATE TABLE subscriptions (id INTEGER PRIMARY KEY, user_id BIGINT NOT NULL, plan_id INTEGER, "
+            "marzban_key VARCHAR, status VARCHAR, expire_date DATETIME)"
+        ))
+        await conn.execute(text("INSERT INTO subscriptions (user_id, status) VALUES (5, 'active')"))
+
+    assert await run_migrations(engine) == [v for v, _, _ in MIGRATIONS]
+    assert await run_migrations(engine) == []
+
+    async with engine.connect() as conn:
+        indexes = await conn.run_sync(lambda c: {i["name"] for i in inspect(c).get_indexes("subscriptions")})
+    assert {"ix_subscriptions_user_id_id", "ix_subscriptions_status_expire_date"} <= indexes
+    async with engine.connect() as conn:
+        columns = await conn.run_sync(lambda c: {col["name"] for col in inspect(c).get_columns("subscriptions")})
+    assert {"server_id", "qr_file_id", "qr_key", "marzban_username"} <= columns
+    async with engine.connect() as conn:
+        # Старая подписка без ника в users — логин user_ID, как его выдавал бот
+        assert (await conn.execute(text("SELECT marzban_username FROM subscriptions"))).scalar() == "user_5"
+
+@pytest.mark.asyncio
+async def test_pending_transactions_count_uses_partial_index(engine):
+    # /metrics считает pending на каждом скрейпе — без прохода по всей истории платежей
+    await run_migrations(engine)
+    query = select(func.count()).select_from(Transaction).where(Transaction.status == "pending")
+    compiled = query.compile(dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True})
+    async with engine.connect() as conn:
+        plan = (await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}")).all()
+    assert any("ix_transactions_pending" in row[-1] for row in plan), plan
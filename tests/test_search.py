@@ -0,0 +1,54 @@
+import pytest
+from sqlalchemy import select, text, update
+
+from app.core.migrations import run_migrations
+from app.core.models import Transaction, User
+from app.core.search import FTS5_AVAILABLE, fts_query, transaction_filter, user_filter
+
+pytestmark = pytest.mark.skipif(not FTS5_AVAILABLE, reason="SQLite без FTS5")
+
+def test_fts_query_prefixes_every_word():
+    assert fts_query("Ivan_Pet") == '"ivan"* "pet"*'
+    assert fts_query(" %_ ") is None
+
+@pytest.mark.asyncio
+async def test_admin_search_uses_fts_index_and_follows_writes(engine, session_factory):
+    async with engine.begin() as conn:
+        # Юзер из базы до миграции попадает в индекс через rebuild
+        await conn.execute(text("INSERT INTO users (telegram_id, username, full_name) VALUES (111, 'old_timer', 'Старый Клиент')"))
+    await run_migrations(engine)
+
+    async with session_factory() as session:
+        session.add_all([
+            User(telegram_id=222, username="ivan_petrov", full_name="Иван Петров"),
+            User(telegram_id=333, username=None, full_name="Мария Сидорова"),
+        ])
+        session.add_all([
+            Transaction(user_id=222, amount=500, status="pending"),
+            Transaction(user_id=333, amount=500, status="success"),
+        ])
+        await session.commit()
+
+        async def users(term):
+            rows = await session.execute(select(User.telegram_id).where(user_filter("sqlite", term)))
+            return sorted(rows.scalars())
+
+        assert await users("петр") == [222]
+        assert await users("клиент") == [111]
+        assert await users("ivan_pe") == [222]
+        assert await users("333") == [333]
+
+        # Триггер на UPDATE переиндексирует имя
+        await session.execute(update(User).where(User.telegram_id == 333).values(full_name="Мария Иванова"))
+        await session.commit()
+        assert await users("сидор") == []
+        assert await users("иванова") == [333]
+
+        txs = await session.execute(select(Transaction.user_id).where(transaction_filter("sqlite", "мария")))
+        assert list(txs.scalars()) == [333]
+
+        stmt = select(User.id).where(user_filter("sqlite", "петр"))
+        sql = str(stmt.compile(engine.sync_engine, compile_kwargs={"literal_binds": True}))
+        details = [row[-1] for row in (await session.execute(text(f"EXPLAIN QUERY PLAN {sql}"))).all()]
+        assert any("users_fts VIRTUAL TABLE INDEX" in d for d in details)
+        assert "SCAN users" not in details, details
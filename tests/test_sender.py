@@ -0,0 +1,85 @@
+import asyncio
+import pytest
+from unittest.mock import MagicMock
+from aiogram.exceptions import TelegramRetryAfter
+
+from app.bot.sender import SendScheduler, INTERACTIVE, BULK
+
+@pytest.mark.asyncio
+async def test_sender_retries_after_flood_wait():
+    scheduler = SendScheduler()
+    attempts = 0
+
+    async def flaky_send():
+        nonlocal attempts
+        attempts += 1
+        if attempts == 1:
+            raise TelegramRetryAfter(method=MagicMock(), message="Flood", retry_after=0)
+        return "sent"
+
+    assert await scheduler.submit(1, flaky_send) == "sent"
+    assert attempts == 2
+    assert scheduler.retry_after_count == 1
+    await scheduler.stop()
+
+@pytest.mark.asyncio
+async def test_sender_sends_interactive_before_bulk():
+    scheduler = SendScheduler()
+    order = []
+
+    def make(tag):
+        async def send():
+            order.append(tag)
+        return send
+
+    # enqueue синхронный: вся очередь собирается до того, как воркеры проснутся
+    futures = [scheduler.enqueue(chat_id, make(f"bulk{chat_id}"), BULK) for chat_id in range(20)]
+    futures.append(scheduler.enqueue(100, make("reply"), INTERACTIVE))
+
+    await asyncio.gather(*futures)
+    assert order[0] == "reply"
+    await scheduler.stop()
+
+@pytest.mark.asyncio
+async def test_sender_pauses_whole_bot_on_flood_from_idle_chat():
+    scheduler = SendScheduler()
+    flooded = asyncio.Event()
+
+    async def flood():
+        flooded.set()
+        raise TelegramRetryAfter(method=MagicMock(), message="Flood", retry_after=30)
+
+    async def chatty():
+        return "sent"
+
+    # Чат 1 уже писал — его RetryAfter только его и касается
+    await scheduler.submit(1, chatty)
+    scheduler.enqueue(1, flood)
+    await flooded.wait()
+    await asyncio.sleep(0.01)
+    assert scheduler.chat_buckets[1].delay() > 0 and scheduler.global_bucket.delay() == 0
+
+    # Молчавший чат получил RetryAfter — лимит общий, стоят все чаты
+    flooded.clear()
+    scheduler.enqueue(2, flood)
+    await flooded.wait()
+    await asyncio.sleep(0.01)
+    assert scheduler.global_bucket.delay() > 25
+    await scheduler.stop()
+
+@pytest.mark.asyncio
+async def test_sender_gives_up_after_max_retries(monkeypatch):
+    from app.core.config import settings
+    monkeypatch.setattr(settings, "TG_SEND_MAX_RETRIES", 2)
+    scheduler = SendScheduler()
+    attempts = 0
+
+    async def always_flood():
+        nonlocal attempts
+        attempts += 1
+        raise TelegramRetryAfter(method=MagicMock(), message="Flood", retry_after=0)
+
+    with pytest.raises(TelegramRetryAfter):
+        await scheduler.submit(1, always_flood)
+    assert attempts == 3
+    await scheduler.stop()
@@ -0,0 +1,29 @@
+import pytest
+
+from app.core.models import Server, Subscription
+from app.services.server_pool import ServerPool
+
+@pytest.mark.asyncio
+async def test_server_pool_places_by_weighted_load(session_factory):
+    async with session_factory() as session:
+        session.add_all([
+            Server(id=1, name="A", host_url="http://node-a", weight=1),
+            Server(id=2, name="B", host_url="http://node-b", weight=3),
+            Server(id=3, name="Off", host_url="http://node-off", is_active=False),
+            Subscription(user_id=100, server_id=2, status="active"),
+        ])
+        await session.commit()
+
+    pool = ServerPool(session_factory=session_factory)
+    await pool.reload()
+
+    placed = [pool.place_new_user()[0] for _ in range(8)]
+    # B весит втрое больше A: итоговая нагрузка 7 против 2 (один юзер на B уже был)
+    assert placed.count(2) == 6 and placed.count(1) == 2
+    assert 3 not in placed
+
+    async with session_factory() as session:
+        sub, server_id, api = await pool.api_for_user(session, 100)
+    assert sub.user_id == 100 and server_id == 2
+    assert api.host == "http://node-b"
+    assert pool.api_for(2) is api
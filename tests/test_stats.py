@@ -0,0 +1,75 @@
+import pytest
+from datetime import datetime
+from sqlalchemy import select, text
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+
+from app.core.db import Base
+from app.core.migrations import run_migrations
+from app.core.models import DailyActivity, DailyRevenue, Plan, Transaction
+from app.services.stats_service import active_by_plan_query, dashboard, record_activity, record_transaction, set_transaction_status
+
+async def buckets(factory):
+    async with factory() as session:
+        rows = (await session.execute(select(DailyRevenue))).scalars().all()
+    return {row.status: (row.count, row.amount) for row in rows}
+
+@pytest.mark.asyncio
+async def test_status_changes_move_revenue_between_buckets(session_factory):
+    async with session_factory() as session:
+        session.add(Plan(id=1, name="Месяц", price=500, duration_days=30))
+        tx = Transaction(user_id=1, plan_id=1, amount=500, status="pending", created_at=datetime.utcnow())
+        session.add(tx)
+        await session.flush()
+        await record_transaction(session, tx, None, "pending")
+        await record_activity(session, "new_users")
+        await session.commit()
+
+    # Воркер выдал доступ, пока у админа открыт старый снимок платежа
+    async with session_factory() as admin, session_factory() as worker:
+        stale = await admin.get(Transaction, tx.id)
+        fresh = await worker.get(Transaction, tx.id)
+        assert await set_transaction_status(worker, fresh, "success", only_from=("pending",))
+        await worker.commit()
+
+        assert not await set_transaction_status(admin, stale, "success", only_from=("pending",))
+        # Отказ перечитывает статус и переносит платеж из success, а не из pending
+        assert await set_transaction_status(admin, stale, "failed")
+        await admin.commit()
+
+    assert await buckets(session_factory) == {"pending": (0, 0), "success": (0, 0), "failed": (1, 500)}
+
+    async with session_factory() as session:
+        data = await dashboard(session)
+    assert data["month"]["rejected"] == 1 and data["month"]["revenue"] == 0
+    assert data["daily"][0]["new_users"] == 1
+
+@pytest.mark.asyncio
+async def test_migration_backfills_rollups_from_existing_rows(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/old.db")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(text(
+            "INSERT INTO transactions (user_id, plan_id, amount, status, created_at) VALUES "
+            "(1, 1, 500, 'success', '2024-05-01 10:00:00'), (2, 1, 500, 'success', '2024-05-01 12:00:00'), "
+            "(3, NULL, 100, 'failed', '2024-05-02 09:00:00')"
+        ))
+        await conn.execute(text("INSERT INTO users (telegram_id, created_at) VALUES (1, '2024-05-01 08:00:00')"))
+
+    await run_migrations(engine)
+
+    factory = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    async with factory() as session:
+        revenue = {(r.day.isoformat(), r.plan_id, r.status): (r.count, r.amount) for r in (await session.execute(select(DailyRevenue))).scalars()}
+        activity = (await session.execute(select(DailyActivity))).scalars().all()
+    assert revenue == {("2024-05-01", 1, "success"): (2, 1000), ("2024-05-02", 0, "failed"): (1, 100)}
+    assert [(a.day.isoformat(), a.new_users) for a in activity] == [("2024-05-01", 1)]
+    await engine.dispose()
+
+@pytest.mark.asyncio
+async def test_active_by_plan_reads_only_the_covering_index(engine):
+    # Счет на каждом открытии страницы — без чтения самих подписок и без сортировки
+    compiled = active_by_plan_query().compile(dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True})
+    async with engine.connect() as conn:
+        plan = [row[-1] for row in (await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}")).all()]
+    assert plan == ["SEARCH subscriptions USING COVERING INDEX ix_subscriptions_status_plan_id (status=?)"], plan
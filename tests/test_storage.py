@@ -0,0 +1,66 @@
+import pytest
+from datetime import datetime, timedelta
+from sqlalchemy import update
+from aiogram.fsm.storage.base import StorageKey
+
+from app.core.models import FSMRecord
+from app.bot.handlers import PaymentStates
+from app.bot.storage import SQLAlchemyStorage
+
+KEY = StorageKey(bot_id=1, chat_id=42, user_id=42)
+
+@pytest.mark.asyncio
+async def test_fsm_storage_survives_restart_and_expires(session_factory):
+    storage = SQLAlchemyStorage(session_factory=session_factory)
+    await storage.set_state(KEY, PaymentStates.waiting_for_receipt)
+    await storage.update_data(KEY, {"plan_id": 2, "amount": 500})
+    await storage.close()
+
+    # "Перезапуск": новый экземпляр читает из таблицы
+    restarted = SQLAlchemyStorage(session_factory=session_factory)
+    assert await restarted.get_state(KEY) == PaymentStates.waiting_for_receipt.state
+    assert await restarted.get_data(KEY) == {"plan_id": 2, "amount": 500}
+
+    # Брошенное состояние старше TTL не возвращается и вычищается
+    async with session_factory() as session:
+        await session.execute(update(FSMRecord).values(updated_at=datetime.utcnow() - timedelta(days=7)))
+        await session.commit()
+    stale = SQLAlchemyStorage(session_factory=session_factory)
+    assert await stale.get_state(KEY) is None
+    await stale.purge_expired()
+    async with session_factory() as session:
+        assert await session.get(FSMRecord, stale._key(KEY)) is None
+
+    await restarted.close()
+    await stale.close()
+
+@pytest.mark.asyncio
+async def test_fsm_storage_clear_deletes_row(session_factory):
+    storage = SQLAlchemyStorage(session_factory=session_factory)
+    await storage.set_state(KEY, PaymentStates.waiting_for_receipt)
+    await storage.flush()
+    await storage.set_state(KEY, None)
+    await storage.set_data(KEY, {})
+    await storage.close()
+
+    async with session_factory() as session:
+        assert await session.get(FSMRecord, storage._key(KEY)) is None
+
+@pytest.mark.asyncio
+async def test_fsm_storage_shared_between_replicas(session_factory):
+    first = SQLAlchemyStorage(session_factory=session_factory, shared=True)
+    second = SQLAlchemyStorage(session_factory=session_factory, shared=True)
+    # Первая реплика уже видела юзера без состояния
+    assert await first.get_state(KEY) is None
+
+    # Покупку начала вторая, чек пришел на первую
+    await second.set_state(KEY, PaymentStates.waiting_for_receipt)
+    await second.update_data(KEY, {"plan_id": 2})
+    assert await first.get_state(KEY) == PaymentStates.waiting_for_receipt.state
+    assert await first.get_data(KEY) == {"plan_id": 2}
+
+    await first.set_state(KEY, None)
+    assert await second.get_state(KEY) is None
+
+    await first.close()
+    await second.close()
@@ -0,0 +1,105 @@
+import pytest
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock
+from sqlalchemy import select
+
+from app.core.models import DailyActivity, Subscription, SyncCheckpoint, User
+from app.services.expiry_service import sweep_expired_subscriptions
+from app.services.marzban_api import MarzbanResult
+from app.services.sync_service import sync_marzban_users
+
+class FakeApi:
+    def __init__(self, users):
+        self.users = users
+        self.pages = []
+
+    async def list_users(self, offset=0, limit=500):
+        self.pages.append(offset)
+        return MarzbanResult(True, data={"users": self.users[offset:offset + limit], "total": len(self.users)}, status=200)
+
+@pytest.mark.asyncio
+async def test_sync_updates_only_drifted_rows_and_resumes_from_checkpoint(session_factory, fake_pool, monkeypatch):
+    from app.core.config import settings
+    monkeypatch.setattr(settings, "MARZBAN_SYNC_PAGE_SIZE", 2)
+    monkeypatch.setattr(settings, "MARZBAN_SYNC_MAX_PAGES", 1)
+
+    old = datetime.fromtimestamp(1_700_000_000)
+    new_ts = 1_800_000_000
+    async with session_factory() as session:
+        session.add(User(telegram_id=1, username="alice"))
+        session.add_all([
+            Subscription(user_id=1, marzban_username="alice", status="active", expire_date=old, marzban_key="http://m/sub/alice"),
+            Subscription(user_id=2, status="active", expire_date=old, marzban_key="http://m/sub/user_2"),
+            Subscription(user_id=3, status="expired", expire_date=old, marzban_key="http://m/sub/user_3"),
+        ])
+        await session.commit()
+
+    api = FakeApi([
+        # Продлили в панели мимо бота
+        {"username": "alice", "status": "active", "expire": new_ts, "subscription_url": "http://m/sub/alice"},
+        # Совпадает с БД — не пишем
+        {"username": "user_2", "status": "active", "expire": 1_700_000_000, "subscription_url": "http://m/sub/user_2"},
+        # Продлен в панели после истечения — оживляем
+        {"username": "user_3", "status": "active", "expire": new_ts, "subscription_url": "http://m/sub/user_3"},
+        {"username": "stranger", "status": "active", "expire": None, "subscription_url": ""},
+    ])
+    pool = fake_pool(api)
+
+    first = await sync_marzban_users(pool, session_factory=session_factory)
+    assert first == {"pages": 1, "seen": 2, "changed": 1, "unknown": 0}
+    async with session_factory() as session:
+        assert (await session.get(SyncCheckpoint, "marzban_users:default")).next_offset == 2
+
+    second = await sync_marzban_users(pool, session_factory=session_factory)
+    assert second == {"pages": 1, "seen": 2, "changed": 1, "unknown": 1}
+    assert api.pages == [0, 2]
+
+    async with session_factory() as session:
+        rows = {r.user_id: r for r in (await session.execute(select(Subscription))).scalars()}
+        checkpoint = await session.get(SyncCheckpoint, "marzban_users:default")
+    assert rows[1].expire_date == datetime.fromtimestamp(new_ts)
+    assert rows[2].status == "active"
+    assert rows[3].status == "active" and rows[3].expire_date == datetime.fromtimestamp(new_ts)
+    # Страница короче лимита — полный проход завершен, начинаем сначала
+    assert checkpoint.next_offset == 0 and checkpoint.last_full_sync_at is not None
+
+@pytest.mark.asyncio
+async def test_sync_leaves_expiry_to_the_sweep(session_factory, fake_pool):
+    past = datetime.utcnow().replace(microsecond=0) - timedelta(hours=2)
+    async with session_factory() as session:
+        session.add(Subscription(user_id=1, status="active", expire_date=past, marzban_key="http://m/sub/user_1"))
+        await session.commit()
+
+    # Marzban сам перевел юзера в expired раньше почасовой проверки
+    api = FakeApi([{"username": "user_1", "status": "expired", "expire": int(past.timestamp()), "subscription_url": "http://m/sub/user_1"}])
+    api.modify_user = AsyncMock(return_value=MarzbanResult(True, {}))
+    await sync_marzban_users(fake_pool(api), session_factory=session_factory)
+    async with session_factory() as session:
+        assert (await session.execute(select(Subscription.status))).scalar() == "active"
+
+    bot = AsyncMock()
+    await sweep_expired_subscriptions(fake_pool(api), bot, session_factory=session_factory)
+    async with session_factory() as session:
+        assert (await session.execute(select(Subscription.status))).scalar() == "expired"
+        assert (await session.execute(select(DailyActivity.expirations))).scalar() == 1
+    assert [c.kwargs["chat_id"] for c in bot.send_message.call_args_list] == [1]
+
+@pytest.mark.asyncio
+async def test_sync_matches_only_stored_marzban_login(session_factory, fake_pool):
+    old = datetime.fromtimestamp(1_700_000_000)
+    async with session_factory() as session:
+        # B выдан под ником bob; A потом взял себе ник bob
+        session.add_all([User(telegram_id=1, username="bob_new"), User(telegram_id=2, username="bob")])
+        session.add_all([
+            Subscription(user_id=1, marzban_username="bob", status="active", expire_date=old, marzban_key="http://m/sub/bob"),
+            Subscription(user_id=2, marzban_username="alice", status="active", expire_date=old, marzban_key="http://m/sub/alice"),
+        ])
+        await session.commit()
+
+    api = FakeApi([{"username": "bob", "status": "active", "expire": 1_800_000_000, "subscription_url": "http://m/sub/bob2"}])
+    await sync_marzban_users(fake_pool(api), session_factory=session_factory)
+
+    async with session_factory() as session:
+        rows = {r.user_id: r for r in (await session.execute(select(Subscription))).scalars()}
+    assert rows[2].expire_date == old and rows[2].marzban_key == "http://m/sub/alice"
+    assert rows[1].marzban_key == "http://m/sub/bob2"
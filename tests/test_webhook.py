@@ -0,0 +1,53 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from app.core.config import settings
+
+UPDATE = {
+    "update_id": 1,
+    "message": {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}, "text": "/start"},
+}
+
+@pytest.fixture
+def client(monkeypatch):
+    fed = []
+
+    async def feed_update(bot, update):
+        fed.append(update.update_id)
+        if update.update_id == 2:
+            raise RuntimeError("handler failed")
+
+    monkeypatch.setattr(main.dp, "feed_update", feed_update)
+    monkeypatch.setattr(settings, "BOT_MODE", "webhook")
+    monkeypatch.setattr(settings, "WEBHOOK_SECRET", "s3cret")
+    # Без with: lifespan (БД, Marzban, Telegram) не запускается
+    client = TestClient(main.app)
+    client.fed = fed
+    return client
+
+def test_webhook_rejects_wrong_secret(client):
+    res = client.post(settings.WEBHOOK_PATH, json=UPDATE, headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+    assert res.status_code == 403
+    assert client.fed == []
+
+def test_webhook_feeds_update_and_swallows_handler_errors(client):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+    assert client.post(settings.WEBHOOK_PATH, json=UPDATE, headers=headers).status_code == 200
+    # Ошибка хендлера — все равно 200, иначе Telegram пришлет апдейт повторно
+    assert client.post(settings.WEBHOOK_PATH, json={**UPDATE, "update_id": 2}, headers=headers).status_code == 200
+    assert client.fed == [1, 2]
+
+def test_webhook_disabled_in_polling_mode(client, monkeypatch):
+    monkeypatch.setattr(settings, "BOT_MODE", "polling")
+    res = client.post(settings.WEBHOOK_PATH, json=UPDATE, headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"})
+    assert res.status_code == 404
+    assert client.fed == []
+
+def test_webhook_requires_secret(client, monkeypatch):
+    # Пустой заголовок при пустом секрете не проходит
+    monkeypatch.setattr(settings, "WEBHOOK_SECRET", "")
+    assert client.post(settings.WEBHOOK_PATH, json=UPDATE).status_code == 403
+    assert client.fed == []
+    with pytest.raises(RuntimeError, match="WEBHOOK_SECRET"):
+        main.check_webhook_config()